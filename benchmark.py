@@ -0,0 +1,397 @@
+# Benchmarks for the performance work on the processors.
+# Every benchmark builds its own synthetic data in a temporary folder, so no
+# database (and no Blazegraph instance) is needed. Run all of them with
+#   python benchmark.py
+# or only some of them with
+#   python benchmark.py relational_getters
+from contextlib import closing
+from csv import writer
+from io import BytesIO, StringIO
+from json import dump, dumps
+from os.path import join
+from sqlite3 import connect
+from sys import argv
+from tempfile import TemporaryDirectory
+from time import perf_counter
+from tracemalloc import start, stop, take_snapshot, get_traced_memory
+from pandas import DataFrame, concat, read_csv, read_sql
+from impl import RelationalQueryProcessor, MetadataProcessor, GenericQueryProcessor
+from impl import AnnotationProcessor, CollectionProcessor, TriplestoreQueryProcessor
+from impl import Annotation, IdentifiableEntity, Image
+from utils.SparqlResults import read_csv_results, read_json_results
+
+
+def timeit(function, repeat:int):
+    start = perf_counter()
+    for _ in range(repeat):
+        function()
+    return perf_counter() - start
+
+
+def create_relational_db(path:str, n_annotations:int=1000, n_entities:int=1000):
+    # same tables written by AnnotationProcessor and MetadataProcessor
+    annotations = DataFrame({
+        "annotationId": [f"annotation-{i}" for i in range(n_annotations)],
+        "id": [f"https://example.org/annotation/{i}" for i in range(n_annotations)],
+        "body": [f"https://example.org/image/{i}.jpg" for i in range(n_annotations)],
+        "target": [f"https://example.org/canvas/{i % n_entities}" for i in range(n_annotations)],
+        "motivation": ["painting"] * n_annotations
+    })
+    images = DataFrame({
+        "imageId": [f"image-{i}" for i in range(n_annotations)],
+        "id": annotations["body"]
+    })
+    entities = DataFrame({
+        "entityId": [f"entity-{i}" for i in range(n_entities)],
+        "id": [f"https://example.org/canvas/{i}" for i in range(n_entities)],
+        "title": [f"Title {i % 100}" for i in range(n_entities)]
+    })
+    creators = DataFrame({
+        "entityId": entities["entityId"],
+        "creator": [f"Creator {i % 50}" for i in range(n_entities)]
+    })
+    with connect(path) as con:
+        annotations.to_sql("Annotation", con, if_exists="replace", index=False)
+        images.to_sql("Image", con, if_exists="replace", index=False)
+        entities.to_sql("Entity", con, if_exists="replace", index=False)
+        creators.to_sql("Creators", con, if_exists="replace", index=False)
+    con.close()
+
+
+class UnpooledRelationalQueryProcessor(RelationalQueryProcessor):
+    # the behaviour before the connection pool: a new connection for every query,
+    # closed when the query has run (all the getters measured go through runStatement)
+    def runStatement(self, name:str, params:tuple=()):
+        with closing(connect(self.getDbPathOrUrl())) as con:
+            return read_sql(self.statements[name], con, params=params)
+
+
+def relational_getters(repeat:int=300):
+    with TemporaryDirectory() as folder:
+        path = join(folder, "benchmark.db")
+        create_relational_db(path)
+
+        getters = [
+            ("getAllAnnotations", lambda qp: qp.getAllAnnotations()),
+            ("getAllImages", lambda qp: qp.getAllImages()),
+            ("getAnnotationsWithBody", lambda qp: qp.getAnnotationsWithBody("https://example.org/image/7.jpg")),
+            ("getAnnotationsWithBodyAndTarget", lambda qp: qp.getAnnotationsWithBodyAndTarget("https://example.org/image/7.jpg", "https://example.org/canvas/7")),
+            ("getAnnotationsWithTarget", lambda qp: qp.getAnnotationsWithTarget("https://example.org/canvas/7")),
+            ("getEntitiesWithCreator", lambda qp: qp.getEntitiesWithCreator("Creator 7")),
+            ("getEntitiesWithTitle", lambda qp: qp.getEntitiesWithTitle("Title 7")),
+            ("getEntities", lambda qp: qp.getEntities()),
+        ]
+
+        # without the result cache, every call really runs its query
+        before = UnpooledRelationalQueryProcessor()
+        before.setDbPathOrUrl(path)
+        before.resultCache = None
+        after = RelationalQueryProcessor()
+        after.setDbPathOrUrl(path)
+        after.resultCache = None
+
+        print("relational getters, queries per second")
+        print(f"{'method':<34}{'before':>10}{'after':>10}{'speedup':>10}")
+        for name, getter in getters:
+            qps_before = repeat / timeit(lambda: getter(before), repeat)
+            qps_after = repeat / timeit(lambda: getter(after), repeat)
+            print(f"{name:<34}{qps_before:>10.0f}{qps_after:>10.0f}{qps_after / qps_before:>9.2f}x")
+        after.close()
+
+
+def create_metadata_csv(path:str, rows:int):
+    # a third of the entities has two creators, a third one, a third none
+    creators = ["Doe, John; Doe, Jane", "Alighieri, Dante", ""]
+    with open(path, "w", encoding="utf-8") as f:
+        f.write("id,title,creator\n")
+        for i in range(rows):
+            f.write(f'https://example.org/entity/{i},Title {i},"{creators[i % 3]}"\n')
+
+
+def split_creators_loop(creator:DataFrame):
+    # the loop used before MetadataProcessor.splitCreators (iteritems is now items)
+    for idx, row in creator.iterrows():
+        for item_idx, item in row.items():
+            if "entity-" in item:
+                entity_id = item
+            if ";" in item:
+                list_of_creators = item.split(";")
+                creator = creator.drop(idx)
+                new_serie = []
+                for i in range(len(list_of_creators)):
+                    new_serie.append(entity_id)
+                new_data = DataFrame({"entityId": new_serie, "creator": list_of_creators})
+                creator = concat([creator.loc[:idx-1], new_data, creator.loc[idx:]], ignore_index=True)
+    return creator
+
+
+def creator_split(rows:int=1000000, loop_rows=(1000, 2000, 4000)):
+    def creator_frame(n):
+        creators = ["Doe, John; Doe, Jane", "Alighieri, Dante", ""]
+        return DataFrame({
+            "entityId": [f"entity-{i}" for i in range(n)],
+            "creator": [creators[i % 3] for i in range(n)]
+        }, dtype="string")
+
+    print("creator splitting, seconds")
+    print(f"{'rows':>10}{'loop':>10}{'explode':>10}")
+    for n in loop_rows:
+        frame = creator_frame(n)
+        print(f"{n:>10}{timeit(lambda: split_creators_loop(frame), 1):>10.3f}{timeit(lambda: MetadataProcessor.splitCreators(frame), 1):>10.3f}")
+    frame = creator_frame(rows)
+    print(f"{rows:>10}{'-':>10}{timeit(lambda: MetadataProcessor.splitCreators(frame), 1):>10.3f}")
+
+    with TemporaryDirectory() as folder:
+        csv_path = join(folder, "metadata.csv")
+        create_metadata_csv(csv_path, rows)
+        processor = MetadataProcessor()
+        processor.setDbPathOrUrl(join(folder, "benchmark.db"))
+        elapsed = timeit(lambda: processor.uploadData(csv_path), 1)
+        print(f"MetadataProcessor.uploadData of {rows} rows: {elapsed:.2f}s ({rows / elapsed:.0f} rows/s)")
+
+
+def annotations_iterrows(df:DataFrame):
+    # how GenericQueryProcessor built the objects before buildObjects
+    return [
+        Annotation(row['id'], row['motivation'], IdentifiableEntity(row['target']), Image(row['body']))
+        for _, row in df.reset_index().iterrows()
+    ]
+
+
+def annotations_vectorized(df:DataFrame):
+    # as in GenericQueryProcessor.getAllAnnotations
+    targets = dict()
+    bodies = dict()
+    return GenericQueryProcessor.buildObjects(
+        df,
+        lambda id, motivation, target, body: Annotation(id, motivation, IdentifiableEntity.intern(target, targets), Image.intern(body, bodies)),
+        "id", "motivation", "target", "body")
+
+
+def materialisation(rows:int=1000000, iterrows_rows:int=50000):
+    # iterrows is far too slow for the whole frame, it runs on the first rows only
+    df = DataFrame({
+        "id": [f"https://example.org/annotation/{i}" for i in range(rows)],
+        "body": [f"https://example.org/image/{i}.jpg" for i in range(rows)],
+        "target": [f"https://example.org/canvas/{i % 1000}" for i in range(rows)],
+        "motivation": ["painting"] * rows
+    })
+    sample = df.head(iterrows_rows)
+
+    print("annotations built from a DataFrame, objects per second")
+    print(f"{'method':<12}{'rows':>10}{'seconds':>10}{'objects/s':>12}")
+    for name, function, frame in [("iterrows", annotations_iterrows, sample),
+                                  ("vectorized", annotations_vectorized, sample),
+                                  ("vectorized", annotations_vectorized, df)]:
+        elapsed = timeit(lambda: function(frame), 1)
+        print(f"{name:<12}{len(frame):>10}{elapsed:>10.3f}{len(frame) / elapsed:>12.0f}")
+
+
+class DictEntity(object):
+    # the data model before __slots__: a __dict__ in every object
+    def __init__(self, id):
+        self.id = id
+
+
+class DictAnnotation(DictEntity):
+    def __init__(self, id, motivation, target, body):
+        self.motivation = motivation
+        self.target = target
+        self.body = body
+        super().__init__(id)
+
+
+def traced_size(function):
+    # bytes still allocated by the objects that function returns
+    start()
+    before = take_snapshot()
+    result = function()
+    after = take_snapshot()
+    stop()
+    size = sum(stat.size_diff for stat in after.compare_to(before, "filename"))
+    return size, result
+
+
+def annotation_memory(rows:int=1000000, targets:int=1000):
+    # the annotations of a large corpus: many of them share the same target canvas.
+    # both models are built from the same DataFrame, so they allocate the same strings
+    df = DataFrame({
+        "id": [f"https://example.org/annotation/{i}" for i in range(rows)],
+        "motivation": ["painting"] * rows,
+        "target": [f"https://example.org/canvas/{i % targets}" for i in range(rows)],
+        "body": [f"https://example.org/image/{i}.jpg" for i in range(rows)]
+    }, dtype=object)
+
+    size_before, objects = traced_size(lambda: GenericQueryProcessor.buildObjects(
+        df,
+        lambda id, motivation, target, body: DictAnnotation(id, motivation, DictEntity(target), DictEntity(body)),
+        "id", "motivation", "target", "body"))
+    del objects
+    size_after, objects = traced_size(lambda: annotations_vectorized(df))
+    del objects
+
+    print(f"memory of {rows} annotations ({targets} distinct targets)")
+    print(f"{'model':<12}{'MB':>10}{'bytes/obj':>12}")
+    print(f"{'__dict__':<12}{size_before / 2**20:>10.1f}{size_before / rows:>12.0f}")
+    print(f"{'__slots__':<12}{size_after / 2**20:>10.1f}{size_after / rows:>12.0f}")
+    print(f"ratio {size_after / size_before:.2f}")
+
+
+def create_collections_json(path:str, collections:int, manifests:int, canvases:int):
+    # collections -> manifests -> canvases with the structure of the IIIF files in data/
+    base = "https://example.org/iiif"
+    data = [{
+        "id": f"{base}/collection/{c}", "type": "Collection", "label": {"none": [f"Collection {c}"]},
+        "items": [{
+            "id": f"{base}/manifest/{c}-{m}", "type": "Manifest", "label": {"none": [f"Manifest {c}-{m}"]},
+            "items": [{
+                "id": f"{base}/canvas/{c}-{m}-{k}", "type": "Canvas", "label": {"none": [f"Canvas {c}-{m}-{k}"]}
+            } for k in range(canvases)]
+        } for m in range(manifests)]
+    } for c in range(collections)]
+    with open(path, "w", encoding="utf-8") as f:
+        dump(data, f)
+
+
+def create_annotations_csv(path:str, rows:int, collections:int, manifests:int, canvases:int):
+    # the annotations are spread evenly over all the canvases
+    base = "https://example.org/iiif"
+    targets = [f"{base}/canvas/{c}-{m}-{k}" for c in range(collections) for m in range(manifests) for k in range(canvases)]
+    with open(path, "w", encoding="utf-8") as f:
+        f.write("id,body,target,motivation\n")
+        for i in range(rows):
+            f.write(f"{base}/annotation/{i},https://example.org/image/{i}.jpg,{targets[i % len(targets)]},painting\n")
+
+
+def annotations_per_canvas(mediator:GenericQueryProcessor, collectionId:str=None, manifestId:str=None):
+    # the loop the set-based methods replace: one graph query per manifest and
+    # one relational query per canvas
+    result = []
+    for processor in mediator.queryProcessors:
+        if isinstance(processor, TriplestoreQueryProcessor):
+            manifestIds = [manifestId] if collectionId is None else processor.getManifestsInCollection(collectionId)["id"]
+            for manifestId in manifestIds:
+                for canvasId in processor.getCanvasesInManifest(manifestId)["id"]:
+                    for relational in mediator.queryProcessors:
+                        if isinstance(relational, RelationalQueryProcessor):
+                            result += mediator.buildAnnotations([relational.getAnnotationsWithTarget(canvasId)])
+    return result
+
+
+def annotation_rollups(annotations:int=1000000, collections:int=10, manifests:int=100, canvases:int=20):
+    # 1k manifests (10 collections of 100), 20k canvases and 1M annotations, with the
+    # graph in a local N-Triples file so that no Blazegraph instance is needed
+    with TemporaryDirectory() as folder:
+        index = join(folder, "identity.db")
+        json_path = join(folder, "collections.json")
+        csv_path = join(folder, "annotations.csv")
+        create_collections_json(json_path, collections, manifests, canvases)
+        create_annotations_csv(csv_path, annotations, collections, manifests, canvases)
+
+        start = perf_counter()
+        graph = CollectionProcessor(batchSize=0, streaming=True)
+        graph.countersDir = folder
+        graph.identityIndex = index
+        graph.setDbPathOrUrl(join(folder, "graph.nt"))
+        graph.uploadData(json_path)
+        relational = AnnotationProcessor()
+        relational.identityIndex = index
+        relational.setDbPathOrUrl(join(folder, "relational.db"))
+        relational.uploadData(csv_path)
+        print(f"corpus loaded in {perf_counter() - start:.1f}s")
+
+        mediators = dict()
+        for name, index_path in [("set-based", None), ("closure", index)]:
+            mediator = GenericQueryProcessor(identityIndex=index_path)
+            rqp = RelationalQueryProcessor()
+            rqp.setDbPathOrUrl(join(folder, "relational.db"))
+            tqp = TriplestoreQueryProcessor()
+            tqp.setDbPathOrUrl(join(folder, "graph.nt"))
+            rqp.resultCache = None
+            tqp.resultCache = None
+            mediator.addQueryProcessor(rqp)
+            mediator.addQueryProcessor(tqp)
+            mediators[name] = mediator
+        collectionId = "https://example.org/iiif/collection/3"
+        manifestId = "https://example.org/iiif/manifest/3-7"
+        # the graph file is parsed by the first query
+        mediators["set-based"].getAnnotationsToManifest(manifestId)
+
+        print("annotation roll-ups, seconds")
+        print(f"{'method':<28}{'per-canvas':>12}{'set-based':>12}{'closure':>12}{'annotations':>13}")
+        for name, loop_call, call in [
+            ("getAnnotationsToCollection", lambda m: annotations_per_canvas(m, collectionId=collectionId),
+             lambda m: m.getAnnotationsToCollection(collectionId)),
+            ("getAnnotationsToManifest", lambda m: annotations_per_canvas(m, manifestId=manifestId),
+             lambda m: m.getAnnotationsToManifest(manifestId)),
+        ]:
+            loop = timeit(lambda: loop_call(mediators["set-based"]), 1)
+            times = [timeit(lambda: call(mediators[mediator]), 1) for mediator in ("set-based", "closure")]
+            found = len(call(mediators["closure"]))
+            print(f"{name:<28}{loop:>12.3f}{times[0]:>12.3f}{times[1]:>12.3f}{found:>13}")
+
+
+def create_sparql_results(rows:int):
+    # the CSV and JSON results of getAllCanvases on a graph of rows canvases
+    canvases = [(f"https://example.org/canvas/{i}",
+                 f"https://dl.ficlit.unibo.it/iiif/2/{i // 100}/canvas/p{i % 100}",
+                 f"Canvas {i}, \"page\" {i % 100}") for i in range(rows)]
+    names = ["canvas", "id", "label"]
+    text = StringIO()
+    csv_rows = writer(text, lineterminator="\r\n")
+    csv_rows.writerow(names)
+    csv_rows.writerows(canvases)
+    json = dumps({"head": {"vars": names}, "results": {"bindings": [
+        {"canvas": {"type": "uri", "value": canvas},
+         "id": {"type": "literal", "value": id},
+         "label": {"type": "literal", "value": label}} for canvas, id, label in canvases]}})
+    return text.getvalue().encode("utf-8"), json.encode("utf-8")
+
+
+def read_csv_string(stream):
+    # the path of sparql_dataframe.get: the whole body, decoded, then parsed
+    return read_csv(StringIO(stream.read().decode("utf-8")), sep=",")
+
+
+def traced_peak(function):
+    # highest traced allocation while function runs (tracing slows down every
+    # allocation, so the time is measured on another run)
+    start()
+    result = function()
+    peak = get_traced_memory()[1]
+    stop()
+    return peak, result
+
+
+def sparql_results(rows:int=1000000):
+    # the body is already in memory (it stands for the socket), so only what the
+    # readers allocate is traced. the three DataFrames are the same
+    csv_body, json_body = create_sparql_results(rows)
+
+    print(f"SELECT results of {rows} rows into a DataFrame (CSV {len(csv_body) / 2**20:.0f} MB, JSON {len(json_body) / 2**20:.0f} MB)")
+    print(f"{'reader':<14}{'seconds':>10}{'peak MB':>10}")
+    frames = []
+    for name, function, body in [("csv string", read_csv_string, csv_body),
+                                 ("csv stream", read_csv_results, csv_body),
+                                 ("json stream", read_json_results, json_body)]:
+        elapsed = timeit(lambda: function(BytesIO(body)), 1)
+        peak, frame = traced_peak(lambda: function(BytesIO(body)))
+        frames.append(frame)
+        print(f"{name:<14}{elapsed:>10.3f}{peak / 2**20:>10.1f}")
+    print("same DataFrames:", all(frame.equals(frames[0]) for frame in frames[1:]))
+
+
+BENCHMARKS = {
+    "relational_getters": relational_getters,
+    "creator_split": creator_split,
+    "materialisation": materialisation,
+    "annotation_memory": annotation_memory,
+    "annotation_rollups": annotation_rollups,
+    "sparql_results": sparql_results,
+}
+
+
+if __name__ == "__main__":
+    for name in argv[1:] or BENCHMARKS:
+        BENCHMARKS[name]()
+        print()
@@ -1,29 +1,56 @@
 from sqlite3 import connect
-from pandas import read_sql, DataFrame, concat, read_csv, Series
-from utils.paths import RDF_DB_URL, SQL_DB_URL
+from pandas import read_sql, DataFrame, concat, read_csv, Series, merge
+from utils.paths import RDF_DB_URL, SQL_DB_URL, COUNTERS_DIR
 from rdflib import Graph, Literal, URIRef
-from rdflib.plugins.stores.sparqlstore import SPARQLUpdateStore
 from sparql_dataframe import get 
 from utils.clean_str import remove_special_chars
 from json import load
-from utils.CreateGraph import create_Graph
+from utils.CreateGraph import create_Graph, stream_Graph
+from utils.UploadGraph import upload_Graph
+from utils.IdAllocator import IdAllocator
+from utils.ConnectionPool import ConnectionPool
+from utils.SparqlSession import SparqlSession
+from utils.SparqlResults import CSV, JSON, fetch_results
+from utils.LocalGraph import is_local_graph, LocalGraphStore
+from utils.ResultCache import ResultCache
+from utils.SparqlTemplate import SparqlTemplates
+from utils.IdentityIndex import IdentityIndex, GraphEntities
 from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor
+from time import monotonic
+from asyncio import to_thread
+from threading import Lock
 
 
 #NOTE: BLOCK DATA MODEL
 
 class IdentifiableEntity():
+    # __slots__ instead of a __dict__ in every object: with hundreds of thousands
+    # of annotations the objects take a fraction of the memory
+    __slots__ = ("id",)
+
     def __init__(self, id:str):
         self.id = id
     def getId(self):
         return self.id
 
+    @classmethod
+    def intern(cls, id:str, shared:dict):
+        # the object of id in shared, created the first time: the annotations of a
+        # result pointing to the same canvas (or image) all get the same object
+        entity = shared.get(id)
+        if entity is None:
+            entity = shared[id] = cls(id)
+        return entity
+
 
 class Image(IdentifiableEntity):
-    pass
+    __slots__ = ()
 
 
 class Annotation(IdentifiableEntity):
+    __slots__ = ("motivation", "target", "body")
+
     def __init__(self, id, motivation:str, target:IdentifiableEntity, body:Image):
         self.motivation = motivation
         self.target = target
@@ -38,6 +65,8 @@ class Annotation(IdentifiableEntity):
     
 
 class EntityWithMetadata(IdentifiableEntity):
+    __slots__ = ("label", "title", "creators")
+
     def __init__(self, id, label, title, creators):
         self.label = label 
         self.title = title
@@ -63,21 +92,70 @@ class EntityWithMetadata(IdentifiableEntity):
     
 
 class Canvas(EntityWithMetadata):
+    __slots__ = ()
+
     def __init__(self, id:str, label:str, title:str, creators:list[str]):
         super().__init__(id, label, title, creators)
 
+class ItemsBatch(object):
+    # the loader of the items of several manifests or collections at once:
+    # load() returns {owner id: list of items}. it runs the first time any of
+    # the owners needs its items, so the others find them already loaded
+    __slots__ = ("load", "items", "mutex")
+
+    def __init__(self, load):
+        self.load = load
+        self.items = None
+        self.mutex = Lock()
+
+    def loadAll(self):
+        with self.mutex:
+            if self.items is None:
+                self.items = self.load()
+        return self.items
+
+    def getItems(self, ownerId:str):
+        return self.loadAll().get(ownerId, [])
+
+
+class LazyItems(object):
+    # the items of a Manifest or Collection that are not loaded yet: getItems() of
+    # the owner asks them to the batch and keeps the list it gets back. the owners
+    # created by the same query share a batch, which is a hint to load the items
+    # of all of them together
+    __slots__ = ("ownerId", "batch")
+
+    def __init__(self, ownerId:str, batch:ItemsBatch):
+        self.ownerId = ownerId
+        self.batch = batch
+
+    def resolve(self):
+        # an error of the loader reaches the caller of getItems(): an empty list
+        # would look like an owner without items. nothing is kept, so the next
+        # getItems() tries again
+        return self.batch.getItems(self.ownerId)
+
+
 class Manifest(EntityWithMetadata):
+    __slots__ = ("items",)
+
     def __init__(self, id:str, label:str, title:str, creators:list[str], items:list[Canvas]):
         super().__init__(id, label, title, creators)
         self.items = items
     def getItems(self):
+        if isinstance(self.items, LazyItems):
+            self.items = self.items.resolve()
         return self.items
 
 class Collection(EntityWithMetadata):
+    __slots__ = ("items",)
+
     def __init__(self, id:str, label:str, title:str, creators:list[str], items:list[Manifest]):
         super().__init__(id, label, title, creators)
         self.items = items
     def getItems(self):
+        if isinstance(self.items, LazyItems):
+            self.items = self.items.resolve()
         return self.items
 
 
@@ -88,6 +166,9 @@ class Collection(EntityWithMetadata):
 
 class Processor(object):
     dbPathOrUrl=""
+    # True for the processors of a graph database, which can also be a local
+    # .nt/.ttl file (see utils/LocalGraph)
+    localGraph = False
     def __init__(self):
         self.dbPathOrUrl = ""
     def getDbPathOrUrl(self):
@@ -96,6 +177,10 @@ class Processor(object):
         if len(newpath)>=3 and newpath[-3:] == ".db":
             self.dbPathOrUrl = newpath
             return True
+        elif self.localGraph and is_local_graph(newpath):
+            # a local graph database (see utils/LocalGraph) instead of a SPARQL endpoint
+            self.dbPathOrUrl = newpath
+            return True
         else:
             is_url = urlparse(newpath)
             if all([is_url.scheme, is_url.netloc]):
@@ -103,12 +188,32 @@ class Processor(object):
                 return True
             else:
                 return False
+    def invalidateResults(self):
+        # called after every upload: the cached query results of this database are old
+        if QueryProcessor.resultCache is not None:
+            QueryProcessor.resultCache.invalidate(self.getDbPathOrUrl())
 
 
 class QueryProcessor(Processor):
+    # cache of the query results shared by all the query processors: a result is
+    # found again for the same call on the same database until a processor uploads
+    # data into that database, the file changes or the result is 5 minutes old (30
+    # seconds for an endpoint, whose writes by other processes or through another
+    # URL are not seen). it keeps 64MB of results at most (see ResultCache). set
+    # it to None on a processor to always run the queries
+    resultCache = ResultCache()
+
     def __init__(self):
         super().__init__()
 
+    def cachedResult(self, key, compute):
+        if self.resultCache is None:
+            return compute()
+        return self.resultCache.getOrCompute(self.getDbPathOrUrl(), key, compute)
+
+    def getCacheStats(self):
+        return self.resultCache.getStats() if self.resultCache is not None else dict()
+
     def getEntityById(self, entityId: str):
         entityId_stripped = entityId.strip("'")
         db_url = self.getDbPathOrUrl() if len(self.getDbPathOrUrl()) else SQL_DB_URL
@@ -121,8 +226,8 @@ class QueryProcessor(Processor):
                 " LEFT JOIN Annotation" +\
                 " ON Entity.id = Annotation.target" +\
                 " WHERE 1=1" +\
-                f" AND Entity.id='{entityId_stripped}'"
-                df = read_sql(query, con)
+                " AND Entity.id=?"
+                df = read_sql(query, con, params=(entityId_stripped,))
 
         elif db_url == RDF_DB_URL:
             endpoint = 'http://127.0.0.1:9999/blazegraph/sparql'
@@ -143,79 +248,59 @@ class QueryProcessor(Processor):
 
 
 class TriplestoreQueryProcessor(QueryProcessor):
-
-    def __init__(self):
-        super().__init__()
-
-    def getAllCanvases(self):
-
-        endpoint = self.getDbPathOrUrl()
-        query_canvases = """
-        PREFIX ns1: <https://github.com/n1kg0r/ds-project-dhdk/attributes/> 
-        PREFIX ns2: <http://purl.org/dc/elements/1.1/> 
-        PREFIX ns3: <https://github.com/n1kg0r/ds-project-dhdk/relations/> 
-
+    # every query is a template compiled once with the prefixes, the values are
+    # bound as escaped literals ({{name}} placeholders) when it is run: the same
+    # call always sends the same text and quotes in ids and labels are safe
+    localGraph = True
+    templates = SparqlTemplates({
+        "allCanvases": """
         SELECT ?canvas ?id ?label
         WHERE {
             ?canvas a <https://github.com/n1kg0r/ds-project-dhdk/classes/Canvas>;
             ns2:identifier ?id;
             ns1:label ?label.
         }
-        """
-
-        df_sparql_getAllCanvases = get(endpoint, query_canvases, True)
-        return df_sparql_getAllCanvases
-
-    def getAllCollections(self):
-
-        endpoint = self.getDbPathOrUrl()
-        query_collections = """
-        PREFIX ns1: <https://github.com/n1kg0r/ds-project-dhdk/attributes/> 
-        PREFIX ns2: <http://purl.org/dc/elements/1.1/> 
-        PREFIX ns3: <https://github.com/n1kg0r/ds-project-dhdk/relations/> 
-
+        """,
+        "canvasesAfter": """
+        SELECT ?canvas ?id ?label
+        WHERE {
+            ?canvas a <https://github.com/n1kg0r/ds-project-dhdk/classes/Canvas>;
+            ns2:identifier ?id;
+            ns1:label ?label.
+            FILTER(STR(?canvas) > {{last}})
+        }
+        ORDER BY STR(?canvas)
+        """,
+        "canvasWithIri": """
+        SELECT ?canvas ?id ?label
+        WHERE {
+            ?canvas a <https://github.com/n1kg0r/ds-project-dhdk/classes/Canvas>;
+            ns2:identifier ?id;
+            ns1:label ?label.
+            FILTER(STR(?canvas) = {{canvas}})
+        }
+        """,
+        "allCollections": """
         SELECT ?collection ?id ?label
         WHERE {
            ?collection a <https://github.com/n1kg0r/ds-project-dhdk/classes/Collection>;
            ns2:identifier ?id;
            ns1:label ?label .
         }
-        """
-
-        df_sparql_getAllCollections = get(endpoint, query_collections, True)
-        return df_sparql_getAllCollections
-
-    def getAllManifests(self):
-
-        endpoint = self.getDbPathOrUrl()
-        query_manifest = """
-        PREFIX ns1: <https://github.com/n1kg0r/ds-project-dhdk/attributes/> 
-        PREFIX ns2: <http://purl.org/dc/elements/1.1/> 
-        PREFIX ns3: <https://github.com/n1kg0r/ds-project-dhdk/relations/> 
-
+        """,
+        "allManifests": """
         SELECT ?manifest ?id ?label
         WHERE {
            ?manifest a <https://github.com/n1kg0r/ds-project-dhdk/classes/Manifest>;
            ns2:identifier ?id;
            ns1:label ?label .
         }
-        """
-
-        df_sparql_getAllManifest = get(endpoint, query_manifest, True)
-        return df_sparql_getAllManifest
-
-    def getCanvasesInCollection(self, collectionId: str):
-
-        endpoint = self.setDbPathOrUrl()
-        query_canInCol = """
-        PREFIX ns1: <https://github.com/n1kg0r/ds-project-dhdk/attributes/> 
-        PREFIX ns2: <http://purl.org/dc/elements/1.1/> 
-        PREFIX ns3: <https://github.com/n1kg0r/ds-project-dhdk/relations/> 
-
+        """,
+        "canvasesInCollection": """
         SELECT ?canvas ?id ?label 
         WHERE {
             ?collection a <https://github.com/n1kg0r/ds-project-dhdk/classes/Collection> ;
-            ns2:identifier "%s" ;
+            ns2:identifier {{collectionId}} ;
             ns3:items ?manifest .
             ?manifest a <https://github.com/n1kg0r/ds-project-dhdk/classes/Manifest> ;
             ns3:items ?canvas .
@@ -223,279 +308,774 @@ class TriplestoreQueryProcessor(QueryProcessor):
             ns2:identifier ?id ;
             ns1:label ?label .
         }
-        """ % collectionId
-
-        df_sparql_getCanvasesInCollection = get(endpoint, query_canInCol, True)
-        return df_sparql_getCanvasesInCollection
-
-    def getCanvasesInManifest(self, manifestId: str):
-
-        endpoint = self.getDbPathOrUrl()
-        query_canInMan = """
-        PREFIX ns1: <https://github.com/n1kg0r/ds-project-dhdk/attributes/> 
-        PREFIX ns2: <http://purl.org/dc/elements/1.1/> 
-        PREFIX ns3: <https://github.com/n1kg0r/ds-project-dhdk/relations/> 
-
+        """,
+        "canvasesInManifest": """
         SELECT ?canvas ?id ?label
         WHERE {
             ?manifest a <https://github.com/n1kg0r/ds-project-dhdk/classes/Manifest> ;
-            ns2:identifier "%s" ;
+            ns2:identifier {{manifestId}} ;
             ns3:items ?canvas .
             ?canvas a <https://github.com/n1kg0r/ds-project-dhdk/classes/Canvas> ;
             ns2:identifier ?id ;
             ns1:label ?label .
         }
-        """ % manifestId
-
-        df_sparql_getCanvasesInManifest = get(endpoint, query_canInMan, True)
-        return df_sparql_getCanvasesInManifest
-
-
-    def getManifestsInCollection(self, collectionId: str):
-
-        endpoint = self.getDbPathOrUrl()
-        query_manInCol = """
-        PREFIX ns1: <https://github.com/n1kg0r/ds-project-dhdk/attributes/> 
-        PREFIX ns2: <http://purl.org/dc/elements/1.1/> 
-        PREFIX ns3: <https://github.com/n1kg0r/ds-project-dhdk/relations/> 
-
+        """,
+        "canvasesInManifests": """
+        SELECT ?manifestId ?canvas ?id ?label
+        WHERE {
+            VALUES ?manifestId { {{manifestIds}} }
+            ?manifest a <https://github.com/n1kg0r/ds-project-dhdk/classes/Manifest> ;
+            ns2:identifier ?manifestId ;
+            ns3:items ?canvas .
+            ?canvas a <https://github.com/n1kg0r/ds-project-dhdk/classes/Canvas> ;
+            ns2:identifier ?id ;
+            ns1:label ?label .
+        }
+        """,
+        "manifestsInCollection": """
         SELECT ?manifest ?id ?label
         WHERE {
             ?collection a <https://github.com/n1kg0r/ds-project-dhdk/classes/Collection> ;
-            ns2:identifier "%s" ;
+            ns2:identifier {{collectionId}} ;
             ns3:items ?manifest .
             ?manifest a <https://github.com/n1kg0r/ds-project-dhdk/classes/Manifest> ;
             ns2:identifier ?id ;
             ns1:label ?label .
         }
-        """ % collectionId
-
-        df_sparql_getManifestInCollection = get(endpoint, query_manInCol, True)
-        return df_sparql_getManifestInCollection
-    
-
-    def getEntitiesWithLabel(self, label: str): 
-            
-
-        endpoint = self.getDbPathOrUrl()
-        query_entityLabel = """
-        PREFIX ns1: <https://github.com/n1kg0r/ds-project-dhdk/attributes/> 
-        PREFIX ns2: <http://purl.org/dc/elements/1.1/> 
-        PREFIX ns3: <https://github.com/n1kg0r/ds-project-dhdk/relations/> 
-
+        """,
+        "manifestsInCollections": """
+        SELECT ?collectionId ?manifest ?id ?label
+        WHERE {
+            VALUES ?collectionId { {{collectionIds}} }
+            ?collection a <https://github.com/n1kg0r/ds-project-dhdk/classes/Collection> ;
+            ns2:identifier ?collectionId ;
+            ns3:items ?manifest .
+            ?manifest a <https://github.com/n1kg0r/ds-project-dhdk/classes/Manifest> ;
+            ns2:identifier ?id ;
+            ns1:label ?label .
+        }
+        """,
+        "canvasesInManifestsOfCollection": """
+        SELECT ?manifestId ?canvas ?id ?label
+        WHERE {
+            ?collection a <https://github.com/n1kg0r/ds-project-dhdk/classes/Collection> ;
+            ns2:identifier {{collectionId}} ;
+            ns3:items ?manifest .
+            ?manifest a <https://github.com/n1kg0r/ds-project-dhdk/classes/Manifest> ;
+            ns2:identifier ?manifestId ;
+            ns3:items ?canvas .
+            ?canvas a <https://github.com/n1kg0r/ds-project-dhdk/classes/Canvas> ;
+            ns2:identifier ?id ;
+            ns1:label ?label .
+        }
+        """,
+        "entitiesWithLabel": """
         SELECT ?entity ?type ?label ?id
         WHERE {
-            ?entity ns1:label "%s" ;
+            ?entity ns1:label {{label}} ;
             a ?type ;
             ns1:label ?label ;
             ns2:identifier ?id .
         }
-        """ % remove_special_chars(label)
-
-        df_sparql_getEntitiesWithLabel = get(endpoint, query_entityLabel, True)
-        return df_sparql_getEntitiesWithLabel
-    
-
-    def getEntitiesWithCanvas(self, canvasId: str): 
-            
-        endpoint = self.getDbPathOrUrl()
-        query_entityCanvas = """
-        PREFIX ns1: <https://github.com/n1kg0r/ds-project-dhdk/attributes/> 
-        PREFIX ns2: <http://purl.org/dc/elements/1.1/> 
-        PREFIX ns3: <https://github.com/n1kg0r/ds-project-dhdk/relations/> 
-
+        """,
+        "entitiesWithId": """
         SELECT ?id ?label ?type
         WHERE {
-            ?entity ns2:identifier "%s" ;
+            ?entity ns2:identifier {{id}} ;
             ns2:identifier ?id ;
             ns1:label ?label ;
             a ?type .
         }
-        """ % remove_special_chars(canvasId)
+        """,
+        "allEntities": """
+        SELECT ?entity ?id ?label ?type
+        WHERE {
+            ?entity ns2:identifier ?id ;
+                    ns2:identifier ?id ;
+                    ns1:label ?label ;
+                    a ?type .
+        }
+        """,
+        "descendantIds": """
+        SELECT DISTINCT ?id
+        WHERE {
+            ?entity ns2:identifier {{entityId}} ;
+            ns3:items+ ?item .
+            ?item ns2:identifier ?id .
+        }
+        """,
+        "entitiesWithIds": """
+        SELECT ?entity ?id ?label ?type
+        WHERE {
+            VALUES ?id { {{ids}} }
+            ?entity ns2:identifier ?id ;
+                    ns1:label ?label ;
+                    a ?type .
+        }
+        """
+    })
+
+    # the result formats asked to the endpoint, in order of preference: the
+    # DataFrames are the same with all of them. pandas parses CSV faster than
+    # ijson parses JSON, JSON is there for the endpoints without CSV results
+    resultFormats = (CSV, JSON)
+
+    def __init__(self):
+        super().__init__()
+
+    def runQuery(self, query: str):
+        # every getter sends its query through here, the same query text on the
+        # same database is answered by the result cache
+        return self.cachedResult(("sparql", query), lambda: self.fetchQuery(query))
+
+    def runTemplate(self, name: str, **values):
+        return self.runQuery(self.templates.render(name, **values))
+
+    def runBatches(self, name: str, column: str, values, batchSize: int, columns: list):
+        # one request per batchSize values instead of one per value: the values
+        # are bound to the VALUES block of the template as a list
+        values = list(dict.fromkeys(str(value) for value in values))
+        frames = [self.runTemplate(name, **{column: values[start:start + batchSize]})
+                  for start in range(0, len(values), batchSize)]
+        if not frames:
+            return DataFrame(columns=columns)
+        return concat(frames, ignore_index=True)
+
+    def getTemplateStats(self):
+        # how many query texts were found already generated (hits) and how many
+        # had to be generated, shared by all the triplestore processors
+        return self.templates.getStats()
+
+    def fetchQuery(self, query: str):
+        if is_local_graph(self.getDbPathOrUrl()):
+            return LocalGraphStore.get(self.getDbPathOrUrl()).query(query)
+        return fetch_results(self.getDbPathOrUrl(), query, self.resultFormats)
+
+    def getAllCanvases(self):
+
+        df_sparql_getAllCanvases = self.runTemplate("allCanvases")
+        return df_sparql_getAllCanvases
+
+    def getAllCanvasesPages(self, pageSize:int=1000):
+        # the rows of getAllCanvases as DataFrames of about pageSize rows, one
+        # request per page. every page continues after the last canvas of the
+        # previous one (keyset pagination), so the endpoint never skips the rows
+        # of the pages before as with OFFSET. the pages skip the result cache:
+        # walking all the canvases never holds them all
+        last = ""
+        while True:
+            page = self.fetchQuery(self.templates.render("canvasesAfter", last=last) + f"LIMIT {pageSize}\n")
+            if len(page) < pageSize:
+                if not page.empty:
+                    yield page
+                break
+            canvases = page["canvas"].astype(str)
+            complete = canvases != canvases.iloc[-1]
+            if complete.any():
+                # the rows of the last canvas may go on in the next page: they
+                # are all read again there
+                page = page[complete].reset_index(drop=True)
+                last = canvases[complete].iloc[-1]
+            else:
+                # a single canvas with pageSize rows or more
+                last = canvases.iloc[-1]
+                page = self.fetchQuery(self.templates.render("canvasWithIri", canvas=last))
+            yield page
+
+    def getAllCollections(self):
+
+        df_sparql_getAllCollections = self.runTemplate("allCollections")
+        return df_sparql_getAllCollections
+
+    def getAllManifests(self):
+
+        df_sparql_getAllManifest = self.runTemplate("allManifests")
+        return df_sparql_getAllManifest
+
+    def getCanvasesInCollection(self, collectionId: str):
+
+        df_sparql_getCanvasesInCollection = self.runTemplate("canvasesInCollection", collectionId=collectionId)
+        return df_sparql_getCanvasesInCollection
+
+    def getCanvasesInManifest(self, manifestId: str):
+
+        df_sparql_getCanvasesInManifest = self.runTemplate("canvasesInManifest", manifestId=manifestId)
+        return df_sparql_getCanvasesInManifest
+
+    def getCanvasesInManifests(self, manifestIds, batchSize:int=500):
+        # getCanvasesInManifest for many manifests with one request per batchSize
+        # of them, manifestId tells to which manifest every canvas belongs
+        return self.runBatches("canvasesInManifests", "manifestIds", manifestIds, batchSize,
+                               ["manifestId", "canvas", "id", "label"])
+
+
+    def getManifestsInCollection(self, collectionId: str):
+
+        df_sparql_getManifestInCollection = self.runTemplate("manifestsInCollection", collectionId=collectionId)
+        return df_sparql_getManifestInCollection
+
+    def getManifestsInCollections(self, collectionIds, batchSize:int=500):
+        # getManifestsInCollection for many collections with one request per
+        # batchSize of them, collectionId tells to which collection every manifest belongs
+        return self.runBatches("manifestsInCollections", "collectionIds", collectionIds, batchSize,
+                               ["collectionId", "manifest", "id", "label"])
+    
+
+    def getCanvasesInManifestsOfCollection(self, collectionId: str):
+        # the canvases of all the manifests of a collection in a single request,
+        # manifestId tells to which manifest every canvas belongs
+
+        df_sparql_getCanvasesInManifestsOfCollection = self.runTemplate("canvasesInManifestsOfCollection", collectionId=collectionId)
+        return df_sparql_getCanvasesInManifestsOfCollection
+    
+
+    def getEntitiesWithLabel(self, label: str): 
+        # the labels are stored with their quotes escaped by remove_special_chars
+
+        df_sparql_getEntitiesWithLabel = self.runTemplate("entitiesWithLabel", label=remove_special_chars(label))
+        return df_sparql_getEntitiesWithLabel
+    
+
+    def getEntitiesWithCanvas(self, canvasId: str): 
 
-        df_sparql_getEntitiesWithCanvas = get(endpoint, query_entityCanvas, True)
+        df_sparql_getEntitiesWithCanvas = self.runTemplate("entitiesWithId", id=canvasId)
         return df_sparql_getEntitiesWithCanvas
     
     def getEntitiesWithId(self, id: str): 
-            
-        endpoint = self.getDbPathOrUrl()
-        query_entityId = """
-        PREFIX ns1: <https://github.com/n1kg0r/ds-project-dhdk/attributes/> 
-        PREFIX ns2: <http://purl.org/dc/elements/1.1/> 
-        PREFIX ns3: <https://github.com/n1kg0r/ds-project-dhdk/relations/> 
 
-        SELECT ?id ?label ?type
-        WHERE {
-            ?entity ns2:identifier "%s" ;
-            ns2:identifier ?id ;
-            ns1:label ?label ;
-            a ?type .
-        }
-        """ % remove_special_chars(id)
-
-        df_sparql_getEntitiesWithId = get(endpoint, query_entityId, True)
+        df_sparql_getEntitiesWithId = self.runTemplate("entitiesWithId", id=id)
         return df_sparql_getEntitiesWithId
     
 
     def getAllEntities(self): 
-            
-        endpoint = self.getDbPathOrUrl()
-        query_AllEntities = """
-        PREFIX ns1: <https://github.com/n1kg0r/ds-project-dhdk/attributes/> 
-        PREFIX ns2: <http://purl.org/dc/elements/1.1/> 
-        PREFIX ns3: <https://github.com/n1kg0r/ds-project-dhdk/relations/> 
-
-        SELECT ?entity ?id ?label ?type
-        WHERE {
-            ?entity ns2:identifier ?id ;
-                    ns2:identifier ?id ;
-                    ns1:label ?label ;
-                    a ?type .
-        }
-        """ 
 
-        df_sparql_getAllEntities = get(endpoint, query_AllEntities, True)
+        df_sparql_getAllEntities = self.runTemplate("allEntities")
         return df_sparql_getAllEntities
 
 
+    def getDescendantIds(self, entityId: str):
+        # the identifiers of everything under an entity (the manifests and canvases
+        # of a collection, the canvases of a manifest) at any depth, in one request
+
+        df_sparql_getDescendantIds = self.runTemplate("descendantIds", entityId=entityId)
+        return df_sparql_getDescendantIds
+
+    def getEntitiesWithIds(self, ids, batchSize:int=500):
+        # the rows of getAllEntities for the given identifiers only, which are
+        # bound with VALUES (batchSize of them per request)
+        return self.runBatches("entitiesWithIds", "ids", ids, batchSize,
+                               ["entity", "id", "label", "type"])
+
+
+
+
+class AsyncTriplestoreQueryProcessor(TriplestoreQueryProcessor):
+    # same queries and results of TriplestoreQueryProcessor, but sent through a
+    # pool of keep-alive connections instead of a new connection per call, plus an
+    # async version of every getter to run many of them at the same time:
+    #   canvases, manifests = await asyncio.gather(qp.getAllCanvasesAsync(), qp.getAllManifestsAsync())
+    def __init__(self, poolSize:int=10, timeout:float=60):
+        super().__init__()
+        self.poolSize = poolSize
+        self.timeout = timeout
+        self.session = None
+        self.mutex = Lock()
+
+    def getSession(self):
+        with self.mutex:
+            if self.session is None or self.session.endpoint != self.getDbPathOrUrl():
+                if self.session is not None:
+                    self.session.close()
+                self.session = SparqlSession(self.getDbPathOrUrl(), self.poolSize, self.timeout)
+            return self.session
+
+    def fetchQuery(self, query: str):
+        if is_local_graph(self.getDbPathOrUrl()):
+            return super().fetchQuery(query)
+        return self.getSession().query(query, self.resultFormats)
+
+    def close(self):
+        with self.mutex:
+            if self.session is not None:
+                self.session.close()
+                self.session = None
+
+    async def runAsync(self, method, *args):
+        # the blocking getter runs in a worker thread, the pool limits the sockets
+        return await to_thread(method, *args)
+
+    async def getAllCanvasesAsync(self):
+        return await self.runAsync(self.getAllCanvases)
+
+    async def getAllCollectionsAsync(self):
+        return await self.runAsync(self.getAllCollections)
+
+    async def getAllManifestsAsync(self):
+        return await self.runAsync(self.getAllManifests)
+
+    async def getAllEntitiesAsync(self):
+        return await self.runAsync(self.getAllEntities)
+
+    async def getCanvasesInCollectionAsync(self, collectionId: str):
+        return await self.runAsync(self.getCanvasesInCollection, collectionId)
+
+    async def getCanvasesInManifestAsync(self, manifestId: str):
+        return await self.runAsync(self.getCanvasesInManifest, manifestId)
+
+    async def getManifestsInCollectionAsync(self, collectionId: str):
+        return await self.runAsync(self.getManifestsInCollection, collectionId)
+
+    async def getManifestsInCollectionsAsync(self, collectionIds, batchSize:int=500):
+        return await self.runAsync(self.getManifestsInCollections, collectionIds, batchSize)
 
+    async def getCanvasesInManifestsOfCollectionAsync(self, collectionId: str):
+        return await self.runAsync(self.getCanvasesInManifestsOfCollection, collectionId)
 
-class RelationalQueryProcessor(Processor):          
+    async def getEntitiesWithLabelAsync(self, label: str):
+        return await self.runAsync(self.getEntitiesWithLabel, label)
+
+    async def getEntitiesWithCanvasAsync(self, canvasId: str):
+        return await self.runAsync(self.getEntitiesWithCanvas, canvasId)
+
+    async def getEntitiesWithIdAsync(self, id: str):
+        return await self.runAsync(self.getEntitiesWithId, id)
+
+    async def getDescendantIdsAsync(self, entityId: str):
+        return await self.runAsync(self.getDescendantIds, entityId)
+
+    async def getEntitiesWithIdsAsync(self, ids, batchSize:int=500):
+        return await self.runAsync(self.getEntitiesWithIds, ids, batchSize)
+
+    async def getCanvasesInManifestsAsync(self, manifestIds, batchSize:int=500):
+        return await self.runAsync(self.getCanvasesInManifests, manifestIds, batchSize)
+
+
+
+
+class RelationalQueryProcessor(QueryProcessor):
+    # every query has a fixed text with "?" placeholders and the values are bound
+    # when it is run: sqlite finds the compiled statement in the connection cache
+    # instead of parsing a new string at every call, and quotes in the ids are safe
+    statements = {
+        "allAnnotations": "SELECT * FROM Annotation;",
+        "allImages": "SELECT * FROM Image;",
+        "annotationsWithBody": "SELECT * FROM Annotation WHERE body = ?",
+        "annotationsWithBodyAndTarget": "SELECT * FROM Annotation WHERE body = ? AND target = ?",
+        "annotationsWithTarget": "SELECT * FROM Annotation WHERE target = ?",
+        "entitiesWithCreator": "SELECT Entity.entityid, Entity.id, Creators.creator, Entity.title FROM Entity LEFT JOIN Creators ON Entity.entityId == Creators.entityId WHERE creator = ?",
+        "entitiesWithTitle": "SELECT Entity.entityid, Entity.id, Creators.creator, Entity.title FROM Entity LEFT JOIN Creators ON Entity.entityId == Creators.entityId WHERE title = ?",
+        "entities": "SELECT Entity.entityid, Entity.id, Creators.creator, Entity.title FROM Entity LEFT JOIN Creators ON Entity.entityId == Creators.entityId"
+    }
+    def __init__(self, cachedStatements:int=128):
+        super().__init__()
+        self.pool = None
+        self.cachedStatements = cachedStatements
+        self.poolMutex = Lock()
+    def getConnection(self):
+        # the processor owns a pool with one persistent connection per thread,
+        # it is recreated if the database path changes. the mediator calls the
+        # processor from several threads, so only one of them creates the pool
+        with self.poolMutex:
+            if self.pool is None or self.pool.path != self.getDbPathOrUrl():
+                if self.pool is not None:
+                    self.pool.close()
+                self.pool = ConnectionPool(self.getDbPathOrUrl(), cachedStatements=self.cachedStatements)
+            pool = self.pool
+        return pool.getConnection()
+    def close(self):
+        with self.poolMutex:
+            if self.pool is not None:
+                self.pool.close()
+                self.pool = None
+    def runStatement(self, name:str, params:tuple=()):
+        return self.cachedResult(("sql", name, tuple(params)),
+                                 lambda: read_sql(self.statements[name], self.getConnection(), params=params))
     def getAllAnnotations(self):
-        with connect(self.getDbPathOrUrl()) as con:
-            q1="SELECT * FROM Annotation;" 
-            q1_table = read_sql(q1, con)
-            return q1_table 
-              
+        return self.runStatement("allAnnotations")
     def getAllImages(self):
-        with connect(self.getDbPathOrUrl()) as con:
-          q2="SELECT * FROM Image;" 
-          q2_table = read_sql(q2, con)
-          return q2_table       
+        return self.runStatement("allImages")
+    def getAllAnnotationsPages(self, pageSize:int=1000):
+        # the rows of getAllAnnotations as DataFrames of pageSize rows at most.
+        # every page continues from the last rowid of the previous one (keyset
+        # pagination), so a page costs the same at the start and at the end of the
+        # table, and no read transaction stays open between two pages
+        query = "SELECT rowid AS page_key, * FROM Annotation WHERE rowid > ? ORDER BY rowid LIMIT ?"
+        last = -1
+        while True:
+            page = read_sql(query, self.getConnection(), params=(last, pageSize))
+            if page.empty:
+                break
+            last = int(page["page_key"].iloc[-1])
+            yield page.drop(columns="page_key")
+            if len(page) < pageSize:
+                break
     def getAnnotationsWithBody(self, bodyId:str):
-        with connect(self.getDbPathOrUrl())as con:
-            q3 = f"SELECT* FROM Annotation WHERE body = '{bodyId}'"
-            q3_table = read_sql(q3, con)
-            return q3_table         
+        return self.runStatement("annotationsWithBody", (bodyId,))
     def getAnnotationsWithBodyAndTarget(self, bodyId:str,targetId:str):
-        with connect(self.getDbPathOrUrl())as con:
-            q4 = f"SELECT* FROM Annotation WHERE body = '{bodyId}' AND target = '{targetId}'"
-            q4_table = read_sql (q4, con)
-            return q4_table         
+        return self.runStatement("annotationsWithBodyAndTarget", (bodyId, targetId))
     def getAnnotationsWithTarget(self, targetId:str):#I've decided not to catch the empty string since in this case a Dataframe is returned, witch is okay
-        with connect(self.getDbPathOrUrl())as con:
-            q5 = f"SELECT* FROM Annotation WHERE target = '{targetId}'"
-            q5_table = read_sql(q5, con)
-            return q5_table  
+        return self.runStatement("annotationsWithTarget", (targetId,))
     def getEntitiesWithCreator(self, creatorName):
-        with connect(self.getDbPathOrUrl())as con:
-             q6 = "SELECT Entity.entityid, Entity.id, Creators.creator, Entity.title FROM Entity LEFT JOIN Creators ON Entity.entityId == Creators.entityId WHERE creator = '" + creatorName +"'"
-             result = read_sql(q6, con)
-             return result
+        return self.runStatement("entitiesWithCreator", (creatorName,))
     def getEntitiesWithTitle(self,title):
-        with connect(self.getDbPathOrUrl())as con:
-             q6 = "SELECT Entity.entityid, Entity.id, Creators.creator, Entity.title FROM Entity LEFT JOIN Creators ON Entity.entityId == Creators.entityId WHERE title = '" + title +"'"
-             result = read_sql(q6, con)  
-             return result
+        return self.runStatement("entitiesWithTitle", (title,))
     def getEntities(self):
-        with connect(self.getDbPathOrUrl())as con:
-             q7 = "SELECT Entity.entityid, Entity.id, Creators.creator, Entity.title FROM Entity LEFT JOIN Creators ON Entity.entityId == Creators.entityId"
-             result = read_sql(q7, con) 
-             return result 
+        return self.runStatement("entities")
+    def selectWithIds(self, select:str, column:str, ids):
+        # the rows of select whose column is one of ids: short lists are bound in
+        # an IN (...), long ones go through a temporary table, and in both cases
+        # the index on column is probed once per id
+        ids = list(dict.fromkeys(ids))
+        if len(ids) <= 100:
+            marks = ", ".join("?" for _ in ids)
+            return read_sql(select + f" WHERE {column} IN ({marks})", self.getConnection(), params=tuple(ids))
+        con = self.getConnection()
+        with con:
+            con.execute("CREATE TEMP TABLE IF NOT EXISTS lookup_ids (id TEXT PRIMARY KEY)")
+            con.execute("DELETE FROM lookup_ids")
+            con.executemany("INSERT OR IGNORE INTO lookup_ids VALUES (?)", ((i,) for i in ids))
+            return read_sql(select + f" WHERE {column} IN (SELECT id FROM lookup_ids)", con)
+    def getEntitiesWithIds(self, ids):
+        # the same rows of getEntities, but only for the given external ids
+        return self.selectWithIds(self.statements["entities"], "Entity.id", ids)
+    def getAnnotationsWithTargets(self, targetIds):
+        # the annotations of all the given targets in one query
+        return self.selectWithIds("SELECT * FROM Annotation", "target", targetIds)
         
 
 
-class AnnotationProcessor(Processor):
-    def __init__(self):
+class RelationalProcessor(Processor):
+    # base of the processors that load csv files into sqlite: the subclasses say
+    # how the csv is read (csvTypes) and which tables come out of it: their
+    # prepareTables(data, numbers) returns {table name: DataFrame} for the rows of
+    # data, numbers being the numbers of their internal ids.
+    # to_sql(if_exists="replace") drops the tables together with their indexes,
+    # so they are built again after every upload, unless deferIndexes is set:
+    # then a bulk load of several files can call createIndexes() only once at the end
+    indexes = []
+    csvTypes = {}
+    # (table, column, prefix) of the internal id given to every row of the csv, and
+    # the column holding that internal id in every table written by prepareTables
+    internalKey = None
+    tableKeys = {}
+    def __init__(self, deferIndexes:bool=False, chunkSize:int=None, progress=None,
+                 loadMode:str="replace", deleteMissing:bool=False):
+        super().__init__()
+        self.deferIndexes = deferIndexes
+        # with a chunkSize the csv is read and written chunkSize rows at a time,
+        # every chunk in its own transaction, so the memory used does not grow with
+        # the file. progress, if given, is called after every chunk as
+        # progress(chunk number, rows in the chunk, rows written so far)
+        self.chunkSize = chunkSize
+        self.progress = progress
+        # loadMode "replace" rewrites the tables, "upsert" adds the new rows of the
+        # csv (by their external id) and updates the changed ones, keeping the rest
+        # of the tables as they are. with deleteMissing the rows whose id is not
+        # in the csv are deleted too
+        self.loadMode = loadMode
+        self.deleteMissing = deleteMissing
+        # path of the identity index refreshed after every upload (None = no index).
+        # it is off by default: see IdentityIndex, an index is only right for the
+        # databases that are written through the processors it is given to
+        self.identityIndex = None
+    def createIndexes(self, con=None):
+        if con is None:
+            # "with" on a connection only commits, it is closed here
+            con = connect(self.getDbPathOrUrl())
+            try:
+                with con:
+                    return self.createIndexes(con)
+            finally:
+                con.close()
+        for name, table, columns in self.indexes:
+            con.execute(f"CREATE INDEX IF NOT EXISTS {name} ON {table} ({', '.join(columns)})")
+        return True
+    def afterUpload(self, con):
+        if not self.deferIndexes:
+            self.createIndexes(con)
+    def saveLastNumber(self, con, last:int):
+        # the highest number of the internal ids given so far is kept in the
+        # database, so an upsert does not read all the ids to find it
+        con.execute("CREATE TABLE IF NOT EXISTS IdCounter (name TEXT PRIMARY KEY, last INTEGER)")
+        con.execute("INSERT OR REPLACE INTO IdCounter VALUES (?, ?)", (self.internalKey[0], last))
+    def lastNumber(self, con):
+        main_table, main_key, prefix = self.internalKey
+        if con.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='IdCounter'").fetchone():
+            row = con.execute("SELECT last FROM IdCounter WHERE name = ?", (main_table,)).fetchone()
+            if row is not None:
+                return row[0]
+        # a database written before the counter existed: the ids are read once
+        return con.execute(f"SELECT MAX(CAST(SUBSTR({main_key}, ?) AS INTEGER)) FROM {main_table}",
+                           (len(prefix) + 1,)).fetchone()[0]
+    def refreshIdentityIndex(self, index:IdentityIndex, ids=None):
+        # the subclasses copy the rows of their tables into the identity index:
+        # all of them, or only the ones of ids (the external ids an upsert touched)
         pass
-    def uploadData(self, path:str): 
+    @staticmethod
+    def internalIds(prefix:str, numbers):
+        # prefix-n for every n in numbers, built in one operation on the whole column
+        return prefix + Series(numbers).astype("string")
+    def readCsv(self, path:str, chunkSize:int=None):
+        return read_csv(path, keep_default_na=False, dtype=self.csvTypes, chunksize=chunkSize)
+    def uploadData(self, path:str, offset:int=0):
+        # offset is the number of the first internal id, so that the ids of
+        # different loads do not overlap
         try:
-            annotations = read_csv(path, 
-                                    keep_default_na=False,
-                                    dtype={
-                                        "id": "string",
-                                        "body": "string",
-                                        "target": "string",
-                                        "motivation": "string"
-                                    })
-            annotations_internalId = []
-            for idx, row in annotations.iterrows():
-                annotations_internalId.append("annotation-" +str(idx))
-            annotations.insert(0, "annotationId", Series(annotations_internalId, dtype = "string"))
-            
-            image = annotations[["body"]]
-            image = image.rename(columns={"body": "id"})
-            image_internalId = []
-            for idx, row in image.iterrows():
-                image_internalId.append("image-" +str(idx))
-            image.insert(0, "imageId", Series(image_internalId, dtype = "string"))
-
-            with connect(self.getDbPathOrUrl()) as con:
-                annotations.to_sql("Annotation", con, if_exists="replace", index=False)
-                image.to_sql("Image", con, if_exists="replace", index=False)
-
+            touched = None
+            if self.loadMode == "upsert":
+                touched = self.upsertData(path)
+            elif self.chunkSize:
+                self.uploadChunks(path, offset)
+            else:
+                data = self.readCsv(path)
+                tables = self.prepareTables(data, range(offset, offset + len(data)))
+                with connect(self.getDbPathOrUrl()) as con:
+                    for name, table in tables.items():
+                        table.to_sql(name, con, if_exists="replace", index=False)
+                    self.saveLastNumber(con, offset + len(data) - 1)
+                    self.afterUpload(con)
+                con.close()
+            self.updateIdentityIndex(touched)
             return True
-        
         except Exception as e:
             print(str(e))
             return False
-
-class MetadataProcessor(Processor):
-    def __init__(self):
-        pass
-    def uploadData(self, path:str):
-        try: 
-            entityWithMetadata= read_csv(path, 
-                                    keep_default_na=False,
-                                    dtype={
-                                        "id": "string",
-                                        "title": "string",
-                                        "creator": "string"
-                                    })
-            
-            metadata_internalId = []
-            for idx, row in entityWithMetadata.iterrows():
-                metadata_internalId.append("entity-" +str(idx))
-            entityWithMetadata.insert(0, "entityId", Series(metadata_internalId, dtype = "string"))
-            creator = entityWithMetadata[["entityId", "creator"]]
-            #I recreate entityMetadata since, as I will create a proxy table, I will have no need of
-            #coloumn creator
-            entityWithMetadata = entityWithMetadata[["entityId", "id", "title"]]
-            
-
-            for idx, row in creator.iterrows():
-                        for item_idx, item in row.iteritems():
-                            if "entity-" in item:
-                                entity_id = item
-                            if ";" in item:
-                                list_of_creators =  item.split(";")
-                                creator = creator.drop(idx)
-                                new_serie = []
-                                for i in range (len(list_of_creators)):
-                                    new_serie.append(entity_id)
-                                new_data = DataFrame({"entityId": new_serie, "creator": list_of_creators})
-                                creator = concat([creator.loc[:idx-1], new_data, creator.loc[idx:]], ignore_index=True)
-
-            with connect(self.getDbPathOrUrl()) as con:
-                entityWithMetadata.to_sql("Entity", con, if_exists="replace", index = False)
-                creator.to_sql("Creators", con, if_exists="replace", index = False)
-            return True
+        finally:
+            self.invalidateResults()
+    def updateIdentityIndex(self, ids=None):
+        # the tables are already written: an error of the index does not make the
+        # upload fail, the part is taken out of the index so that no query uses it
+        if not self.identityIndex:
+            return
+        index = None
+        try:
+            index = IdentityIndex(self.identityIndex)
+            self.refreshIdentityIndex(index, ids)
         except Exception as e:
-                print(str(e))
-                return False
+            print(f"identity index not updated: {e}")
+            if index is not None:
+                try:
+                    index.forget(self.getDbPathOrUrl(), [self.indexPart])
+                except Exception as e:
+                    print(e)
+        finally:
+            if index is not None:
+                index.close()
+    def uploadChunks(self, path:str, offset:int=0):
+        con = connect(self.getDbPathOrUrl())
+        try:
+            written = 0
+            for number, chunk in enumerate(self.readCsv(path, self.chunkSize), 1):
+                first = offset + written
+                tables = self.prepareTables(chunk.reset_index(drop=True), range(first, first + len(chunk)))
+                with con:
+                    for name, table in tables.items():
+                        if number == 1:
+                            # an empty to_sql replaces the old table with the same schema
+                            table.head(0).to_sql(name, con, if_exists="replace", index=False)
+                        columns = ", ".join(f'"{column}"' for column in table.columns)
+                        marks = ", ".join("?" for _ in table.columns)
+                        con.executemany(f"INSERT INTO {name} ({columns}) VALUES ({marks})",
+                                        table.itertuples(index=False, name=None))
+                written += len(chunk)
+                if self.progress:
+                    self.progress(number, len(chunk), written)
+            with con:
+                self.saveLastNumber(con, offset + written - 1)
+                self.afterUpload(con)
+        finally:
+            con.close()
+
+
+    def upsertData(self, path:str):
+        # returns the external ids of the rows added, changed or deleted, or None
+        # if the tables were written from scratch
+        main_table, main_key, prefix = self.internalKey
+        con = connect(self.getDbPathOrUrl())
+        try:
+            data = self.readCsv(path)
+            if not con.execute("SELECT name FROM sqlite_master WHERE type='table' AND name=?", (main_table,)).fetchone():
+                # nothing to update yet: a normal upload
+                tables = self.prepareTables(data, range(len(data)))
+                with con:
+                    for name, table in tables.items():
+                        table.to_sql(name, con, if_exists="replace", index=False)
+                    self.saveLastNumber(con, len(data) - 1)
+                    self.afterUpload(con)
+                return None
+
+            with con:
+                # the rows already in the database keep their internal id, the new ones
+                # continue after the highest one. only the ids of the csv are looked up
+                con.execute("CREATE TEMP TABLE upsert_ids (id TEXT)")
+                con.executemany("INSERT INTO upsert_ids VALUES (?)", ((i,) for i in data["id"]))
+                known = dict(con.execute(
+                    f"SELECT m.id, CAST(SUBSTR(m.{main_key}, ?) AS INTEGER) FROM {main_table} m JOIN upsert_ids u ON m.id = u.id",
+                    (len(prefix) + 1,)).fetchall())
+                last = self.lastNumber(con)
+                next_number = -1 if last is None else last
+                numbers = []
+                for external_id in data["id"]:
+                    number = known.get(external_id)
+                    if number is None:
+                        next_number += 1
+                        number = next_number
+                        known[external_id] = number
+                    numbers.append(number)
+                tables = self.prepareTables(data, numbers)
+                # the rows of the identity index come from the tables keyed by the
+                # internal id of the main table: their changed keys give the touched ids
+                external_ids = dict(zip(tables[main_table][main_key], tables[main_table]["id"]))
+                touched = set()
+
+                for name, table in tables.items():
+                    key = self.tableKeys[name]
+                    columns = ", ".join(f'"{column}"' for column in table.columns)
+                    marks = ", ".join("?" for _ in table.columns)
+                    con.execute(f"CREATE TEMP TABLE staged ({columns})")
+                    con.executemany(f"INSERT INTO staged ({columns}) VALUES ({marks})",
+                                    table.itertuples(index=False, name=None))
+                    con.execute(f"CREATE INDEX temp.staged_key ON staged ({key})")
+                    # a key is changed if its rows differ in any column (new keys
+                    # have no rows in the table, so they are changed too)
+                    con.execute(f"""
+                        CREATE TEMP TABLE changed AS
+                        SELECT {key} FROM (SELECT {columns} FROM staged
+                                           EXCEPT SELECT {columns} FROM {name} WHERE {key} IN (SELECT {key} FROM staged))
+                        UNION
+                        SELECT {key} FROM (SELECT {columns} FROM {name} WHERE {key} IN (SELECT {key} FROM staged)
+                                           EXCEPT SELECT {columns} FROM staged)""")
+                    if key == main_key:
+                        touched.update(external_ids[changed] for changed, in con.execute(f"SELECT {key} FROM changed"))
+                    con.execute(f"DELETE FROM {name} WHERE {key} IN (SELECT {key} FROM changed)")
+                    con.execute(f"INSERT INTO {name} ({columns}) SELECT {columns} FROM staged WHERE {key} IN (SELECT {key} FROM changed)")
+                    if self.deleteMissing:
+                        if name == main_table:
+                            touched.update(deleted for deleted, in con.execute(
+                                f"SELECT id FROM {name} WHERE {key} NOT IN (SELECT {key} FROM staged)"))
+                        con.execute(f"DELETE FROM {name} WHERE {key} NOT IN (SELECT {key} FROM staged)")
+                    con.execute("DROP TABLE changed")
+                    con.execute("DROP TABLE staged")
+                con.execute("DROP TABLE upsert_ids")
+                self.saveLastNumber(con, next_number)
+                self.afterUpload(con)
+            return touched
+        finally:
+            con.close()
+
+
+class AnnotationProcessor(RelationalProcessor):
+    indexes = [
+        ("idx_annotation_target", "Annotation", ["target"]),
+        # also used by the lookups on body and target together
+        ("idx_annotation_body_target", "Annotation", ["body", "target"]),
+        ("idx_annotation_id", "Annotation", ["id"]),
+        ("idx_annotation_annotationId", "Annotation", ["annotationId"]),
+        ("idx_image_id", "Image", ["id"]),
+        ("idx_image_imageId", "Image", ["imageId"])
+    ]
+    internalKey = ("Annotation", "annotationId", "annotation-")
+    indexPart = "annotations"
+    tableKeys = {"Annotation": "annotationId", "Image": "imageId"}
+    csvTypes = {
+        "id": "string",
+        "body": "string",
+        "target": "string",
+        "motivation": "string"
+    }
+    def prepareTables(self, annotations:DataFrame, numbers):
+        annotations.insert(0, "annotationId", self.internalIds("annotation-", numbers))
+        
+        image = annotations[["body"]]
+        image = image.rename(columns={"body": "id"})
+        image.insert(0, "imageId", self.internalIds("image-", numbers))
+
+        return {"Annotation": annotations, "Image": image}
+    def refreshIdentityIndex(self, index:IdentityIndex, ids=None):
+        index.refreshAnnotations(self.getDbPathOrUrl(), ids)
+
+class MetadataProcessor(RelationalProcessor):
+    indexes = [
+        ("idx_entity_id", "Entity", ["id"]),
+        ("idx_entity_title", "Entity", ["title"]),
+        ("idx_entity_entityId", "Entity", ["entityId"]),
+        # covering indexes: the Entity LEFT JOIN Creators ON entityId join and the
+        # lookups by creator are answered from the index without reading Creators
+        ("idx_creators_entityId_creator", "Creators", ["entityId", "creator"]),
+        ("idx_creators_creator_entityId", "Creators", ["creator", "entityId"])
+    ]
+    internalKey = ("Entity", "entityId", "entity-")
+    indexPart = "metadata"
+    tableKeys = {"Entity": "entityId", "Creators": "entityId"}
+    csvTypes = {
+        "id": "string",
+        "title": "string",
+        "creator": "string"
+    }
+    @staticmethod
+    def splitCreators(creator:DataFrame):
+        # from (entityId, "creator 1; creator 2") rows to one (entityId, creator) row
+        # per creator, in a single pass over the column instead of a loop on the rows.
+        # entities without creators keep one row with an empty creator
+        creator = creator.assign(creator=creator["creator"].str.split(";"))
+        creator = creator.explode("creator", ignore_index=True)
+        creator["creator"] = creator["creator"].str.strip().astype("string")
+        return creator
+    def prepareTables(self, entityWithMetadata:DataFrame, numbers):
+        entityWithMetadata.insert(0, "entityId", self.internalIds("entity-", numbers))
+        creator = self.splitCreators(entityWithMetadata[["entityId", "creator"]])
+        #I recreate entityMetadata since, as I will create a proxy table, I will have no need of
+        #coloumn creator
+        entityWithMetadata = entityWithMetadata[["entityId", "id", "title"]]
+
+        return {"Entity": entityWithMetadata, "Creators": creator}
+    def refreshIdentityIndex(self, index:IdentityIndex, ids=None):
+        index.refreshMetadata(self.getDbPathOrUrl(), ids)
 
 
 
 class CollectionProcessor(Processor):
+    localGraph = True
 
-    def __init__(self):
+    def __init__(self, batchSize:int=10000, uploadMode:str="update", streaming:bool=False):
         super().__init__()
+        # triples are sent in batches of batchSize (0 = everything in one request),
+        # uploadMode is "update" (SPARQL INSERT DATA) or "post" (N-Triples POST)
+        self.batchSize = batchSize
+        self.uploadMode = uploadMode
+        # with streaming the json file is never loaded as a whole: the triples are
+        # created while parsing and sent batch by batch (use it with a batchSize > 0)
+        self.streaming = streaming
+        # folder of the counter files used for the internal ids
+        self.countersDir = COUNTERS_DIR
+        self.uploadReport = []
+        # path of the identity index the uploaded entities are added to (None = no
+        # index, the default: see RelationalProcessor)
+        self.identityIndex = None
 
     def uploadData(self, path: str):
 
+        entities = None
         try: 
 
             base_url = "https://github.com/n1kg0r/ds-project-dhdk/"
+            endpoint = self.getDbPathOrUrl()
+
+            # the entities of the upload are written into the identity index
+            # batch by batch, while the triples are sent
+            entities = self.stageEntities()
+
+            # one allocator for the whole upload: the internal ids are reserved in
+            # blocks and the counters are saved when it is closed
+            if self.streaming:
+                with open(path, mode='rb') as jsonfile, IdAllocator(self.countersDir) as allocator:
+                    triples = stream_Graph(jsonfile, base_url, allocator)
+                    if entities is not None:
+                        triples = entities.watch(triples)
+                    self.uploadReport = upload_Graph(triples, endpoint, self.batchSize, self.uploadMode)
+                self.addToIdentityIndex(entities)
+                return True
+
             my_graph = Graph()
             
 
@@ -503,24 +1083,22 @@ class CollectionProcessor(Processor):
                 json_object = load(jsonfile)
             
             #CREATE GRAPH
-            if type(json_object) is list: #CONTROLLARE!!!
-                for collection in json_object:
-                    create_Graph(collection, base_url, my_graph)
-            
-            else:
-                create_Graph(json_object, base_url, my_graph)
+            with IdAllocator(self.countersDir) as allocator:
+                if type(json_object) is list: #CONTROLLARE!!!
+                    for collection in json_object:
+                        create_Graph(collection, base_url, my_graph, allocator)
+                
+                else:
+                    create_Graph(json_object, base_url, my_graph, allocator)
             
                     
             #DB UPTDATE
-            store = SPARQLUpdateStore()
-
-            endpoint = self.getDbPathOrUrl()
+            self.uploadReport = upload_Graph(my_graph, endpoint, self.batchSize, self.uploadMode)
 
-            store.open((endpoint, endpoint))
-
-            for triple in my_graph.triples((None, None, None)):
-                store.add(triple)
-            store.close()
+            if entities is not None:
+                for triple in my_graph:
+                    entities.add(triple)
+            self.addToIdentityIndex(entities)
 
             with open('grafo.ttl', mode='a', encoding='utf-8') as f:
                 f.write(my_graph.serialize(format='turtle'))
@@ -530,39 +1108,173 @@ class CollectionProcessor(Processor):
         except Exception as e:
             print(str(e))
             return False
+
+        finally:
+            if entities is not None:
+                entities.index.close()
+            self.invalidateResults()
         
 
 
+    def stageEntities(self):
+        # the entities of an upload staged in the identity index (None = no index)
+        if not self.identityIndex:
+            return None
+        index = None
+        try:
+            index = IdentityIndex(self.identityIndex)
+            return index.stageGraph(self.batchSize)
+        except Exception as e:
+            print(f"identity index not updated: {e}")
+            if index is not None:
+                index.close()
+            return None
+
+    def addToIdentityIndex(self, entities:GraphEntities):
+        # the triples are already uploaded: an error of the index does not make the
+        # upload fail, the graph is taken out of the index so that no query uses it
+        if entities is None:
+            return
+        try:
+            entities.index.addGraph(self.getDbPathOrUrl(), entities)
+        except Exception as e:
+            print(f"identity index not updated: {e}")
+            try:
+                entities.index.forget(self.getDbPathOrUrl(), ["graph"])
+            except Exception as e:
+                print(e)
+
+
+
 # NOTE: BLOCK GENERIC PROCESSOR
 
 class GenericQueryProcessor():
-    def __init__(self):
+    def __init__(self, timeout:float=None, partialResults:bool=True, maxWorkers:int=8,
+                 identityIndex:str=None):
         self.queryProcessors = []
+        # the sub-queries sent to the processors run together on a thread pool.
+        # timeout (seconds) is the default wait for every processor, it can be
+        # changed for a single processor in addQueryProcessor. with partialResults
+        # a processor that fails or is too slow is left out of the result,
+        # otherwise its exception is raised
+        self.timeout = timeout
+        self.timeouts = dict()
+        self.partialResults = partialResults
+        self.executor = ThreadPoolExecutor(max_workers=maxWorkers)
+        # the lookups by id, label, title and creator are answered by the identity
+        # index written by the upload processors, when it has the rows of all the
+        # databases of the query processors (None, the default = always query the databases)
+        self.identityIndex = identityIndex
+        self.index = None
     def cleanQueryProcessors(self):
         self.queryProcessors = []
+        self.timeouts = dict()
         return True
-    def addQueryProcessor(self, processor: QueryProcessor):
+    def addQueryProcessor(self, processor: QueryProcessor, timeout:float=None):
         try:
             self.queryProcessors.append(processor)
+            if timeout is not None:
+                self.timeouts[id(processor)] = timeout
             return True 
         except Exception as e:
             print(e)
             return False
+
+    def fanOut(self, calls):
+        # calls is a list of (processor, function without arguments): they are all
+        # started at once, so the slowest backend sets the latency instead of the
+        # sum of them. the results come back in the same order, None for the
+        # calls that failed or timed out (a timed out call is not stopped, its
+        # result is just not waited for)
+        start = monotonic()
+        futures = [(processor, self.executor.submit(function)) for processor, function in calls]
+        results = []
+        for processor, future in futures:
+            timeout = self.timeouts.get(id(processor), self.timeout)
+            remaining = None if timeout is None else max(0, start + timeout - monotonic())
+            try:
+                results.append(future.result(timeout=remaining))
+            except Exception as e:
+                if not self.partialResults:
+                    raise
+                print(f"{type(processor).__name__}: {e!r}")
+                results.append(None)
+        return results
+
+    @staticmethod
+    def buildObjects(df, factory, *columns):
+        # the domain objects of a result: factory is called once per row with the
+        # values of columns, read from whole column lists instead of building a
+        # Series for every row as iterrows does. a column that the result does not
+        # have gives empty strings
+        if df is None or df.empty:
+            return []
+        arrays = [df[column].tolist() if column in df.columns else [""] * len(df) for column in columns]
+        return list(map(factory, *arrays))
+
+    def getIndexedDatabases(self, parts=("metadata",)):
+        # (identity index, graph databases, relational databases) if the index can
+        # answer for all the databases of the processors, otherwise None: the graph
+        # of every graph database and the parts ("metadata", "annotations") the
+        # query reads of every relational database must be in the index
+        if not self.identityIndex:
+            return None
+        graph_dbs = [p.getDbPathOrUrl() for p in self.queryProcessors if isinstance(p, TriplestoreQueryProcessor)]
+        relational_dbs = [p.getDbPathOrUrl() for p in self.queryProcessors if isinstance(p, RelationalQueryProcessor)]
+        if not graph_dbs or (parts and not relational_dbs):
+            return None
+        try:
+            if self.index is None or self.index.path != self.identityIndex:
+                self.index = IdentityIndex(self.identityIndex)
+            needed = [(db, "graph") for db in graph_dbs] + [(db, part) for db in relational_dbs for part in parts]
+            if not self.index.isIndexed(needed):
+                return None
+        except Exception as e:
+            print(e)
+            return None
+        return self.index, graph_dbs, relational_dbs
+
+    def callAll(self, method:str, *args):
+        # the same method on every processor that has it
+        calls = [(processor, lambda processor=processor: getattr(processor, method)(*args))
+                 for processor in self.queryProcessors if hasattr(processor, method)]
+        return [result for result in self.fanOut(calls) if result is not None]
         
+    # push-down of the ids between the two databases: the rows found in one of
+    # them are completed with a lookup of only their ids in the other one, instead
+    # of joining them with the whole content of the other database
+    def getRelationalEntitiesWithIds(self, ids):
+        ids = list(ids)
+        frames = self.fanOut([(processor, lambda processor=processor: processor.getEntitiesWithIds(ids))
+                              for processor in self.queryProcessors
+                              if isinstance(processor, RelationalQueryProcessor)])
+        frames = [frame for frame in frames if frame is not None]
+        if not frames:
+            return DataFrame(columns=["entityId", "id", "creator", "title"])
+        return concat(frames, ignore_index=True)
+
+    def getGraphEntitiesWithIds(self, ids):
+        ids = list(ids)
+        frames = self.fanOut([(processor, lambda processor=processor: processor.getEntitiesWithIds(ids))
+                              for processor in self.queryProcessors
+                              if isinstance(processor, TriplestoreQueryProcessor)])
+        frames = [frame for frame in frames if frame is not None]
+        if not frames:
+            return DataFrame(columns=["entity", "id", "label", "type"])
+        return concat(frames, ignore_index=True)
+
     def getAllAnnotations(self):
         result = []
-        for processor in self.queryProcessors:
+        for df in self.callAll("getAllAnnotations"):
             try:
-                df = processor.getAllAnnotations()
-                df = df.reset_index() 
-
-                annotations_list = [
-                    Annotation(row['id'], 
-                               row['motivation'], 
-                               IdentifiableEntity(row['target']), 
-                               Image(row['body'])
-                               ) for _, row in df.iterrows()
-                ]
+                targets = dict()
+                bodies = dict()
+                annotations_list = self.buildObjects(
+                    df,
+                    lambda id, motivation, target, body: Annotation(id, motivation,
+                                                                    IdentifiableEntity.intern(target, targets),
+                                                                    Image.intern(body, bodies)),
+                    "id", "motivation", "target", "body")
                 result += annotations_list
             except Exception as e:
                 print(e)
@@ -571,41 +1283,72 @@ class GenericQueryProcessor():
     
     def getAllCanvas(self):
         result = []
-        for processor in self.queryProcessors:
+        for df in self.callAll("getAllCanvases"):
             try:
-                df = processor.getAllCanvases()
-                df = df.reset_index() 
-                
-                canvases_list = [
-                    Canvas(row['id'],
-                               row['label'], 
-                               row['title'],
-                               []
-                               ) for _, row in df.iterrows()
-                ] 
+                canvases_list = self.buildObjects(
+                    df,
+                    lambda id, label, title: Canvas(id, label, title, []),
+                    "id", "label", "title")
                 result += canvases_list
             except Exception as e:
                 print(e)
         return result
     
 
-    def getAllCollections(self):
-        result = []
+    def iterPages(self, method:str, pageSize:int):
+        # the pages of every query processor having method, one after the other.
+        # with partialResults a processor that fails before its first page is left
+        # out, as in the other queries. an error after some pages is always raised:
+        # the walk would otherwise look complete when it was cut short
         for processor in self.queryProcessors:
+            if hasattr(processor, method):
+                pages = 0
+                try:
+                    for page in getattr(processor, method)(pageSize):
+                        pages += 1
+                        yield page
+                except Exception as e:
+                    if pages or not self.partialResults:
+                        raise
+                    print(e)
+
+    def iterAllAnnotations(self, pageSize:int=1000):
+        # the objects of getAllAnnotations, built and yielded one page at a time:
+        # the memory used depends on pageSize only, and the first annotations are
+        # available after the first page instead of the whole table
+        for df in self.iterPages("getAllAnnotationsPages", pageSize):
+            targets = dict()
+            bodies = dict()
+            yield from self.buildObjects(
+                df,
+                lambda id, motivation, target, body: Annotation(id, motivation,
+                                                                IdentifiableEntity.intern(target, targets),
+                                                                Image.intern(body, bodies)),
+                "id", "motivation", "target", "body")
+
+    def iterAllCanvas(self, pageSize:int=1000):
+        # the objects of getAllCanvas, one page at a time
+        for df in self.iterPages("getAllCanvasesPages", pageSize):
+            yield from self.buildObjects(
+                df,
+                lambda id, label, title: Canvas(id, label, title, []),
+                "id", "label", "title")
+
+    def getAllCollections(self, prefetch:bool=False):
+        # the manifests of the collections are loaded by the first getItems() of
+        # any of them, for all the collections of the result together (see
+        # getManifestsInCollections). with prefetch the whole hierarchy (manifests
+        # and canvases) is loaded now
+        result = []
+        for df in self.callAll("getAllCollections"):
             try:
-                df = processor.getAllCollections()
-                df = df.reset_index() 
-                
-                collections_list = [
-                    Collection(row['id'],
-                               row['label'],
-                               row['collection'],
-                               [],
-                               [
-                                   Manifest('','','',[],Canvas('','','',''))
-                                ]
-                                ) for _, row in df.iterrows()
-                ] 
+                batch = ItemsBatch(lambda ids=df["id"].tolist(): self.getManifestsInCollections(ids, prefetch))
+                collections_list = self.buildObjects(
+                    df,
+                    lambda id, label, collection: Collection(id, label, collection, [], LazyItems(id, batch)),
+                    "id", "label", "collection")
+                if prefetch:
+                    batch.loadAll()
                 result += collections_list
             except Exception as e:
                 print(e)
@@ -624,24 +1367,48 @@ class GenericQueryProcessor():
                 processor.getAllManifests()
             except Exception as e:
                 print(e)
-    def getAnnotationsToCanvas(self):
-        for processor in self.queryProcessors:
-            try:
-                processor.getAnnotationsToCanvas()
-            except Exception as e:
-                print(e)
-    def getAnnotationsToCollection(self):
-        for processor in self.queryProcessors:
-            try:
-                processor.getAnnotationsToCollection()
-            except Exception as e:
-                print(e)
-    def getAnnotationsToManifest(self):
-        for processor in self.queryProcessors:
+    def buildAnnotations(self, frames):
+        # the Annotation objects of the rows of frames, sharing the target and body
+        # objects with the same id
+        result = []
+        targets = dict()
+        bodies = dict()
+        for df in frames:
             try:
-                processor.getAnnotationsToManifest()
+                result += self.buildObjects(
+                    df,
+                    lambda id, motivation, target, body: Annotation(id, motivation,
+                                                                    IdentifiableEntity.intern(target, targets),
+                                                                    Image.intern(body, bodies)),
+                    "id", "motivation", "target", "body")
             except Exception as e:
                 print(e)
+        return result
+
+    def getAnnotationsToEntities(self, targetIds):
+        # the annotations of a set of targets, with one query per relational database
+        targetIds = list(targetIds)
+        return self.buildAnnotations(self.callAll("getAnnotationsWithTargets", targetIds))
+
+    def getAnnotationsUnder(self, entityId):
+        # the annotations of an entity and of everything under it: all the ids come
+        # from one graph query and their annotations from one relational query, or
+        # everything from one lookup of the closure table in the identity index
+        indexed = self.getIndexedDatabases(("annotations",))
+        if indexed:
+            index, graph_dbs, relational_dbs = indexed
+            return self.buildAnnotations([index.annotationsUnder(graph_dbs, relational_dbs, entityId)])
+        ids = [entityId]
+        for df in self.callAll("getDescendantIds", entityId):
+            ids += df["id"].tolist() if not df.empty else []
+        return self.getAnnotationsToEntities(ids)
+
+    def getAnnotationsToCanvas(self, canvasId):
+        return self.getAnnotationsToEntities([canvasId])
+    def getAnnotationsToCollection(self, collectionId):
+        return self.getAnnotationsUnder(collectionId)
+    def getAnnotationsToManifest(self, manifestId):
+        return self.getAnnotationsUnder(manifestId)
     def getAnnotationsWithBody(self):
         for processor in self.queryProcessors:
             try:
@@ -676,44 +1443,55 @@ class GenericQueryProcessor():
 
 
     def getCanvasesInCollection(self, collectionId):
+        indexed = self.getIndexedDatabases()
+        if indexed:
+            # the canvases under the collection, at any depth, from the closure table
+            index, graph_dbs, relational_dbs = indexed
+            df_joined = index.entitiesWith(graph_dbs, relational_dbs, "ancestor", collectionId, "Canvas")
+            if not df_joined.empty:
+                return self.buildObjects(df_joined, Canvas, "id", "label", "title", "creator")
+            return None
         graph_db = DataFrame()
         relation_db = DataFrame()
         for item in self.queryProcessors:
             if isinstance(item, TriplestoreQueryProcessor):
                 graph_db = item.getCanvasesInCollection(collectionId)#restituisce canva, id, collection
-            elif isinstance(item, RelationalQueryProcessor):
-                relation_db = item.getEntities() #restituisce entityId, id, title, creator
-            else:
-                break
         if not graph_db.empty:
+            relation_db = self.getRelationalEntitiesWithIds(graph_db["id"]) #restituisce entityId, id, title, creator
             df_joined = merge(graph_db, relation_db, left_on="id", right_on="id")
-            canvas_list = []
-            # itera le righe del dataframe e crea gli oggetti Canvas
-            for index, row in df_joined.iterrows():
-                canvas = Canvas(row['id'], row['label'], row['title'], row['creator'])
-                canvas_list.append(canvas)
+            # crea gli oggetti Canvas dalle colonne del dataframe
+            canvas_list = self.buildObjects(df_joined, Canvas, "id", "label", "title", "creator")
             return canvas_list
     def getCanvasesInManifest(self, manifestId):
         for item in self.queryProcessors:
             if isinstance(item, TriplestoreQueryProcessor):
                 graph_db = item.getCanvasesInManifest(manifestId)
-                canvas_list = []
-                for index, row in graph_db.iterrows():
-                    canvas = Canvas(row['id'], row['label'], row['title'], row['creator'])
-                    canvas_list.append(canvas)
-                    return canvas_list
+                canvas_list = self.buildObjects(graph_db, Canvas, "id", "label", "title", "creator")
+                return canvas_list
             else:
                 pass
     def getEntityById(self, id):
+        indexed = self.getIndexedDatabases(())
+        if indexed:
+            index, graph_dbs, _ = indexed
+            graph_db = index.graphEntitiesWith(graph_dbs, "id", id)
+            if not graph_db.empty:
+                return IdentifiableEntity(graph_db["id"].iloc[0])
+            return None
         for item in self.queryProcessors:
             if isinstance(item, TriplestoreQueryProcessor):
                 graph_db = item.getEntitiesWithId(id)  #non funziona perchè non abbiamo ancora imprementato il queryprocessor
-                for index, row in graph_db.iterrows():#sicuramente non funziona 
-                    entity = IdentifiableEntity(row['id'])
+                if not graph_db.empty:
+                    entity = IdentifiableEntity(graph_db["id"].iloc[0])
                     return entity
             else:
                 pass
     def getEntitiesWithCreator(self, creator):
+        indexed = self.getIndexedDatabases()
+        if indexed:
+            index, graph_dbs, relational_dbs = indexed
+            df_joined = index.entitiesWith(graph_dbs, relational_dbs, "creator", creator)
+            return self.buildObjects(df_joined, EntityWithMetadata, "id", "label", "title", "creator")
         graph_db = DataFrame()
         relation_db = DataFrame()
         for item in self.queryProcessors:  
@@ -722,20 +1500,11 @@ class GenericQueryProcessor():
             else:
                 pass
         if not relation_db.empty:
-            id = [["id"]]
-            for item in self.queryProcessors:  
-                if isinstance(item, TriplestoreQueryProcessor):
-                    for ind, item in id.iteritems:
-                        graph_db = item.getEntitiesWithCreator(creator) #restituisce entityId, id, title, creator
-                else:
-                    pass
+            # the labels of only the entities found, with one VALUES query
+            graph_db = self.getGraphEntitiesWithIds(relation_db["id"])
         if not relation_db.empty:
             df_joined = merge(graph_db, relation_db, left_on="id", right_on="id")
-            entity_list = []
-            # itera le righe del dataframe e crea gli oggetti Canvas
-            for index, row in df_joined.iterrows():
-                entity = EntityWithMetadata(row['id'], row['label'], row['title'], row['creator'])
-                entity_list.append(entity)
+            entity_list = self.buildObjects(df_joined, EntityWithMetadata, "id", "label", "title", "creator")
             return entity_list
 
 # ERICA:
@@ -745,16 +1514,23 @@ class GenericQueryProcessor():
         graph_db = DataFrame()
         relational_db = DataFrame()
 
-        for processor in self.queryProcessors:
-            if isinstance(processor, TriplestoreQueryProcessor):
-                graph_db = processor.getEntitiesWithLabel(label)
-            elif isinstance(processor, RelationalQueryProcessor):
-                relational_db = processor.getEntities()
-            else:
-                break
+        indexed = self.getIndexedDatabases()
+        if indexed:
+            # the same rows of the merge below, from the identity index, where the
+            # labels are stored as in the graph (quotes escaped by remove_special_chars)
+            index, graph_dbs, relational_dbs = indexed
+            stored_label = remove_special_chars(label)
+            df_joined = index.entitiesWith(graph_dbs, relational_dbs, "label", stored_label)
+            graph_db = index.graphEntitiesWith(graph_dbs, "label", stored_label) if df_joined.empty else df_joined
+        else:
+            for processor in self.queryProcessors:
+                if isinstance(processor, TriplestoreQueryProcessor):
+                    graph_db = processor.getEntitiesWithLabel(label)
             
         if not graph_db.empty: #check if the call got some result
-            df_joined = merge(graph_db, relational_db, left_on="id", right_on="id") #create the merge with the two db
+            if not indexed:
+                relational_db = self.getRelationalEntitiesWithIds(graph_db["id"])
+                df_joined = merge(graph_db, relational_db, left_on="id", right_on="id") #create the merge with the two db
             df_joined_fill = df_joined.fillna("") 
             grouped = df_joined_fill.groupby("id").agg({
                                                         "label": "first",
@@ -765,38 +1541,16 @@ class GenericQueryProcessor():
 
             if not sorted.empty: # if the merge has some result inside, proceed
         
-                result = list()
-
-                for row_idx, row in sorted.iterrows():
-                    id = row["id"]
-                    label = label
-                    title = row["title"]
-                    creators_row = row['creator']
-                    for item in creators_row: # iterate the string and find out if there are some ";", if there are, split them
-                        if item == ";":
-                            creators = creators_row.split(';') # if it's a string the class attribute would automatically append every string in a list
-                            break
-                    else:
-                        creators = [creators_row] # else, create a list and the class attribute will take it directly 
-
-                    entities = EntityWithMetadata(id, label, title, creators)
-                    result.append(entities)
-                
+                # split the joined creators again, a list is taken directly by the class attribute
+                result = self.buildObjects(
+                    sorted,
+                    lambda id, title, creators_row: EntityWithMetadata(id, label, title, creators_row.split(';') if isinstance(creators_row, str) else [creators_row]),
+                    "id", "title", "creator")
 
                 return result
             
             else: # if the merge got no result and is empty, then take only the result of the graph_db query and fill the attributes with empty strings
-                result = list()
-
-                for row_idx, row in graph_db.iterrows():
-                    id = row["id"]
-                    label = label
-                    title = ""
-                    creators = ""
-
-                    entities = EntityWithMetadata(id, label, title, creators)
-                    result.append(entities)
-                
+                result = self.buildObjects(graph_db, lambda id: EntityWithMetadata(id, label, "", ""), "id")
 
                 return result
                 
@@ -804,30 +1558,33 @@ class GenericQueryProcessor():
         
     def getEntitiesWithTitle(self, title):
 
+        indexed = self.getIndexedDatabases()
+        if indexed:
+            index, graph_dbs, relational_dbs = indexed
+            df_joined = index.entitiesWith(graph_dbs, relational_dbs, "title", title)
+            return self.buildObjects(
+                df_joined,
+                lambda id, label, creators: EntityWithMetadata(id, label, title, creators),
+                "id", "label", "creator")
+
         graph_db = DataFrame()
         relational_db = DataFrame()
 
         for processor in self.queryProcessors:
-            if isinstance(processor, TriplestoreQueryProcessor):
-                graph_db = processor.getAllEntities()
-            elif isinstance(processor, RelationalQueryProcessor):
+            if isinstance(processor, RelationalQueryProcessor):
                 relational_db = processor.getEntitiesWithTitle(title)
-            else:
-                break        
         
+        result = list()
+        if not relational_db.empty:
+            graph_db = self.getGraphEntitiesWithIds(relational_db["id"])
 
         if not graph_db.empty:
             df_joined = merge(graph_db, relational_db, left_on="id", right_on="id")
 
-            result = list()
-
-            for row_idx, row in df_joined.iterrows():
-                id = row["id"]
-                label = row["label"]
-                title = title
-                creators = row["creator"]
-                entities = EntityWithMetadata(id, label, title, creators)
-                result.append(entities)
+            result = self.buildObjects(
+                df_joined,
+                lambda id, label, creators: EntityWithMetadata(id, label, title, creators),
+                "id", "label", "creator")
 
         return result
         
@@ -846,62 +1603,107 @@ class GenericQueryProcessor():
             else:
                 break
 
+        result = list()
         if not graph_db.empty:
             df_joined = merge(graph_db, relational_db, left_on="id", right_on="target")
-            result = list()
-
-            for row_idx, row in df_joined.iterrows():
-                id = row["body"]
-                images = Image(id)
-            result.append(images)
+            result = self.buildObjects(df_joined, Image, "body")
 
         return result
     
 
-    def getManifestsInCollection(self, collectionId):
+    def canvasesByManifest(self, canvases_db):
+        # the Canvas objects of a getCanvasesInManifestsOfCollection result, with
+        # their metadata when there is any, as {manifest id: list of canvases}
+        items_by_manifest = dict()
+        if canvases_db is None or canvases_db.empty:
+            return items_by_manifest
+        relational_db = self.getRelationalEntitiesWithIds(canvases_db["id"])
+        if not relational_db.empty:
+            canvases_db = merge(canvases_db, relational_db[["id", "title", "creator"]], how="left", on="id")
+        else:
+            canvases_db = canvases_db.assign(title="", creator="")
+        canvases_db = canvases_db.fillna("")
+        for manifest_id, group in canvases_db.groupby("manifestId", sort=False):
+            canvases = dict()
+            for canvas_id, label, title, creator in zip(group["id"], group["label"], group["title"], group["creator"]):
+                if canvas_id not in canvases:
+                    canvases[canvas_id] = Canvas(canvas_id, label, title, [])
+                if creator:
+                    canvases[canvas_id].getCreators().append(creator)
+            items_by_manifest[manifest_id] = list(canvases.values())
+        return items_by_manifest
+
+    def getManifestsInCollection(self, collectionId, prefetch:bool=False):
 
         graph_db = DataFrame()
         relational_db = DataFrame()
+        batch = ItemsBatch(dict)
         
         for processor in self.queryProcessors:
             if isinstance(processor, TriplestoreQueryProcessor):
-                graph_db = processor.getManifestsInCollection(collectionId)
-            elif isinstance(processor, RelationalQueryProcessor):
-                relational_db = processor.getEntities()
-            else:
-                break
+                if prefetch:
+                    # all the canvases of all the manifests in one query, sent
+                    # at the same time as the one of the manifests
+                    graph_db, canvases_db = self.fanOut([
+                        (processor, lambda: processor.getManifestsInCollection(collectionId)),
+                        (processor, lambda: processor.getCanvasesInManifestsOfCollection(collectionId))
+                    ])
+                    items_by_manifest = self.canvasesByManifest(canvases_db)
+                    batch = ItemsBatch(lambda items_by_manifest=items_by_manifest: items_by_manifest)
+                else:
+                    # the canvases are loaded by the first getItems() of any of the
+                    # manifests, for all of them with the same single query
+                    graph_db = processor.getManifestsInCollection(collectionId)
+                    batch = ItemsBatch(lambda processor=processor: self.canvasesByManifest(
+                        processor.getCanvasesInManifestsOfCollection(collectionId)))
+                graph_db = DataFrame() if graph_db is None else graph_db
         
-
-        if not graph_db.empty:
+        if graph_db.empty:
+            return list()
+        relational_db = self.getRelationalEntitiesWithIds(graph_db["id"])
+        return self.buildManifests(graph_db, relational_db, batch)
+
+    def buildManifests(self, graph_db, relational_db, batch):
+        # the Manifest objects of the manifests of a collection, with their
+        # metadata when there is any, whose items are loaded by batch
+        if not relational_db.empty:
             df_joined = merge(graph_db, relational_db, left_on="id", right_on="id") 
+        else:
+            df_joined = DataFrame()
 
-            if not df_joined.empty:
-               
-                result = list()
-
-                for row_idx, row in df_joined.iterrows():
-                    id = row["id"]
-                    label = row["label"]
-                    title = row["title"]
-                    creators = row["creator"]
-                    items = processor.getCanvasesInManifest(id)
-                    manifests = Manifest(id, label, title, creators, items)
-                    result.append(manifests)
-
-            return result
+        if not df_joined.empty:
+            result = self.buildObjects(
+                df_joined,
+                lambda id, label, title, creators: Manifest(id, label, title, creators, LazyItems(id, batch)),
+                "id", "label", "title", "creator")
         else: 
-            result = list()
-
-            for row_idx, row in graph_db.iterrows():
-                id = row["id"]
-                label = row["label"]
-                title = ""
-                creators = ""
-                items = processor.getCanvasesInManifest(id)
-                manifests = Manifest(id, label, title, creators, items)
-                result.append(manifests)            
-
-            return result
+            result = self.buildObjects(
+                graph_db,
+                lambda id, label: Manifest(id, label, "", "", LazyItems(id, batch)),
+                "id", "label")
+
+        return result
+
+    def getManifestsInCollections(self, collectionIds, prefetch:bool=False):
+        # getManifestsInCollection for many collections as {collection id: list of
+        # manifests}, with one query for the manifests of all of them, one lookup
+        # of their metadata and one query for the canvases of all the manifests
+        # (at the first getItems() of any manifest, or now with prefetch)
+        collectionIds = list(collectionIds)
+        frames = [frame for frame in self.callAll("getManifestsInCollections", collectionIds) if not frame.empty]
+        if not collectionIds or not frames:
+            return dict()
+        graph_db = concat(frames, ignore_index=True)
+        manifest_ids = graph_db["id"].drop_duplicates().tolist()
+
+        batch = ItemsBatch(lambda: self.canvasesByManifest(
+            concat(self.callAll("getCanvasesInManifests", manifest_ids) or [DataFrame()], ignore_index=True)))
+        if prefetch:
+            batch.loadAll()
+        relational_db = self.getRelationalEntitiesWithIds(manifest_ids)
+
+        return {collection_id: self.buildManifests(group.drop(columns="collectionId"), relational_db, batch)
+                for collection_id, group in graph_db.groupby("collectionId", sort=False)}
 
 
 # NOTE: TEST BLOCK, TO BE DELETED
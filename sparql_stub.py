@@ -0,0 +1,85 @@
+# An in-process SPARQL endpoint for the tests: the queries run on an rdflib
+# Graph and the results are sent as CSV or JSON, following the Accept header
+# like Blazegraph. status and delay make it answer with an error or slowly,
+# and it counts the connections and keeps the queries it gets.
+#   stub = SparqlStub(graph)
+#   processor.setDbPathOrUrl(stub.url)
+#   ...
+#   stub.close()
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread, Lock
+from time import sleep
+from rdflib import Graph
+
+
+class SparqlStub(object):
+    def __init__(self, graph:Graph=None):
+        self.graph = Graph() if graph is None else graph
+        self.status = 200
+        self.delay = 0
+        self.connections = 0
+        self.requests = 0
+        self.queries = []
+        self.active = 0
+        self.maxActive = 0
+        self.mutex = Lock()
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def setup(self):
+                super().setup()
+                with stub.mutex:
+                    stub.connections += 1
+
+            def do_POST(self):
+                query = self.rfile.read(int(self.headers.get("Content-Length", 0))).decode("utf-8")
+                with stub.mutex:
+                    stub.requests += 1
+                    stub.queries.append(query)
+                    stub.active += 1
+                    stub.maxActive = max(stub.maxActive, stub.active)
+                try:
+                    sleep(stub.delay)
+                    if stub.status != 200:
+                        self.answer(stub.status, "text/plain", b"stub error")
+                        return
+                    result = stub.graph.query(query)
+                    if stub.prefersJson(self.headers.get("Accept", "")):
+                        self.answer(200, "application/sparql-results+json", result.serialize(format="json"))
+                    else:
+                        self.answer(200, "text/csv;charset=utf-8", result.serialize(format="csv"))
+                finally:
+                    with stub.mutex:
+                        stub.active -= 1
+
+            def answer(self, status, contentType, body):
+                self.send_response(status)
+                self.send_header("Content-Type", contentType)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}/blazegraph/sparql"
+        Thread(target=self.server.serve_forever, daemon=True).start()
+
+    @staticmethod
+    def prefersJson(accept:str):
+        # the format with the highest q among the ones of the header
+        best, best_q = "text/csv", -1.0
+        for part in accept.split(","):
+            fields = [field.strip() for field in part.split(";")]
+            q = next((float(field[2:]) for field in fields[1:] if field.startswith("q=")), 1.0)
+            if q > best_q:
+                best, best_q = fields[0], q
+        return best == "application/sparql-results+json"
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
@@ -0,0 +1,39 @@
+import unittest
+from multiprocessing import get_context
+from tempfile import TemporaryDirectory
+from utils.IdAllocator import IdAllocator
+
+
+def allocate(directory, count, blockSize):
+    # what a loader process does: numbers taken one at a time, then closed
+    with IdAllocator(directory, blockSize) as allocator:
+        return [allocator.next("Canvas") for _ in range(count)]
+
+
+class TestIdAllocator(unittest.TestCase):
+
+    def test_01_numbers_in_order(self):
+        with TemporaryDirectory() as directory:
+            with IdAllocator(directory, blockSize=3) as allocator:
+                self.assertEqual([allocator.next("Canvas") for _ in range(7)], list(range(1, 8)))
+            # the unused tail of the last block is given back
+            with IdAllocator(directory, blockSize=3) as allocator:
+                self.assertEqual(allocator.next("Canvas"), 8)
+
+    def test_02_unique_across_processes(self):
+        with TemporaryDirectory() as directory:
+            with get_context("spawn").Pool(6) as pool:
+                results = pool.starmap(allocate, [(directory, 500, 7)] * 12)
+            numbers = [number for result in results for number in result]
+            self.assertEqual(len(numbers), 12 * 500)
+            self.assertEqual(len(set(numbers)), len(numbers))
+
+    def test_03_reset(self):
+        with TemporaryDirectory() as directory:
+            allocate(directory, 10, 4)
+            IdAllocator(directory).reset()
+            self.assertEqual(allocate(directory, 1, 4), [1])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,229 @@
+import unittest
+from os import remove
+from os.path import join
+from unittest.mock import patch
+from sqlite3 import connect
+from tempfile import TemporaryDirectory
+from rdflib import Literal, RDF, URIRef
+from utils.CreateGraph import Canvas, Collection, Manifest, has_id, items, label
+from utils.IdentityIndex import IdentityIndex
+from utils.ResultCache import database_key as index_key
+from impl import (AnnotationProcessor, CollectionProcessor, GenericQueryProcessor, MetadataProcessor,
+                  RelationalQueryProcessor, TriplestoreQueryProcessor, QueryProcessor)
+
+DATA = "data"
+MANIFEST = "https://dl.ficlit.unibo.it/iiif/2/28429/manifest"
+COLLECTION = "https://dl.ficlit.unibo.it/iiif/28429/collection"
+
+
+class TestIdentityIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = TemporaryDirectory()
+        self.relational = join(self.directory.name, "relational.db")
+        self.graph = join(self.directory.name, "graph.nt")
+        self.index = join(self.directory.name, "index.db")
+        self.cache = QueryProcessor.resultCache
+        QueryProcessor.resultCache = None
+
+    def tearDown(self):
+        QueryProcessor.resultCache = self.cache
+        self.directory.cleanup()
+
+    def upload(self, cls, file, indexed=True, **options):
+        processor = cls(**options)
+        processor.identityIndex = self.index if indexed else None
+        if cls is CollectionProcessor:
+            processor.countersDir = join(self.directory.name, "counters")
+            processor.setDbPathOrUrl(self.graph)
+        else:
+            processor.setDbPathOrUrl(self.relational)
+        self.assertTrue(processor.uploadData(join(DATA, file)))
+
+    def generic(self, indexed):
+        relational = RelationalQueryProcessor()
+        relational.setDbPathOrUrl(self.relational)
+        graph = TriplestoreQueryProcessor()
+        graph.setDbPathOrUrl(self.graph)
+        generic = GenericQueryProcessor(identityIndex=self.index if indexed else None)
+        generic.addQueryProcessor(relational)
+        generic.addQueryProcessor(graph)
+        return generic
+
+    def test_01_parts_written_without_the_index(self):
+        # the annotations are not in the index: the queries reading them must not use it
+        self.upload(AnnotationProcessor, "annotations.csv", indexed=False)
+        self.upload(MetadataProcessor, "metadata.csv")
+        self.upload(CollectionProcessor, "collection-1.json", streaming=True, batchSize=500)
+
+        indexed = self.generic(True)
+        plain = self.generic(False)
+        self.assertIsNone(indexed.getIndexedDatabases(("annotations",)))
+        self.assertIsNotNone(indexed.getIndexedDatabases(("metadata",)))
+        expected = sorted(annotation.getId() for annotation in plain.getAnnotationsToManifest(MANIFEST))
+        self.assertTrue(expected)
+        self.assertEqual(sorted(annotation.getId() for annotation in indexed.getAnnotationsToManifest(MANIFEST)), expected)
+
+    def test_02_all_parts_indexed(self):
+        self.upload(AnnotationProcessor, "annotations.csv")
+        self.upload(MetadataProcessor, "metadata.csv")
+        self.upload(CollectionProcessor, "collection-1.json", streaming=True, batchSize=500)
+
+        indexed = self.generic(True)
+        plain = self.generic(False)
+        self.assertIsNotNone(indexed.getIndexedDatabases(("metadata", "annotations")))
+        self.assertEqual(sorted(annotation.getId() for annotation in indexed.getAnnotationsToCollection(COLLECTION)),
+                         sorted(annotation.getId() for annotation in plain.getAnnotationsToCollection(COLLECTION)))
+        self.assertEqual(sorted(canvas.getId() for canvas in indexed.getCanvasesInCollection(COLLECTION)),
+                         sorted(canvas.getId() for canvas in plain.getCanvasesInCollection(COLLECTION)))
+
+    def index_rows(self, path):
+        con = connect(path)
+        try:
+            return {table: sorted(con.execute(f"SELECT * FROM {table}").fetchall())
+                    for table in ("AnnotationEntity", "MetadataEntity", "MetadataCreator")}
+        finally:
+            con.close()
+
+    def test_03_upsert_refreshes_the_touched_ids(self):
+        self.upload(AnnotationProcessor, "annotations.csv")
+        self.upload(MetadataProcessor, "metadata.csv")
+        with open(join(DATA, "annotations.csv"), encoding="utf-8") as f:
+            header, *rows = f.read().splitlines()
+        with open(join(DATA, "metadata.csv"), encoding="utf-8") as f:
+            metadata_header, *metadata = f.read().splitlines()
+        # a changed body, a new annotation, the others missing and deleted; a
+        # changed title and creators and a deleted entity
+        delta = join(self.directory.name, "delta.csv")
+        with open(delta, "w", encoding="utf-8") as f:
+            f.write("\n".join([header, rows[0].replace("default.jpg", "changed.jpg")] + rows[1:10] +
+                              ["https://example.org/annotation/new,https://example.org/new.jpg,https://example.org/canvas/new,painting"]))
+        metadata_delta = join(self.directory.name, "metadata-delta.csv")
+        with open(metadata_delta, "w", encoding="utf-8") as f:
+            f.write("\n".join([metadata_header, metadata[0].replace("Opere", "Tutte le opere").replace("Doe, Jane", "Roe, Jane")]
+                              + metadata[2:]))
+        self.upload(AnnotationProcessor, delta, loadMode="upsert", deleteMissing=True)
+        self.upload(MetadataProcessor, metadata_delta, loadMode="upsert", deleteMissing=True)
+
+        # the same rows as an index built from the final database
+        rebuilt = join(self.directory.name, "rebuilt.db")
+        index = IdentityIndex(rebuilt)
+        index.refreshAnnotations(self.relational)
+        index.refreshMetadata(self.relational)
+        index.close()
+        updated = self.index_rows(self.index)
+        self.assertEqual(len(updated["AnnotationEntity"]), 11)
+        self.assertIn("Dante Alighieri: Tutte le opere", [title for _, _, title in updated["MetadataEntity"]])
+        self.assertEqual(updated, self.index_rows(rebuilt))
+
+    def test_04_entities_staged_in_batches(self):
+        # the triples of an entity and its links spread over several batches
+        manifest, canvas = URIRef("https://example.org/m"), URIRef("https://example.org/c")
+        triples = [(manifest, RDF.type, Manifest), (manifest, items, canvas), (manifest, has_id, Literal("m-1")),
+                   (canvas, label, Literal("old label")), (manifest, label, Literal("Manifest")),
+                   (canvas, RDF.type, Canvas), (canvas, label, Literal("Canvas")), (canvas, has_id, Literal("c-1")),
+                   (URIRef("https://example.org/without-id"), label, Literal("no id"))]
+        index = IdentityIndex(self.index)
+        try:
+            entities = index.stageGraph(batchSize=2)
+            self.assertEqual(list(entities.watch(triples)), triples)
+            index.addGraph(self.graph, entities)
+            rows = self.index_graph()
+        finally:
+            index.close()
+        self.assertEqual(rows["GraphEntity"], [("c-1", "Canvas", "Canvas"), ("m-1", "Manifest", "Manifest")])
+        self.assertEqual(rows["GraphParent"], [("c-1", "m-1")])
+
+    def test_05_closure_after_a_second_upload(self):
+        def entity(name, kind):
+            uri = URIRef(f"https://example.org/{name}")
+            return uri, [(uri, RDF.type, kind), (uri, has_id, Literal(name)), (uri, label, Literal(name))]
+
+        collection, collection_triples = entity("k", Collection)
+        manifest, manifest_triples = entity("m", Manifest)
+        other, other_triples = entity("m2", Manifest)
+        canvases = [entity(f"c{n}", Canvas) for n in range(4)]
+        first = collection_triples + manifest_triples + canvases[0][1] + canvases[1][1] + [
+            (collection, items, manifest), (manifest, items, canvases[0][0]), (manifest, items, canvases[1][0])]
+        # a new manifest of the collection, with a new canvas and one of the other
+        # manifest, and a new canvas of the manifest already there
+        second = (collection_triples + other_triples + manifest_triples +
+                  canvases[0][1] + canvases[2][1] + canvases[3][1]) + [
+            (collection, items, other), (other, items, canvases[2][0]), (other, items, canvases[0][0]),
+            (manifest, items, canvases[3][0])]
+
+        index = IdentityIndex(self.index)
+        try:
+            for triples in (first, second):
+                entities = index.stageGraph(batchSize=4)
+                for triple in triples:
+                    entities.add(triple)
+                index.addGraph(self.graph, entities)
+            con = index.pool.getConnection()
+            closure = sorted(con.execute("SELECT ancestor, descendant, depth FROM GraphClosure").fetchall())
+            with con:
+                index._rebuildClosure(con, index_key(self.graph))
+            rebuilt = sorted(con.execute("SELECT ancestor, descendant, depth FROM GraphClosure").fetchall())
+        finally:
+            index.close()
+
+        names = ["k", "m", "m2", "c0", "c1", "c2", "c3"]
+        self.assertEqual(closure, sorted([(name, name, 0) for name in names] + [
+            ("k", "m", 1), ("k", "m2", 1), ("k", "c0", 2), ("k", "c1", 2), ("k", "c2", 2), ("k", "c3", 2),
+            ("m", "c0", 1), ("m", "c1", 1), ("m", "c3", 1), ("m2", "c0", 1), ("m2", "c2", 1)]))
+        self.assertEqual(closure, rebuilt)
+
+    def test_06_off_by_default(self):
+        for processor in (AnnotationProcessor(), MetadataProcessor(), CollectionProcessor(), GenericQueryProcessor()):
+            self.assertIsNone(processor.identityIndex)
+
+    def test_07_index_errors_do_not_fail_the_upload(self):
+        self.upload(AnnotationProcessor, "annotations.csv")
+        self.upload(MetadataProcessor, "metadata.csv")
+        self.upload(CollectionProcessor, "collection-1.json", streaming=True, batchSize=500)
+        with patch.object(IdentityIndex, "refreshAnnotations", side_effect=OSError("disk full")):
+            self.upload(AnnotationProcessor, "annotations.csv")
+        with patch.object(IdentityIndex, "addGraph", side_effect=OSError("disk full")):
+            self.upload(CollectionProcessor, "collection-2.json", streaming=True, batchSize=500)
+
+        # the uploads are there, the parts that could not be refreshed are not used
+        indexed = self.generic(True)
+        self.assertTrue(indexed.getAllAnnotations())
+        self.assertIsNone(indexed.getIndexedDatabases(("annotations",)))
+        self.assertIsNone(indexed.getIndexedDatabases(()))
+        index = IdentityIndex(self.index)
+        try:
+            self.assertTrue(index.isIndexed([(self.relational, "metadata")]))
+            self.assertFalse(index.isIndexed([(self.graph, "graph")]))
+        finally:
+            index.close()
+
+    def test_08_forget_a_database_that_was_reset(self):
+        self.upload(MetadataProcessor, "metadata.csv")
+        self.upload(CollectionProcessor, "collection-1.json", streaming=True, batchSize=500)
+        remove(self.graph)
+        index = IdentityIndex(self.index)
+        try:
+            index.forget(self.graph, ["graph"])
+        finally:
+            index.close()
+        self.upload(CollectionProcessor, "collection-2.json", streaming=True, batchSize=500)
+
+        indexed = self.generic(True)
+        plain = self.generic(False)
+        self.assertIsNone(plain.getEntityById(COLLECTION))
+        self.assertIsNone(indexed.getEntityById(COLLECTION))
+        self.assertFalse(indexed.getCanvasesInCollection(COLLECTION))
+        self.assertFalse(plain.getCanvasesInCollection(COLLECTION))
+
+    def index_graph(self):
+        con = connect(self.index)
+        try:
+            return {"GraphEntity": sorted(con.execute("SELECT id, type, label FROM GraphEntity").fetchall()),
+                    "GraphParent": sorted(con.execute("SELECT id, parent FROM GraphParent").fetchall())}
+        finally:
+            con.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,114 @@
+import unittest
+from os.path import join
+from tempfile import TemporaryDirectory
+from threading import Thread
+from time import perf_counter
+from unittest.mock import patch
+from rdflib import Literal, URIRef
+from utils.LocalGraph import LocalGraphStore
+from impl import (AnnotationProcessor, CollectionProcessor, MetadataProcessor,
+                  RelationalQueryProcessor, TriplestoreQueryProcessor)
+
+LABEL = URIRef("https://example.org/label")
+COUNT = "SELECT (COUNT(*) AS ?n) WHERE { ?s ?p ?o }"
+# a query that keeps the Graph busy for a while
+SLOW = "SELECT (COUNT(*) AS ?n) WHERE { ?a ?p ?x . ?b ?q ?y . FILTER(STR(?x) < STR(?y)) }"
+
+
+def triples(start, count):
+    return [(URIRef(f"https://example.org/canvas/{n}"), LABEL, Literal(f"Canvas {n}")) for n in range(start, start + count)]
+
+
+class TestLocalGraphStore(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = TemporaryDirectory()
+        self.store = LocalGraphStore(join(self.directory.name, "graph.nt"))
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def count(self):
+        return int(self.store.query(COUNT)["n"].iloc[0])
+
+    def test_01_add_and_external_writes(self):
+        self.store.add(triples(0, 10))
+        self.assertEqual(self.count(), 10)
+        # another process appends to the file
+        other = LocalGraphStore(self.store.path)
+        other.add(triples(10, 5))
+        self.assertEqual(self.count(), 15)
+
+    def test_02_queries_do_not_wait_for_each_other(self):
+        self.store.add(triples(0, 80))
+        finished = dict()
+
+        def run(name, query):
+            self.store.query(query)
+            finished[name] = perf_counter()
+
+        slow = Thread(target=run, args=("slow", SLOW))
+        slow.start()
+        while self.store.readers == 0 and slow.is_alive():
+            pass
+        run("fast", COUNT)
+        slow.join()
+        self.assertLess(finished["fast"], finished["slow"])
+
+    def test_03_concurrent_queries_and_uploads(self):
+        self.store.add(triples(0, 100))
+        errors = []
+
+        def reader():
+            try:
+                for _ in range(20):
+                    self.assertGreaterEqual(self.count(), 100)
+            except Exception as error:
+                errors.append(error)
+
+        def writer(start):
+            self.store.add(triples(start, 50))
+
+        threads = [Thread(target=reader) for _ in range(4)] + [Thread(target=writer, args=(100 + 50 * n,)) for n in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(30)
+        self.assertEqual(errors, [])
+        self.assertEqual(self.count(), 300)
+        self.assertEqual(self.store.readers, 0)
+
+
+    def test_04_append_of_another_process_during_an_upload(self):
+        self.store.add(triples(0, 10))
+        other = LocalGraphStore(self.store.path)
+        reload = self.store._reload
+        writers = []
+
+        def reload_then_other_writes():
+            # the other process appends between the refresh and the append of this one
+            reload()
+            writer = Thread(target=other.add, args=(triples(10, 5),))
+            writer.start()
+            writer.join(0.5)
+            writers.append(writer)
+
+        with patch.object(self.store, "_reload", reload_then_other_writes):
+            self.store.add(triples(15, 5))
+        writers[0].join(30)
+        self.assertEqual(self.count(), 20)
+        self.assertEqual(int(other.query(COUNT)["n"].iloc[0]), 20)
+
+    def test_05_local_graph_paths(self):
+        for processor in (TriplestoreQueryProcessor(), CollectionProcessor()):
+            for path in ("graph.nt", "graph.ttl", "relational.db", "http://127.0.0.1:9999/blazegraph/sparql"):
+                self.assertTrue(processor.setDbPathOrUrl(path), (processor, path))
+        for processor in (RelationalQueryProcessor(), AnnotationProcessor(), MetadataProcessor()):
+            for path in ("graph.nt", "graph.ttl"):
+                self.assertFalse(processor.setDbPathOrUrl(path), (processor, path))
+                self.assertEqual(processor.getDbPathOrUrl(), "")
+            self.assertTrue(processor.setDbPathOrUrl("relational.db"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,101 @@
+import unittest
+from os.path import join
+from sqlite3 import connect
+from tempfile import TemporaryDirectory
+from pandas import concat, read_sql
+from impl import AnnotationProcessor, GenericQueryProcessor, QueryProcessor, RelationalQueryProcessor
+from test_relational_upsert import annotation, write_csv
+
+
+class FailingProcessor(RelationalQueryProcessor):
+    # the pages of the database, then an error after failAfter of them
+    def __init__(self, failAfter):
+        super().__init__()
+        self.failAfter = failAfter
+
+    def getAllAnnotationsPages(self, pageSize:int=1000):
+        for number, page in enumerate(super().getAllAnnotationsPages(pageSize)):
+            if number == self.failAfter:
+                break
+            yield page
+        raise ConnectionError("database gone")
+
+
+class TestRelationalPages(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = TemporaryDirectory()
+        self.database = join(self.directory.name, "relational.db")
+        self.cache = QueryProcessor.resultCache
+        QueryProcessor.resultCache = None
+
+    def tearDown(self):
+        QueryProcessor.resultCache = self.cache
+        self.directory.cleanup()
+
+    def load(self, count):
+        path = write_csv(join(self.directory.name, "annotations.csv"), "id,body,target,motivation",
+                         [annotation(n) for n in range(count)])
+        processor = AnnotationProcessor()
+        processor.setDbPathOrUrl(self.database)
+        self.assertTrue(processor.uploadData(path))
+
+    def processor(self, cls=RelationalQueryProcessor, *args):
+        processor = cls(*args)
+        processor.setDbPathOrUrl(self.database)
+        return processor
+
+    def generic(self, *processors, partialResults=True):
+        generic = GenericQueryProcessor(partialResults=partialResults)
+        for processor in processors:
+            generic.addQueryProcessor(processor)
+        return generic
+
+    def expected(self):
+        con = connect(self.database)
+        try:
+            return read_sql("SELECT * FROM Annotation ORDER BY rowid", con)
+        finally:
+            con.close()
+
+    def test_01_pages(self):
+        self.load(7)
+        expected = self.expected()
+        for pageSize, sizes in ((1, [1] * 7), (3, [3, 3, 1]), (7, [7]), (10, [7])):
+            pages = list(self.processor().getAllAnnotationsPages(pageSize))
+            self.assertEqual([len(page) for page in pages], sizes, f"pageSize={pageSize}")
+            self.assertEqual(concat(pages, ignore_index=True).values.tolist(), expected.values.tolist())
+            self.assertEqual(list(pages[0].columns), list(expected.columns))
+
+    def test_02_empty_table(self):
+        self.load(0)
+        self.assertEqual(list(self.processor().getAllAnnotationsPages(1)), [])
+        self.assertEqual(list(self.generic(self.processor()).iterAllAnnotations(1)), [])
+
+    def test_03_annotation_objects(self):
+        self.load(5)
+        for pageSize in (1, 2, 5):
+            annotations = list(self.generic(self.processor()).iterAllAnnotations(pageSize))
+            self.assertEqual([a.getId() for a in annotations], [f"https://example.org/annotation/{n}" for n in range(5)])
+            self.assertEqual(annotations[2].getTarget().getId(), "https://example.org/canvas/2")
+            self.assertEqual(annotations[2].getBody().getId(), "https://example.org/image/2.jpg")
+
+    def test_04_errors_after_the_first_page(self):
+        self.load(5)
+        walk = self.generic(self.processor(FailingProcessor, 2)).iterAllAnnotations(2)
+        self.assertEqual(len([next(walk) for _ in range(4)]), 4)
+        with self.assertRaises(ConnectionError):
+            next(walk)
+
+    def test_05_errors_before_the_first_page(self):
+        self.load(3)
+        # left out with partialResults, raised without
+        generic = self.generic(self.processor(FailingProcessor, 0), self.processor())
+        self.assertEqual(len(list(generic.iterAllAnnotations(2))), 3)
+        generic = self.generic(self.processor(FailingProcessor, 0), partialResults=False)
+        with self.assertRaises(ConnectionError):
+            list(generic.iterAllAnnotations(2))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,110 @@
+import unittest
+from os.path import join
+from sqlite3 import connect
+from tempfile import TemporaryDirectory
+from impl import AnnotationProcessor, MetadataProcessor
+
+
+def write_csv(path, header, rows):
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(header + "\n")
+        for row in rows:
+            f.write(",".join(f'"{value}"' for value in row) + "\n")
+    return path
+
+
+def annotation(n, body=None):
+    return (f"https://example.org/annotation/{n}", body or f"https://example.org/image/{n}.jpg",
+            f"https://example.org/canvas/{n}", "painting")
+
+
+class TestRelationalUpsert(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = TemporaryDirectory()
+        self.database = join(self.directory.name, "relational.db")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def processor(self, cls, **options):
+        processor = cls(**options)
+        processor.identityIndex = None
+        processor.setDbPathOrUrl(self.database)
+        return processor
+
+    def annotations(self, name, rows, **options):
+        path = write_csv(join(self.directory.name, name), "id,body,target,motivation", rows)
+        self.assertTrue(self.processor(AnnotationProcessor, **options).uploadData(path))
+
+    def rows(self, query):
+        with connect(self.database) as con:
+            return con.execute(query).fetchall()
+
+    def test_01_changed_and_new_rows(self):
+        self.annotations("first.csv", [annotation(0), annotation(1), annotation(2)])
+        self.annotations("delta.csv", [annotation(1, "https://example.org/image/changed.jpg"), annotation(3)],
+                         loadMode="upsert")
+
+        self.assertEqual(self.rows("SELECT annotationId, id, body FROM Annotation ORDER BY annotationId"), [
+            ("annotation-0", "https://example.org/annotation/0", "https://example.org/image/0.jpg"),
+            ("annotation-1", "https://example.org/annotation/1", "https://example.org/image/changed.jpg"),
+            ("annotation-2", "https://example.org/annotation/2", "https://example.org/image/2.jpg"),
+            ("annotation-3", "https://example.org/annotation/3", "https://example.org/image/3.jpg")])
+        self.assertEqual(self.rows("SELECT imageId, id FROM Image WHERE imageId IN ('image-1', 'image-3') ORDER BY imageId"), [
+            ("image-1", "https://example.org/image/changed.jpg"),
+            ("image-3", "https://example.org/image/3.jpg")])
+
+    def test_02_unchanged_rows_are_not_rewritten(self):
+        self.annotations("first.csv", [annotation(0), annotation(1)])
+        before = self.rows("SELECT rowid, annotationId FROM Annotation ORDER BY rowid")
+        self.annotations("same.csv", [annotation(0), annotation(1)], loadMode="upsert")
+        self.assertEqual(self.rows("SELECT rowid, annotationId FROM Annotation ORDER BY rowid"), before)
+
+    def test_03_delete_missing(self):
+        self.annotations("first.csv", [annotation(0), annotation(1), annotation(2)])
+        self.annotations("delta.csv", [annotation(0), annotation(3)], loadMode="upsert", deleteMissing=True)
+
+        self.assertEqual(self.rows("SELECT annotationId, id FROM Annotation ORDER BY annotationId"), [
+            ("annotation-0", "https://example.org/annotation/0"),
+            ("annotation-3", "https://example.org/annotation/3")])
+        self.assertEqual(self.rows("SELECT imageId FROM Image ORDER BY imageId"), [("image-0",), ("image-3",)])
+
+    def test_04_numbers_are_not_reused(self):
+        self.annotations("first.csv", [annotation(0), annotation(1), annotation(2)])
+        self.annotations("delete.csv", [annotation(0)], loadMode="upsert", deleteMissing=True)
+        self.annotations("add.csv", [annotation(0), annotation(5)], loadMode="upsert")
+
+        self.assertEqual(self.rows("SELECT annotationId FROM Annotation ORDER BY annotationId"),
+                         [("annotation-0",), ("annotation-3",)])
+        self.assertEqual(self.rows("SELECT last FROM IdCounter WHERE name = 'Annotation'"), [(3,)])
+
+    def test_05_database_without_counter(self):
+        # a database loaded before the counter table existed
+        self.annotations("first.csv", [annotation(0), annotation(1)])
+        with connect(self.database) as con:
+            con.execute("DROP TABLE IdCounter")
+        self.annotations("delta.csv", [annotation(2)], loadMode="upsert")
+        self.assertEqual(self.rows("SELECT annotationId FROM Annotation WHERE id = 'https://example.org/annotation/2'"),
+                         [("annotation-2",)])
+
+    def test_06_metadata_creators(self):
+        header = "id,title,creator"
+        first = write_csv(join(self.directory.name, "metadata.csv"), header, [
+            ("https://example.org/manifest/1", "One", "Doe, John; Doe, Jane"),
+            ("https://example.org/manifest/2", "Two", "Roe, Richard")])
+        delta = write_csv(join(self.directory.name, "metadata-delta.csv"), header, [
+            ("https://example.org/manifest/1", "One", "Doe, John"),
+            ("https://example.org/manifest/3", "Three", "")])
+        self.assertTrue(self.processor(MetadataProcessor).uploadData(first))
+        self.assertTrue(self.processor(MetadataProcessor, loadMode="upsert", deleteMissing=True).uploadData(delta))
+
+        self.assertEqual(self.rows("SELECT entityId, id, title FROM Entity ORDER BY entityId"), [
+            ("entity-0", "https://example.org/manifest/1", "One"),
+            ("entity-2", "https://example.org/manifest/3", "Three")])
+        self.assertEqual(self.rows("SELECT entityId, creator FROM Creators ORDER BY entityId, creator"), [
+            ("entity-0", "Doe, John"), ("entity-2", "")])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,108 @@
+import unittest
+from os.path import join
+from sqlite3 import connect
+from tempfile import TemporaryDirectory
+from time import sleep
+from pandas import DataFrame
+from utils.ResultCache import ResultCache, result_size
+
+
+class TestResultCache(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = TemporaryDirectory()
+        self.database = join(self.directory.name, "relational.db")
+        with connect(self.database) as con:
+            con.execute("CREATE TABLE Entity (id TEXT)")
+            con.execute("INSERT INTO Entity VALUES ('a')")
+        con.close()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def count(self, cache):
+        def compute():
+            con = connect(self.database)
+            try:
+                return [con.execute("SELECT COUNT(*) FROM Entity").fetchone()[0]]
+            finally:
+                con.close()
+        return cache.getOrCompute(self.database, "count", compute)[0]
+
+    def write(self, journal="delete"):
+        # a write of another process, that does not invalidate the cache
+        con = connect(self.database)
+        con.execute(f"PRAGMA journal_mode={journal}")
+        with con:
+            con.execute("INSERT INTO Entity VALUES ('b')")
+        return con
+
+    def test_01_hits_until_invalidated(self):
+        cache = ResultCache()
+        self.assertEqual(self.count(cache), 1)
+        self.assertEqual(self.count(cache), 1)
+        self.assertEqual(cache.getStats()["hits"], 1)
+        cache.invalidate(self.database)
+        self.assertEqual(self.count(cache), 1)
+        self.assertEqual(cache.getStats()["misses"], 2)
+
+    def test_02_write_of_another_process(self):
+        cache = ResultCache()
+        self.assertEqual(self.count(cache), 1)
+        self.write().close()
+        self.assertEqual(self.count(cache), 2)
+
+    def test_03_write_ahead_log(self):
+        cache = ResultCache()
+        reader = self.write(journal="wal")
+        self.assertEqual(self.count(cache), 2)
+        # the connection stays open: the write is only in the -wal file
+        with reader:
+            reader.execute("INSERT INTO Entity VALUES ('c')")
+        self.assertEqual(self.count(cache), 3)
+        reader.close()
+
+    def test_04_ttl(self):
+        cache = ResultCache(endpointTtl=0.05)
+        calls = []
+        compute = lambda: calls.append(1) or ["result"]
+        cache.getOrCompute("http://127.0.0.1:9999/blazegraph/sparql", "all", compute)
+        cache.getOrCompute("http://127.0.0.1:9999/blazegraph/sparql", "all", compute)
+        self.assertEqual(len(calls), 1)
+        sleep(0.1)
+        cache.getOrCompute("http://127.0.0.1:9999/blazegraph/sparql", "all", compute)
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(cache.getStats()["expirations"], 1)
+
+        # a database file has its own ttl
+        self.count(cache)
+        sleep(0.1)
+        self.count(cache)
+        self.assertEqual(cache.getStats()["hits"], 2)
+
+    def test_05_bounded_by_bytes(self):
+        frame = lambda n: DataFrame({"id": [f"https://example.org/canvas/{n}/{i}" for i in range(1000)]})
+        size = result_size(frame(0))
+        self.assertGreater(size, 1000 * len("https://example.org/canvas/0/0"))
+        cache = ResultCache(maxBytes=3 * size + size // 2)
+        for n in range(5):
+            cache.getOrCompute(self.database, n, lambda n=n: frame(n))
+        stats = cache.getStats()
+        self.assertEqual((stats["size"], stats["evictions"]), (3, 2))
+        self.assertLessEqual(stats["bytes"], stats["maxBytes"])
+        # the least recently used are gone
+        calls = []
+        cache.getOrCompute(self.database, 0, lambda: calls.append(0) or frame(0))
+        cache.getOrCompute(self.database, 4, lambda: calls.append(4) or frame(4))
+        self.assertEqual(calls, [0])
+        # a result larger than the cache is returned but not kept
+        large = DataFrame({"id": [f"https://example.org/canvas/{i}" for i in range(20000)]})
+        self.assertEqual(len(cache.getOrCompute(self.database, "large", lambda: large)), 20000)
+        self.assertEqual(cache.getStats()["size"], 3)
+        self.assertLessEqual(cache.getStats()["bytes"], cache.maxBytes)
+        cache.clear()
+        self.assertEqual(cache.getStats()["bytes"], 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
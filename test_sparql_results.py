@@ -0,0 +1,80 @@
+import json
+import unittest
+import warnings
+from io import BytesIO
+from pandas import read_csv
+from pandas.errors import DtypeWarning
+from pandas.testing import assert_frame_equal
+from rdflib import BNode, Graph, Literal, URIRef
+from utils.SparqlResults import read_csv_results, read_json_results
+
+P = URIRef("https://example.org/p")
+Q = URIRef("https://example.org/q")
+VALUES = ["plain", 'with "quotes"', "comma, here", "new\nline", "ünï©ødé", "None", "NA", "null", "", "  ", " x",
+          "1930", "12 letters", "true", "1e5", "inf", "nan", "-3", "0x10", "information"]
+
+
+def subject(n):
+    return URIRef(f"https://example.org/s{n:07d}")
+
+
+class TestSparqlResults(unittest.TestCase):
+    # the JSON results of a query must give the same DataFrame as its CSV
+    # results read with read_csv, column types included
+
+    def check(self, triples, query):
+        graph = Graph()
+        for triple in triples:
+            graph.add(triple)
+        result = graph.query(query)
+        return self.checkResults(result.serialize(format="csv"), result.serialize(format="json"))
+
+    def checkResults(self, csv, results):
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", DtypeWarning)
+            expected = read_csv(BytesIO(csv), sep=",")
+            frames = [read_csv_results(BytesIO(csv)), read_json_results(BytesIO(results)),
+                      read_json_results(BytesIO(results), chunkSize=37)]
+        for frame in frames:
+            assert_frame_equal(frame, expected, check_exact=True)
+            self.assertEqual(list(frame.dtypes), list(expected.dtypes))
+        return expected
+
+    def test_01_strings(self):
+        triples = [(subject(n), P, Literal(value)) for n, value in enumerate(VALUES)] + [(BNode(), P, Literal("b"))]
+        self.check(triples, "SELECT ?s ?o WHERE { ?s <https://example.org/p> ?o }")
+        # one column: an unbound or empty value is a blank line
+        self.check(triples, "SELECT ?o WHERE { ?s <https://example.org/p> ?o }")
+
+    def test_02_optional_values(self):
+        triples = ([(subject(n), P, Literal(f"label {n}")) for n in range(50)] +
+                   [(subject(n), Q, Literal(n)) for n in range(0, 50, 2)])
+        frame = self.check(triples, "SELECT ?s ?l ?n WHERE { ?s <https://example.org/p> ?l "
+                                    "OPTIONAL { ?s <https://example.org/q> ?n } }")
+        self.assertEqual(frame["n"].dtype, "float64")
+        self.check(triples, "SELECT ?n WHERE { ?s <https://example.org/p> ?l OPTIONAL { ?s <https://example.org/q> ?n } }")
+        self.check(triples, "SELECT ?s ?x WHERE { ?s <https://example.org/p> ?l OPTIONAL { ?s <https://example.org/none> ?x } }")
+
+    def test_03_empty(self):
+        frame = self.check([(subject(0), P, Literal("a"))], "SELECT ?s ?l WHERE { ?s <https://example.org/none> ?l }")
+        self.assertEqual(list(frame.columns), ["s", "l"])
+
+    def test_04_numbers_and_bools(self):
+        self.check([(subject(n), P, Literal(n % 2 == 0)) for n in range(10)],
+                   "SELECT ?s ?o WHERE { ?s <https://example.org/p> ?o }")
+        self.check([(subject(n), P, Literal(n / 3)) for n in range(10)],
+                   "SELECT ?s ?o WHERE { ?s <https://example.org/p> ?o }")
+
+    def test_05_types_change_between_blocks(self):
+        # read_csv infers the types by blocks of rows (262144 for two columns):
+        # numbers in the first block and text in the second give an object column
+        rows = [(str(subject(n)), str(n) if n < 300000 else f"text {n}") for n in range(320000)]
+        csv = "s,o\r\n" + "".join(f"{s},{o}\r\n" for s, o in rows)
+        bindings = [{"s": {"type": "uri", "value": s}, "o": {"type": "literal", "value": o}} for s, o in rows]
+        results = json.dumps({"head": {"vars": ["s", "o"]}, "results": {"bindings": bindings}})
+        frame = self.checkResults(csv.encode("utf-8"), results.encode("utf-8"))
+        self.assertEqual(frame["o"].dtype, "object")
+
+
+if __name__ == "__main__":
+    unittest.main()
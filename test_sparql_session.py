@@ -0,0 +1,102 @@
+import unittest
+from http.client import HTTPException
+from threading import Thread
+from pandas.testing import assert_frame_equal
+from rdflib import Graph, Literal, URIRef
+from sparql_stub import SparqlStub
+from utils.SparqlResults import CSV, JSON
+from utils.SparqlSession import SparqlSession
+
+QUERY = "SELECT ?s ?label WHERE { ?s <https://example.org/label> ?label } ORDER BY ?s"
+
+
+def example_graph():
+    graph = Graph()
+    for n in range(20):
+        graph.add((URIRef(f"https://example.org/canvas/{n}"), URIRef("https://example.org/label"), Literal(f"Canvas {n}")))
+    return graph
+
+
+class TestSparqlSession(unittest.TestCase):
+
+    def setUp(self):
+        self.stub = SparqlStub(example_graph())
+
+    def tearDown(self):
+        self.stub.close()
+
+    def run_threads(self, target, count, timeout=10):
+        threads = [Thread(target=target, daemon=True) for _ in range(count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(timeout)
+        # a query still waiting for a connection is a hang
+        self.assertFalse(any(thread.is_alive() for thread in threads))
+
+    def test_01_formats(self):
+        session = SparqlSession(self.stub.url, size=1)
+        csv = session.query(QUERY, (CSV,))
+        json = session.query(QUERY, (JSON, CSV))
+        session.close()
+        self.assertEqual(len(csv), 20)
+        self.assertEqual(csv["label"].iloc[0], "Canvas 0")
+        assert_frame_equal(json, csv)
+
+    def test_02_connections_are_reused(self):
+        session = SparqlSession(self.stub.url, size=2)
+        self.run_threads(lambda: [session.query(QUERY) for _ in range(5)], 8)
+        session.close()
+        self.assertEqual(self.stub.requests, 40)
+        self.assertLessEqual(self.stub.connections, 2)
+        self.assertEqual(session.opened, 0)
+
+    def test_03_at_most_size_queries_at_once(self):
+        self.stub.delay = 0.05
+        session = SparqlSession(self.stub.url, size=2)
+        self.run_threads(lambda: session.query(QUERY), 8)
+        session.close()
+        self.assertEqual(self.stub.requests, 8)
+        self.assertLessEqual(self.stub.maxActive, 2)
+
+    def test_04_errors_free_the_connection(self):
+        # every failed query discards its connection: the queries waiting for
+        # it must open a new one instead of waiting forever
+        self.stub.status = 500
+        self.stub.delay = 0.05
+        session = SparqlSession(self.stub.url, size=1)
+        errors = []
+
+        def failing_query():
+            try:
+                session.query(QUERY)
+            except HTTPException as error:
+                errors.append(error)
+
+        self.run_threads(failing_query, 4)
+        self.assertEqual(len(errors), 4)
+        self.assertEqual(session.opened, 0)
+
+        self.stub.status = 200
+        self.assertEqual(len(session.query(QUERY)), 20)
+        session.close()
+
+    def test_05_timeout(self):
+        self.stub.delay = 1
+        session = SparqlSession(self.stub.url, size=1, timeout=0.2)
+        errors = []
+
+        def waiting_query():
+            try:
+                session._borrow()
+            except TimeoutError as error:
+                errors.append(error)
+
+        connection = session._borrow()
+        self.run_threads(waiting_query, 1)
+        session._discard(connection)
+        self.assertEqual(len(errors), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
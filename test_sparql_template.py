@@ -0,0 +1,78 @@
+import unittest
+from rdflib import Graph, Literal, URIRef
+from sparql_stub import SparqlStub
+from utils.SparqlTemplate import PREFIXES, SparqlTemplate, SparqlTemplates, sparql_literal
+from impl import TriplestoreQueryProcessor
+
+P = URIRef("https://example.org/p")
+VALUES = ['with "quotes"', "back\\slash", "new\nline", "carriage\rreturn", "tab\there", "form\ffeed\bbackspace", "ends with \\",
+          '" } ; DROP ALL ; SELECT * { "', "ünï©ødé"]
+
+
+class TestSparqlTemplate(unittest.TestCase):
+
+    def test_01_escaped_values(self):
+        self.assertEqual(sparql_literal('a "b" c'), '"a \\"b\\" c"')
+        self.assertEqual(sparql_literal("a\\b"), '"a\\\\b"')
+        self.assertNotIn("\n", sparql_literal("a\nb"))
+        # every value ends up in the query as the same literal, and nothing else
+        graph = Graph()
+        for n, value in enumerate(VALUES):
+            graph.add((URIRef(f"https://example.org/s{n}"), P, Literal(value)))
+        template = SparqlTemplate("SELECT ?s WHERE { ?s <https://example.org/p> {{value}} }")
+        for n, value in enumerate(VALUES):
+            query = template.bind({"value": value})
+            self.assertTrue(query.startswith(PREFIXES))
+            self.assertEqual([str(row.s) for row in graph.query(query)], [f"https://example.org/s{n}"], repr(value))
+
+    def test_02_values_block(self):
+        template = SparqlTemplate("SELECT ?s WHERE { VALUES ?id { {{ids}} } ?s <https://example.org/p> ?id }")
+        query = template.bind({"ids": ["a", 'b"', "c\nd"]})
+        self.assertIn('VALUES ?id { "a" "b\\"" "c\\nd" }', query)
+        graph = Graph()
+        for value in ("a", 'b"', "c\nd", "e"):
+            graph.add((URIRef(f"https://example.org/{len(graph)}"), P, Literal(value)))
+        self.assertEqual(len(graph.query(query)), 3)
+        self.assertEqual(template.bind({"ids": ("a",)}), template.bind({"ids": ["a"]}))
+        self.assertIn("VALUES ?id {  }", template.bind({"ids": []}))
+
+    def test_03_lru(self):
+        templates = SparqlTemplates({"one": "SELECT * WHERE { ?s ?p {{value}} }"}, maxSize=2)
+        first = templates.render("one", value="a")
+        templates.render("one", value="b")
+        self.assertIs(templates.render("one", value="a"), first)
+        # c evicts b, the least recently used
+        templates.render("one", value="c")
+        self.assertEqual(templates.getStats()["size"], 2)
+        templates.render("one", value="a")
+        self.assertEqual(templates.getStats()["hits"], 2)
+        templates.render("one", value="b")
+        self.assertEqual(templates.getStats()["hits"], 2)
+        self.assertEqual(templates.getStats()["generated"], 4)
+        # the texts of lists are generated every time and not kept
+        templates.render("one", value=["a", "b"])
+        templates.render("one", value=["a", "b"])
+        self.assertEqual(templates.getStats()["generated"], 6)
+        self.assertEqual(templates.getStats()["size"], 2)
+
+    def test_04_template_stats(self):
+        stub = SparqlStub()
+        try:
+            processor = TriplestoreQueryProcessor()
+            processor.resultCache = None
+            processor.setDbPathOrUrl(stub.url)
+            before = processor.getTemplateStats()
+            for _ in range(3):
+                processor.getEntitiesWithId('https://example.org/"stats" test')
+            processor.getEntitiesWithLabel('a "stats" test label')
+            after = processor.getTemplateStats()
+        finally:
+            stub.close()
+        self.assertEqual(after["generated"] - before["generated"], 2)
+        self.assertEqual(after["hits"] - before["hits"], 2)
+        self.assertEqual(len(stub.queries), 4)
+        self.assertEqual(stub.queries[0], stub.queries[2])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,130 @@
+import unittest
+from pandas import concat
+from rdflib import Graph, Literal, Namespace, RDF, URIRef
+from sparql_stub import SparqlStub
+from impl import GenericQueryProcessor, TriplestoreQueryProcessor
+
+CLASSES = Namespace("https://github.com/n1kg0r/ds-project-dhdk/classes/")
+ATTRIBUTES = Namespace("https://github.com/n1kg0r/ds-project-dhdk/attributes/")
+DC = Namespace("http://purl.org/dc/elements/1.1/")
+RELATIONS = Namespace("https://github.com/n1kg0r/ds-project-dhdk/relations/")
+BASE = "https://github.com/n1kg0r/ds-project-dhdk/"
+
+
+def canvas(graph, n, labels):
+    subject = URIRef(f"{BASE}canvas-{n}")
+    graph.add((subject, RDF.type, CLASSES.Canvas))
+    graph.add((subject, DC.identifier, Literal(f"https://example.org/canvas/{n}")))
+    for label in labels:
+        graph.add((subject, ATTRIBUTES.label, Literal(label)))
+
+
+def entity(graph, kind, n, items=()):
+    subject = URIRef(f"{BASE}{kind.lower()}-{n}")
+    graph.add((subject, RDF.type, CLASSES[kind]))
+    graph.add((subject, DC.identifier, Literal(f"https://example.org/{kind.lower()}/{n}")))
+    graph.add((subject, ATTRIBUTES.label, Literal(f"{kind} {n}")))
+    for item in items:
+        graph.add((subject, RELATIONS.items, item))
+    return subject
+
+
+def example_graph():
+    graph = Graph()
+    for n in range(12):
+        canvas(graph, n, [f"Canvas {n}"])
+    # canvases with more than one row, one of them longer than the small pages
+    canvas(graph, 3, ["Another label", "A third label"])
+    canvas(graph, 7, [f"Label {i}" for i in range(5)])
+    # 3 collections of 2 manifests of 2 canvases, and a collection with no manifests
+    for c in range(3):
+        manifests = [entity(graph, "Manifest", 2 * c + m, [URIRef(f"{BASE}canvas-{4 * c + 2 * m + i}") for i in range(2)])
+                     for m in range(2)]
+        entity(graph, "Collection", c, manifests)
+    entity(graph, "Collection", 3)
+    return graph
+
+
+class TestTriplestoreQueryProcessor(unittest.TestCase):
+
+    def setUp(self):
+        self.stub = SparqlStub(example_graph())
+        self.processor = TriplestoreQueryProcessor()
+        self.processor.resultCache = None
+        self.processor.setDbPathOrUrl(self.stub.url)
+
+    def tearDown(self):
+        self.stub.close()
+
+    @staticmethod
+    def rows(df):
+        return sorted(df[["canvas", "id", "label"]].itertuples(index=False, name=None))
+
+    def test_01_canvases_pages(self):
+        expected = self.rows(self.processor.getAllCanvases())
+        self.assertEqual(len(expected), 12 + 2 + 5)
+        for pageSize in (1, 2, 3, 4, 7, 18, 100):
+            pages = list(self.processor.getAllCanvasesPages(pageSize))
+            self.assertEqual(self.rows(concat(pages)), expected, f"pageSize={pageSize}")
+            # the rows of a canvas are never split over two pages
+            seen = [set(page["canvas"]) for page in pages]
+            for first in range(len(seen)):
+                for second in range(first + 1, len(seen)):
+                    self.assertFalse(seen[first] & seen[second])
+
+    def test_02_pages_are_keyset(self):
+        list(self.processor.getAllCanvasesPages(5))
+        self.assertTrue(self.stub.queries)
+        self.assertFalse(any("OFFSET" in query for query in self.stub.queries))
+
+    def test_03_manifests_in_collections(self):
+        ids = [f"https://example.org/collection/{c}" for c in range(4)]
+        df = self.processor.getManifestsInCollections(ids, batchSize=3)
+        self.assertEqual(len(self.stub.queries), 2)
+        self.assertEqual(sorted(zip(df["collectionId"], df["id"])),
+                         [(ids[m // 2], f"https://example.org/manifest/{m}") for m in range(6)])
+
+    def test_04_collections_hierarchy(self):
+        generic = GenericQueryProcessor()
+        generic.addQueryProcessor(self.processor)
+        collections = sorted(generic.getAllCollections(), key=lambda collection: collection.getId())
+        items = [[(manifest.getId(), [canvas.getId() for canvas in manifest.getItems()])
+                  for manifest in collection.getItems()] for collection in collections]
+        self.assertEqual(len(collections), 4)
+        self.assertEqual(sorted(items[0]), [
+            ("https://example.org/manifest/0", ["https://example.org/canvas/0", "https://example.org/canvas/1"]),
+            ("https://example.org/manifest/1", ["https://example.org/canvas/2", "https://example.org/canvas/3"])])
+        self.assertEqual(items[3], [])
+        # the collections, the manifests of all of them and the canvases of all
+        # the manifests: no query per collection or per manifest
+        self.assertEqual(len(self.stub.queries), 3)
+
+    def test_05_iter_all_canvas(self):
+        generic = GenericQueryProcessor()
+        generic.addQueryProcessor(self.processor)
+        expected = sorted(canvas.getId() for canvas in generic.getAllCanvas())
+        # the keyset order of the pages: the canvas IRI
+        order = [f"https://example.org/canvas/{n}" for n in sorted(range(12), key=lambda n: f"canvas-{n}")]
+        for pageSize in (1, 4, 19, 100):
+            ids = [canvas.getId() for canvas in generic.iterAllCanvas(pageSize)]
+            self.assertEqual(sorted(ids), expected, f"pageSize={pageSize}")
+            self.assertEqual([id for n, id in enumerate(ids) if n == 0 or ids[n - 1] != id], order)
+        self.assertEqual(list(GenericQueryProcessor().iterAllCanvas(5)), [])
+
+
+    def test_06_items_errors_reach_the_caller(self):
+        generic = GenericQueryProcessor(partialResults=False)
+        generic.addQueryProcessor(self.processor)
+        collection = next(collection for collection in generic.getAllCollections()
+                          if collection.getId() == "https://example.org/collection/0")
+        self.stub.status = 500
+        with self.assertRaises(Exception):
+            collection.getItems()
+        # nothing is kept: the next call loads the items
+        self.stub.status = 200
+        self.assertEqual(sorted(manifest.getId() for manifest in collection.getItems()),
+                         ["https://example.org/manifest/0", "https://example.org/manifest/1"])
+
+
+if __name__ == "__main__":
+    unittest.main()
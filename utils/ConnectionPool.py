@@ -0,0 +1,40 @@
+from sqlite3 import connect
+from threading import local, Lock
+
+
+class ConnectionPool(object):
+    # keeps one open sqlite connection per thread for a database file, instead of
+    # opening and closing a connection for every query. sqlite caches the compiled
+    # statements per connection, so keeping it open also lets them be reused.
+    def __init__(self, path:str, wal:bool=True, cachedStatements:int=128):
+        self.path = path
+        self.wal = wal
+        # size of the compiled statement cache of every connection
+        self.cachedStatements = cachedStatements
+        self.local = local()
+        self.connections = []
+        self.mutex = Lock()
+
+    def _open(self):
+        con = connect(self.path, check_same_thread=False, cached_statements=self.cachedStatements)
+        if self.wal:
+            # WAL lets readers go on while a processor is writing the tables
+            con.execute("PRAGMA journal_mode=WAL")
+            con.execute("PRAGMA synchronous=NORMAL")
+        return con
+
+    def getConnection(self):
+        con = getattr(self.local, "connection", None)
+        if con is None:
+            con = self._open()
+            self.local.connection = con
+            with self.mutex:
+                self.connections.append(con)
+        return con
+
+    def close(self):
+        with self.mutex:
+            for con in self.connections:
+                con.close()
+            self.connections = []
+        self.local = local()
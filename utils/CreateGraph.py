@@ -1,41 +1,35 @@
 
 from rdflib import Graph, URIRef, RDF, Literal 
-from clean_str import remove_special_chars
+from ijson import parse
+from utils.clean_str import remove_special_chars
+from utils.IdAllocator import IdAllocator
 
-def create_Graph(json_object:dict, base_url, my_graph:Graph):
-    
-    # create an internal id for the collections using an external counter
-    # .strip is for removing eventually white space
-    with open('collection_counter.txt', 'r', encoding='utf-8') as a:
-        collection_counter = int(a.read().strip())
-
-    # create an internal id for the manifest using an external counter
-    with open('manifest_counter.txt', 'r', encoding='utf-8') as b:
-        manifest_counter = int(b.read().strip())
 
-    # create an internal id for the canvases using an external counter
-    with open('canvas_counter.txt', 'r', encoding='utf-8') as c:
-        canvas_counter = int(c.read().strip())
+# classes
+Collection = URIRef("https://github.com/n1kg0r/ds-project-dhdk/classes/Collection")
+Manifest = URIRef("https://github.com/n1kg0r/ds-project-dhdk/classes/Manifest")
+Canvas = URIRef("https://github.com/n1kg0r/ds-project-dhdk/classes/Canvas")
 
+# attributes related to classes
+label = URIRef("https://github.com/n1kg0r/ds-project-dhdk/attributes/label")
 
-    # classes
-    Collection = URIRef("https://github.com/n1kg0r/ds-project-dhdk/classes/Collection")
-    Manifest = URIRef("https://github.com/n1kg0r/ds-project-dhdk/classes/Manifest")
-    Canvas = URIRef("https://github.com/n1kg0r/ds-project-dhdk/classes/Canvas")
+# relations among classes
+items = URIRef("https://github.com/n1kg0r/ds-project-dhdk/relations/items")
+has_id = URIRef("http://purl.org/dc/elements/1.1/identifier")
 
-    # attributes related to classes
-    label = URIRef("https://github.com/n1kg0r/ds-project-dhdk/attributes/label")
 
-    # relations among classes
-    items = URIRef("https://github.com/n1kg0r/ds-project-dhdk/relations/items")
-    has_id = URIRef("http://purl.org/dc/elements/1.1/identifier")
+def create_Graph(json_object:dict, base_url, my_graph:Graph, allocator:IdAllocator=None):
 
+    # the internal ids are numbered by an IdAllocator: pass the same allocator to
+    # every call of an upload, otherwise a new one is used (and closed) for this call
+    own_allocator = allocator is None
+    if own_allocator:
+        allocator = IdAllocator()
     # create a variable for the id
     collection_id = json_object['id'] 
 
-    # create an internal id with an external counter
-    collection_counter += 1
-    collection_IntId = json_object['type'] + f"_{collection_counter}"
+    # create an internal id with the allocator
+    collection_IntId = json_object['type'] + f"_{allocator.next('Collection')}"
     Coll_internalId = URIRef(base_url + collection_IntId)
 
     # create a list from the dictionary of label and catch the value of the key "none" (language) in a variable
@@ -56,9 +50,8 @@ def create_Graph(json_object:dict, base_url, my_graph:Graph):
     for manifest in json_object["items"]:
         manifest_id = manifest['id']
 
-        # here i raise the counter for the manifest internal id
-        manifest_counter += 1
-        manifest_IntId = manifest['type'] + f"_{manifest_counter}" 
+        # here i take the number for the manifest internal id
+        manifest_IntId = manifest['type'] + f"_{allocator.next('Manifest')}" 
         Man_internalId = URIRef(base_url + manifest_IntId)
 
         #add the "has Item" to connect Collection to Manifest
@@ -82,9 +75,8 @@ def create_Graph(json_object:dict, base_url, my_graph:Graph):
         for canvas in manifest["items"]:
             canvas_id = canvas['id']
 
-            # here i raise the counter for the manifest internal id
-            canvas_counter += 1
-            canvas_IntId = canvas['type'] + f"_{canvas_counter}" 
+            # here i take the number for the canvas internal id
+            canvas_IntId = canvas['type'] + f"_{allocator.next('Canvas')}" 
             Can_internalId = URIRef(base_url + canvas_IntId)
 
             #add the "has Item" to connect Collection to Manifest
@@ -103,22 +95,62 @@ def create_Graph(json_object:dict, base_url, my_graph:Graph):
             my_graph.add((Can_internalId, RDF.type, Canvas))
             my_graph.add((Can_internalId, label, Literal(str(C_value_label))))
 
-    #upload the counters text file
-    with open('collection_counter.txt', 'w') as a:
-        a.write(str(collection_counter))
-
-    with open('manifest_counter.txt', 'w') as b:
-        b.write(str(manifest_counter))
-
-    with open('canvas_counter.txt', 'w') as c:
-        c.write(str(canvas_counter))
-
-
-
-
-
-    
-
-
-
-
+    if own_allocator:
+        allocator.close()
+
+
+def stream_Graph(jsonfile, base_url, allocator:IdAllocator=None):
+    # same triples as create_Graph, but the json file (opened in binary mode) is read
+    # with an event-based parser and every triple is yielded as soon as it is known,
+    # so nothing bigger than a single collection/manifest/canvas is kept in memory.
+    # the file can contain a single collection or a list of collections
+
+    own_allocator = allocator is None
+    if own_allocator:
+        allocator = IdAllocator()
+
+    classes = [Collection, Manifest, Canvas]
+    kinds = ["Collection", "Manifest", "Canvas"]
+    # every open entity is [prefix, internal uri, label already added]
+    stack = []
+
+    try:
+        for prefix, event, value in parse(jsonfile):
+
+            if event == "start_map":
+                if not stack:
+                    is_entity = prefix in ("", "item")
+                else:
+                    parent_prefix = stack[-1][0]
+                    child_prefix = parent_prefix + ".items.item" if parent_prefix else "items.item"
+                    is_entity = len(stack) < len(classes) and prefix == child_prefix
+
+                if is_entity:
+                    # the internal id only depends on the position in the hierarchy,
+                    # so the triples can be created before the "type" key is read
+                    kind = kinds[len(stack)]
+                    internalId = URIRef(base_url + f"{kind}_{allocator.next(kind)}")
+
+                    if stack:
+                        yield (stack[-1][1], items, internalId)
+                    yield (internalId, RDF.type, classes[len(stack)])
+                    stack.append([prefix, internalId, False])
+
+            elif event == "end_map" and stack and prefix == stack[-1][0]:
+                stack.pop()
+
+            elif event == "string" and stack:
+                entity_prefix, internalId, labelled = stack[-1]
+                key = prefix[len(entity_prefix) + 1:] if entity_prefix else prefix
+
+                if key == "id":
+                    yield (internalId, has_id, Literal(value))
+
+                # only the first value of the first language is used, as in create_Graph
+                elif not labelled and key.startswith("label.") and key.endswith(".item") and key.count(".") == 2:
+                    stack[-1][2] = True
+                    yield (internalId, label, Literal(str(remove_special_chars(str(value)))))
+
+    finally:
+        if own_allocator:
+            allocator.close()
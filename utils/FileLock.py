@@ -0,0 +1,30 @@
+try:
+    from fcntl import flock, LOCK_EX, LOCK_UN
+
+    def _lock(f):
+        flock(f.fileno(), LOCK_EX)
+
+    def _unlock(f):
+        flock(f.fileno(), LOCK_UN)
+
+except ImportError:  # windows
+    from msvcrt import locking, LK_LOCK, LK_UNLCK
+
+    def _lock(f):
+        f.seek(0)
+        locking(f.fileno(), LK_LOCK, 1)
+
+    def _unlock(f):
+        f.seek(0)
+        locking(f.fileno(), LK_UNLCK, 1)
+
+
+def with_file_lock(path:str, function):
+    # function() under an exclusive lock on the file at path, shared with the
+    # other processes. the lock is not reentrant, not even in the same process
+    with open(path, 'a+') as lockfile:
+        _lock(lockfile)
+        try:
+            return function()
+        finally:
+            _unlock(lockfile)
@@ -0,0 +1,82 @@
+from os import makedirs, replace
+from os.path import join, exists
+from threading import Lock
+from utils.FileLock import with_file_lock
+from utils.paths import COUNTERS_DIR
+
+
+class IdAllocator(object):
+    # hands out the numbers of the internal ids (Collection_N, Manifest_N, Canvas_N).
+    # the counter files only store a high-water mark: every time a loader needs
+    # numbers it reserves a whole block of them under an exclusive file lock, so
+    # several processes can upload at the same time without reusing an id, and
+    # the files are touched once per block instead of at every collection.
+    def __init__(self, directory:str=COUNTERS_DIR, blockSize:int=1000):
+        self.directory = directory
+        self.blockSize = blockSize
+        self.blocks = dict()  # kind -> [next number to give, last number reserved]
+        self.mutex = Lock()
+        makedirs(directory, exist_ok=True)
+
+    def _counterPath(self, kind:str):
+        return join(self.directory, kind.lower() + "_counter.txt")
+
+    def _read(self, kind:str):
+        path = self._counterPath(kind)
+        if not exists(path):
+            return 0
+        with open(path, 'r', encoding='utf-8') as f:
+            value = f.read().strip()
+        return int(value) if value else 0
+
+    def _write(self, kind:str, value:int):
+        # write and rename, so a crash never leaves a half written counter
+        path = self._counterPath(kind)
+        with open(path + ".tmp", 'w', encoding='utf-8') as f:
+            f.write(str(value))
+        replace(path + ".tmp", path)
+
+    def _withLock(self, function):
+        return with_file_lock(join(self.directory, "counters.lock"), function)
+
+    def reserve(self, kind:str, size:int):
+        # reserve size numbers for kind, return the first one
+        def _reserve():
+            first = self._read(kind) + 1
+            self._write(kind, first + size - 1)
+            return first
+        return self._withLock(_reserve)
+
+    def next(self, kind:str):
+        with self.mutex:
+            block = self.blocks.get(kind)
+            if block is None or block[0] > block[1]:
+                first = self.reserve(kind, self.blockSize)
+                block = [first, first + self.blockSize - 1]
+                self.blocks[kind] = block
+            number = block[0]
+            block[0] += 1
+            return number
+
+    def close(self):
+        # give back the unused tail of the current blocks, but only if no other
+        # process reserved numbers after us (otherwise the gap is simply left)
+        def _release():
+            for kind, (next_number, last) in self.blocks.items():
+                if next_number <= last and self._read(kind) == last:
+                    self._write(kind, next_number - 1)
+        with self.mutex:
+            if self.blocks:
+                self._withLock(_release)
+            self.blocks = dict()
+
+    def reset(self, kinds=("Collection", "Manifest", "Canvas")):
+        with self.mutex:
+            self.blocks = dict()
+            self._withLock(lambda: [self._write(kind, 0) for kind in kinds])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,353 @@
+from sqlite3 import connect
+from pandas import read_sql
+from rdflib import RDF
+from utils.ConnectionPool import ConnectionPool
+from utils.CreateGraph import Collection, Manifest, Canvas, label, items, has_id
+from utils.ResultCache import database_key
+from utils.paths import IDENTITY_INDEX
+
+# the local name of the classes of the graph, used as the type of the entities
+TYPES = {Collection: "Collection", Manifest: "Manifest", Canvas: "Canvas"}
+
+# the tables of the index that hold every part of a database
+PART_TABLES = {
+    "graph": ["GraphEntity", "GraphParent", "GraphClosure"],
+    "metadata": ["MetadataEntity", "MetadataCreator"],
+    "annotations": ["AnnotationEntity"]
+}
+
+
+class GraphEntities(object):
+    # id, type, label and parent of the entities described by the triples of a
+    # collection upload. watch() passes the triples on while it reads them, so
+    # it also works with the triples streamed by stream_Graph. every batchSize
+    # triples what was found is moved into temporary tables of the index (kept
+    # on disk), so only one batch is in memory whatever the size of the upload;
+    # addGraph turns the uris into ids once the whole upload has been read.
+    # an error of the index stops the staging but not the upload that watches
+    # the triples: it is kept in error and raised by addGraph
+    def __init__(self, index, batchSize:int=10000):
+        self.index = index
+        self.con = index.pool.getConnection()
+        self.batchSize = batchSize or 10000
+        self.error = None
+        self.attributes = {"id": [], "type": [], "label": []}
+        self.children = []
+        self.pending = 0
+        # changing temp_store drops the temporary tables, it is set first
+        self.con.execute("PRAGMA temp_store = FILE")
+        with self.con:
+            self.con.execute("DROP TABLE IF EXISTS temp.StagedEntity")
+            self.con.execute("DROP TABLE IF EXISTS temp.StagedChild")
+            self.con.execute("CREATE TEMP TABLE StagedEntity (uri TEXT PRIMARY KEY, id TEXT, type TEXT, label TEXT)")
+            self.con.execute("CREATE TEMP TABLE StagedChild (seq INTEGER PRIMARY KEY, parent TEXT, child TEXT)")
+
+    def add(self, triple):
+        if self.error is not None:
+            return
+        s, p, o = triple
+        if p == has_id:
+            self.attributes["id"].append((str(s), str(o)))
+        elif p == RDF.type and o in TYPES:
+            self.attributes["type"].append((str(s), TYPES[o]))
+        elif p == label:
+            self.attributes["label"].append((str(s), str(o)))
+        elif p == items:
+            self.children.append((str(s), str(o)))
+        else:
+            return
+        self.pending += 1
+        if self.pending >= self.batchSize:
+            try:
+                self.flush()
+            except Exception as e:
+                self.error = e
+
+    def watch(self, triples):
+        for triple in triples:
+            self.add(triple)
+            yield triple
+
+    def flush(self):
+        # a later value of the same attribute of a uri replaces the earlier one
+        with self.con:
+            for column, rows in self.attributes.items():
+                self.con.executemany(f"INSERT INTO temp.StagedEntity (uri, {column}) VALUES (?, ?) "
+                                     f"ON CONFLICT (uri) DO UPDATE SET {column} = excluded.{column}", rows)
+                rows.clear()
+            self.con.executemany("INSERT INTO temp.StagedChild (parent, child) VALUES (?, ?)", self.children)
+            self.children.clear()
+        self.pending = 0
+
+    def close(self):
+        with self.con:
+            self.con.execute("DROP TABLE IF EXISTS temp.StagedEntity")
+            self.con.execute("DROP TABLE IF EXISTS temp.StagedChild")
+
+
+class IdentityIndex(object):
+    # a sqlite file that joins the two databases once, when they are written,
+    # instead of at every query: for every external id it keeps the type, label
+    # and parents found in the graph and the title, creators and annotations found
+    # in the relational database. every row has the key of the database it comes
+    # from, so one index can serve several pairs of databases: a query gives the
+    # databases of its processors and only their rows are used.
+    # the processors refresh it after every upload (collections are added, the
+    # metadata and annotations of a database are rebuilt), so it is only valid
+    # for databases written through the processors. IndexedPart records which
+    # parts ("graph", "metadata", "annotations") of which database are there: a
+    # query uses the index only if all the parts it reads are (see isIndexed).
+    # the index cannot see a database that is emptied or replaced (a Blazegraph
+    # reset, a deleted file): its parts must then be removed with forget()
+    schema = [
+        "CREATE TABLE IF NOT EXISTS IndexedPart (db TEXT, part TEXT, PRIMARY KEY (db, part))",
+        "CREATE TABLE IF NOT EXISTS GraphEntity (db TEXT, id TEXT, type TEXT, label TEXT, PRIMARY KEY (db, id))",
+        "CREATE INDEX IF NOT EXISTS GraphEntity_label ON GraphEntity (label)",
+        "CREATE TABLE IF NOT EXISTS GraphParent (db TEXT, id TEXT, parent TEXT, PRIMARY KEY (db, parent, id))",
+        "CREATE INDEX IF NOT EXISTS GraphParent_id ON GraphParent (db, id)",
+        "CREATE TABLE IF NOT EXISTS GraphClosure (db TEXT, ancestor TEXT, descendant TEXT, depth INTEGER, "
+        "PRIMARY KEY (db, ancestor, descendant))",
+        "CREATE INDEX IF NOT EXISTS GraphClosure_descendant ON GraphClosure (db, descendant)",
+        "CREATE TABLE IF NOT EXISTS MetadataEntity (db TEXT, id TEXT, title TEXT, PRIMARY KEY (db, id))",
+        "CREATE INDEX IF NOT EXISTS MetadataEntity_title ON MetadataEntity (title)",
+        "CREATE TABLE IF NOT EXISTS MetadataCreator (db TEXT, id TEXT, creator TEXT)",
+        "CREATE INDEX IF NOT EXISTS MetadataCreator_id ON MetadataCreator (db, id)",
+        "CREATE INDEX IF NOT EXISTS MetadataCreator_creator ON MetadataCreator (creator)",
+        "CREATE TABLE IF NOT EXISTS AnnotationEntity (db TEXT, id TEXT, motivation TEXT, target TEXT, body TEXT)",
+        "CREATE INDEX IF NOT EXISTS AnnotationEntity_id ON AnnotationEntity (db, id)",
+        "CREATE INDEX IF NOT EXISTS AnnotationEntity_target ON AnnotationEntity (target, db)",
+    ]
+
+    def __init__(self, path:str=IDENTITY_INDEX):
+        self.path = path
+        self.pool = ConnectionPool(path)
+        with self.pool.getConnection() as con:
+            for statement in self.schema:
+                con.execute(statement)
+
+    def close(self):
+        self.pool.close()
+
+    def _markIndexed(self, con, db:str, part:str):
+        con.execute("INSERT OR IGNORE INTO IndexedPart VALUES (?, ?)", (db, part))
+
+    def forget(self, path:str, parts=("graph", "metadata", "annotations")):
+        # the rows and the marks of parts of the database at path: the queries
+        # go back to the database until the parts are uploaded again
+        db = database_key(path)
+        with self.pool.getConnection() as con:
+            for part in parts:
+                con.execute("DELETE FROM IndexedPart WHERE db = ? AND part = ?", (db, part))
+                for table in PART_TABLES[part]:
+                    con.execute(f"DELETE FROM {table} WHERE db = ?", (db,))
+
+    def stageGraph(self, batchSize:int=10000):
+        # the entities of a collection upload, staged in the index while they are read
+        return GraphEntities(self, batchSize)
+
+    def addGraph(self, endpoint:str, entities:GraphEntities):
+        # the graph uploads only add triples, so the entities are added too. the
+        # uris of the staged rows are resolved here, when all the ids are known
+        if entities.error is not None:
+            raise entities.error
+        db = database_key(endpoint)
+        indexed = self.isIndexed([(endpoint, "graph")])
+        entities.flush()
+        con = entities.con
+        with con:
+            con.execute("INSERT OR REPLACE INTO GraphEntity "
+                        "SELECT ?, id, type, label FROM temp.StagedEntity WHERE id IS NOT NULL", (db,))
+            # the links that are not in the index yet, in the order of the upload
+            con.execute("DROP TABLE IF EXISTS temp.NewLink")
+            con.execute("""
+                CREATE TEMP TABLE NewLink AS
+                SELECT child.id AS id, parent.id AS parent, min(link.seq) AS seq
+                FROM temp.StagedChild link
+                JOIN temp.StagedEntity parent ON parent.uri = link.parent
+                JOIN temp.StagedEntity child ON child.uri = link.child
+                WHERE parent.id IS NOT NULL AND child.id IS NOT NULL
+                AND NOT EXISTS (SELECT 1 FROM GraphParent known
+                                WHERE known.db = ? AND known.parent = parent.id AND known.id = child.id)
+                GROUP BY child.id, parent.id
+            """, (db,))
+            con.execute("INSERT INTO GraphParent SELECT ?, id, parent FROM temp.NewLink ORDER BY seq", (db,))
+            if indexed:
+                self._extendClosure(con, db)
+            else:
+                self._rebuildClosure(con, db)
+            con.execute("DROP TABLE temp.NewLink")
+            self._markIndexed(con, db, "graph")
+        entities.close()
+
+    def _extendClosure(self, con, db:str):
+        # the closure rows of the new entities and links only: every entity is its
+        # own ancestor at depth 0, and a link from parent to child joins every
+        # ancestor of parent to every descendant of child, keeping the shortest
+        # depth of a pair already there. the links are added one after the other,
+        # so the later ones see the pairs made by the earlier ones
+        con.execute("INSERT OR IGNORE INTO GraphClosure SELECT ?, id, id, 0 FROM temp.StagedEntity WHERE id IS NOT NULL",
+                    (db,))
+        links = con.execute("SELECT parent, id FROM temp.NewLink ORDER BY seq").fetchall()
+        con.executemany("""
+            INSERT INTO GraphClosure
+            SELECT a.db, a.ancestor, d.descendant, a.depth + 1 + d.depth
+            FROM GraphClosure a CROSS JOIN GraphClosure d
+            WHERE a.db = :db AND a.descendant = :parent AND d.db = :db AND d.ancestor = :child
+            ON CONFLICT (db, ancestor, descendant) DO UPDATE SET depth = min(depth, excluded.depth)
+        """, ({"db": db, "parent": parent, "child": child} for parent, child in links))
+
+    def _rebuildClosure(self, con, db:str):
+        # every (ancestor, descendant) pair of the hierarchy of the graph, each
+        # entity being its own ancestor at depth 0: "everything under X" is then a
+        # lookup of the rows of X, whatever the depth. used for a graph that is not
+        # in the index yet, the later uploads only extend it (see _extendClosure)
+        con.execute("DELETE FROM GraphClosure WHERE db = ?", (db,))
+        con.execute("""
+            INSERT INTO GraphClosure
+            WITH RECURSIVE closure(ancestor, descendant, depth) AS (
+                SELECT id, id, 0 FROM GraphEntity WHERE db = :db
+                UNION
+                SELECT closure.ancestor, GraphParent.id, closure.depth + 1
+                FROM closure JOIN GraphParent ON GraphParent.db = :db AND GraphParent.parent = closure.descendant
+            )
+            SELECT :db, ancestor, descendant, min(depth) FROM closure GROUP BY ancestor, descendant
+        """, {"db": db})
+
+    def _rebuild(self, path:str, part:str, tables:list, statements:list, ids=None):
+        # the rows of the relational database at path are read again from its
+        # tables, attached to the index connection, and replace the old ones.
+        # statements are (id column, statement) pairs with a {touched} condition:
+        # with ids (the external ids an upsert changed or deleted) only their rows
+        # are replaced, if the part is already in the index, otherwise all of them
+        db = database_key(path)
+        con = connect(self.path)
+        try:
+            con.execute("ATTACH DATABASE ? AS source", (path,))
+            with con:
+                if ids is not None and self.isIndexed([(path, part)]):
+                    con.execute("CREATE TEMP TABLE touched (id TEXT PRIMARY KEY)")
+                    con.executemany("INSERT OR IGNORE INTO touched VALUES (?)", ((id,) for id in ids))
+                    for table in tables:
+                        con.execute(f"DELETE FROM {table} WHERE db = ? AND id IN (SELECT id FROM temp.touched)", (db,))
+                    for column, statement in statements:
+                        con.execute(statement.format(touched=f"{column} IN (SELECT id FROM temp.touched)"), (db,))
+                    con.execute("DROP TABLE temp.touched")
+                else:
+                    for table in tables:
+                        con.execute(f"DELETE FROM {table} WHERE db = ?", (db,))
+                    for column, statement in statements:
+                        con.execute(statement.format(touched="1"), (db,))
+                self._markIndexed(con, db, part)
+            con.execute("DETACH DATABASE source")
+        finally:
+            con.close()
+
+    def refreshMetadata(self, path:str, ids=None):
+        self._rebuild(path, "metadata", ["MetadataEntity", "MetadataCreator"], [
+            ("id", "INSERT OR REPLACE INTO MetadataEntity SELECT ?, id, title FROM source.Entity WHERE {touched}"),
+            ("Entity.id", "INSERT INTO MetadataCreator SELECT ?, Entity.id, Creators.creator "
+                          "FROM source.Entity JOIN source.Creators ON Entity.entityId = Creators.entityId WHERE {touched}"),
+        ], ids)
+
+    def refreshAnnotations(self, path:str, ids=None):
+        self._rebuild(path, "annotations", ["AnnotationEntity"], [
+            ("id", "INSERT INTO AnnotationEntity SELECT ?, id, motivation, target, body FROM source.Annotation WHERE {touched}"),
+        ], ids)
+
+    def isIndexed(self, parts):
+        # True if all of parts, (database, part) pairs, were written through the processors
+        keys = set((database_key(db), part) for db, part in parts)
+        if not keys:
+            return False
+        marks = " OR ".join("(db = ? AND part = ?)" for _ in keys)
+        found = self.pool.getConnection().execute(
+            f"SELECT count(*) FROM IndexedPart WHERE {marks}", tuple(value for key in keys for value in key)).fetchone()[0]
+        return found == len(keys)
+
+    def graphEntitiesWith(self, graphDbs, column:str, value:str):
+        # id, type and label of the graph entities with the given id or label
+        if column not in ("id", "label"):
+            raise ValueError(f"unknown column: {column}")
+        graph = [database_key(db) for db in graphDbs]
+        marks = ", ".join("?" for _ in graph)
+        db = "db" if column == "id" else "+db"
+        query = f"SELECT DISTINCT id, type, label FROM GraphEntity WHERE {db} IN ({marks}) AND {column} = ?"
+        return read_sql(query, self.pool.getConnection(), params=tuple(graph) + (value,))
+
+    def entitiesWith(self, graphDbs, relationalDbs, column:str, value:str, type:str=None):
+        # the entities found in both databases whose id, label, title or creator
+        # is value, or that are under the entity value ("ancestor"), only of the
+        # given type if there is one: one row per creator (NULL when there is
+        # none), the same rows of a merge between the graph and the relational getters
+        graph = [database_key(db) for db in graphDbs]
+        relational = [database_key(db) for db in relationalDbs]
+        graph_marks = ", ".join("?" for _ in graph)
+        relational_marks = ", ".join("?" for _ in relational)
+        # the table probed with value comes first, CROSS JOIN keeps that order. a
+        # "+" before a db column stops sqlite from preferring the (db, id) primary
+        # key to the index on the probed column
+        g = "GraphEntity g"
+        m = f"MetadataEntity m ON m.id = g.id AND m.db IN ({relational_marks})"
+        c = "MetadataCreator c ON c.db = m.db AND c.id = m.id"
+        shapes = {
+            "id": (f"{g} CROSS JOIN {m} LEFT JOIN {c}",
+                   f"g.db IN ({graph_marks}) AND g.id = ?", relational + graph),
+            "label": (f"{g} CROSS JOIN {m} LEFT JOIN {c}",
+                      f"+g.db IN ({graph_marks}) AND g.label = ?", relational + graph),
+            "ancestor": (f"GraphClosure k CROSS JOIN {g} ON g.db = k.db AND g.id = k.descendant CROSS JOIN {m} LEFT JOIN {c}",
+                         f"k.db IN ({graph_marks}) AND k.ancestor = ? AND k.depth > 0", relational + graph),
+            "title": (f"MetadataEntity m CROSS JOIN {g} ON g.id = m.id AND g.db IN ({graph_marks}) LEFT JOIN {c}",
+                      f"+m.db IN ({relational_marks}) AND m.title = ?", graph + relational),
+            "creator": (f"MetadataCreator c CROSS JOIN MetadataEntity m ON m.db = c.db AND m.id = c.id "
+                        f"CROSS JOIN {g} ON g.id = m.id AND g.db IN ({graph_marks})",
+                        f"+c.db IN ({relational_marks}) AND c.creator = ?", graph + relational),
+        }
+        if column not in shapes:
+            raise ValueError(f"unknown column: {column}")
+        tables, where, params = shapes[column]
+        params = tuple(params) + (value,)
+        if type is not None:
+            where += " AND g.type = ?"
+            params += (type,)
+        query = f"SELECT g.id, g.type, g.label, m.title, c.creator FROM {tables} WHERE {where}"
+        result = read_sql(query, self.pool.getConnection(), params=params)
+        return result.sort_values(["id", "creator"], kind="stable", ignore_index=True)
+
+    def descendantsOf(self, graphDbs, id:str, type:str=None):
+        # id, type and label of the entities under id (not id itself), at any depth
+        graph = [database_key(db) for db in graphDbs]
+        marks = ", ".join("?" for _ in graph)
+        query = f"""
+            SELECT DISTINCT g.id, g.type, g.label
+            FROM GraphClosure k JOIN GraphEntity g ON g.db = k.db AND g.id = k.descendant
+            WHERE k.db IN ({marks}) AND k.ancestor = ? AND k.depth > 0
+        """
+        params = tuple(graph) + (id,)
+        if type is not None:
+            query += " AND g.type = ?"
+            params += (type,)
+        return read_sql(query, self.pool.getConnection(), params=params)
+
+    def annotationsUnder(self, graphDbs, relationalDbs, id:str):
+        # the annotations whose target is id or any entity under it
+        graph = [database_key(db) for db in graphDbs]
+        relational = [database_key(db) for db in relationalDbs]
+        graph_marks = ", ".join("?" for _ in graph)
+        relational_marks = ", ".join("?" for _ in relational)
+        # CROSS JOIN keeps the closure rows of id as the outer loop, so the
+        # annotations are found through their target index instead of a scan
+        query = f"""
+            SELECT DISTINCT a.id, a.motivation, a.target, a.body
+            FROM GraphClosure k
+            CROSS JOIN AnnotationEntity a ON a.target = k.descendant AND a.db IN ({relational_marks})
+            WHERE k.db IN ({graph_marks}) AND k.ancestor = ?
+        """
+        return read_sql(query, self.pool.getConnection(), params=tuple(relational) + tuple(graph) + (id,))
+
+    def parentsOf(self, graphDbs, id:str):
+        # the ids of the manifests or collections that have id among their items
+        graph = [database_key(db) for db in graphDbs]
+        marks = ", ".join("?" for _ in graph)
+        rows = self.pool.getConnection().execute(
+            f"SELECT DISTINCT parent FROM GraphParent WHERE db IN ({marks}) AND id = ?", tuple(graph) + (id,))
+        return [parent for parent, in rows]
@@ -0,0 +1,111 @@
+from io import BytesIO
+from os import stat
+from os.path import exists
+from threading import Condition, Lock
+from pandas import read_csv
+from rdflib import Graph
+from rdflib.plugins.sparql import prepareQuery
+from utils.FileLock import with_file_lock
+
+# suffixes of the files that setDbPathOrUrl accepts as a local graph database
+LOCAL_GRAPH_FORMATS = {".nt": "nt", ".ttl": "turtle"}
+
+
+def is_local_graph(path:str) -> bool:
+    return any(path.endswith(suffix) for suffix in LOCAL_GRAPH_FORMATS)
+
+
+class LocalGraphStore(object):
+    # a graph database kept in a local file instead of a Blazegraph endpoint.
+    # the file is parsed once into an rdflib Graph (indexed in memory by subject,
+    # predicate and object), the uploads append N-Triples lines to the file (valid
+    # turtle too) and the queries run on the Graph without any HTTP round trip.
+    # if another process writes the file, it is parsed again at the next query.
+    # the appends and the parsing of the file hold an exclusive lock on path +
+    # ".lock" (see FileLock): an upload reads the lines of the other processes and
+    # writes its own with no append in between, and no file is parsed half written.
+    # the queries run at the same time, each on the Graph it found: an upload
+    # waits until no query reads the Graph it changes, and the queries that
+    # come after it wait for the upload
+    stores = dict()
+    storesMutex = Lock()
+    # the SPARQL parser of rdflib (pyparsing) is not thread safe
+    parseMutex = Lock()
+
+    @classmethod
+    def get(cls, path:str):
+        with cls.storesMutex:
+            store = cls.stores.get(path)
+            if store is None:
+                store = cls(path)
+                cls.stores[path] = store
+            return store
+
+    def __init__(self, path:str):
+        self.path = path
+        self.format = next(f for suffix, f in LOCAL_GRAPH_FORMATS.items() if path.endswith(suffix))
+        self.graph = Graph()
+        self.signature = None
+        self.changed = Condition(Lock())
+        self.readers = 0
+        self.writers = 0
+
+    def _fileSignature(self):
+        if not exists(self.path):
+            return None
+        info = stat(self.path)
+        return (info.st_size, info.st_mtime_ns)
+
+    def _reload(self):
+        # with the file lock held
+        signature = self._fileSignature()
+        if signature != self.signature:
+            graph = Graph()
+            if signature is not None:
+                graph.parse(self.path, format=self.format)
+            self.graph = graph
+            self.signature = signature
+
+    def _refresh(self):
+        if self._fileSignature() != self.signature:
+            with_file_lock(self.path + ".lock", self._reload)
+
+    def _append(self, triples, lines:str):
+        # with the file lock held: the signature taken after the write covers
+        # only the lines of the Graph
+        self._reload()
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write(lines)
+        for triple in triples:
+            self.graph.add(triple)
+        self.signature = self._fileSignature()
+
+    def add(self, triples):
+        triples = list(triples)
+        lines = "".join(f"{s.n3()} {p.n3()} {o.n3()} .\n" for s, p, o in triples)
+        with self.changed:
+            self.writers += 1
+            try:
+                self.changed.wait_for(lambda: self.readers == 0)
+                with_file_lock(self.path + ".lock", lambda: self._append(triples, lines))
+            finally:
+                self.writers -= 1
+                self.changed.notify_all()
+
+    def query(self, query:str):
+        # the same DataFrame that sparql_dataframe builds from the CSV of the endpoint.
+        # the lock is held to refresh the Graph and take it, not while the query runs
+        with self.parseMutex:
+            prepared = prepareQuery(query)
+        with self.changed:
+            self.changed.wait_for(lambda: self.writers == 0)
+            self._refresh()
+            graph = self.graph
+            self.readers += 1
+        try:
+            data = graph.query(prepared).serialize(format="csv")
+        finally:
+            with self.changed:
+                self.readers -= 1
+                self.changed.notify_all()
+        return read_csv(BytesIO(data), sep=",")
@@ -0,0 +1,129 @@
+from collections import OrderedDict
+from os import stat
+from os.path import abspath
+from sys import getsizeof
+from threading import Lock
+from time import monotonic
+from urllib.parse import urlparse
+from pandas import DataFrame
+
+
+def database_key(path:str) -> str:
+    # the same database written as "relational.db" and "./relational.db" has one key
+    url = urlparse(path)
+    if url.scheme and url.netloc:
+        return path
+    return abspath(path)
+
+
+def database_version(key:str):
+    # the size and modification time of a database file and of its write-ahead
+    # log: they change when any process writes into it, also one that is not
+    # a processor of this process. None for an endpoint
+    if urlparse(key).netloc:
+        return None
+    version = []
+    for path in (key, key + "-wal"):
+        try:
+            info = stat(path)
+            version.append((info.st_size, info.st_mtime_ns))
+        except OSError:
+            version.append(None)
+    return tuple(version)
+
+
+def result_size(value) -> int:
+    # the bytes of a result, the strings of the object columns included
+    if isinstance(value, DataFrame):
+        return int(value.memory_usage(index=True, deep=True).sum())
+    return getsizeof(value)
+
+
+class ResultCache(object):
+    # results of the query processors, kept in LRU order up to maxSize entries
+    # and maxBytes bytes (see result_size; a larger result is not kept), and for
+    # ttl seconds at most (None = until they are evicted).
+    # every database has a generation number, increased by the processors that
+    # upload data into it: the generation is part of the key, so after an upload
+    # the old results are never found again and just age out of the cache.
+    # a database file also has a version (see database_version) in the key, for
+    # the writes of other processes. an endpoint has none, and its key is the URL:
+    # what another process writes, or this one through another URL of the same
+    # endpoint (RDF_DB_URL and RDF_DB_URL_UPD in utils/paths.py), is not seen
+    # until the results are endpointTtl seconds old
+    def __init__(self, maxSize:int=256, ttl:float=300, maxBytes:int=64 * 1024 * 1024, endpointTtl:float=30):
+        self.maxSize = maxSize
+        self.maxBytes = maxBytes
+        self.ttl = ttl
+        self.endpointTtl = endpointTtl
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.generations = dict()
+        self.mutex = Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def getGeneration(self, database:str):
+        return self.generations.get(database_key(database), 0)
+
+    def invalidate(self, database:str):
+        with self.mutex:
+            key = database_key(database)
+            self.generations[key] = self.generations.get(key, 0) + 1
+
+    def getOrCompute(self, database:str, key, compute):
+        # key identifies the call (method and arguments) on that database
+        database = database_key(database)
+        full_key = (database, self.getGeneration(database), database_version(database), key)
+        ttl = self.endpointTtl if full_key[2] is None else self.ttl
+        with self.mutex:
+            entry = self.entries.get(full_key)
+            if entry is not None:
+                stored_at, value, size = entry
+                if ttl is not None and monotonic() - stored_at > ttl:
+                    del self.entries[full_key]
+                    self.bytes -= size
+                    self.expirations += 1
+                else:
+                    self.entries.move_to_end(full_key)
+                    self.hits += 1
+                    return value.copy()
+            self.misses += 1
+
+        value = compute()
+        size = result_size(value)
+        if self.maxBytes is not None and size > self.maxBytes:
+            return value
+
+        with self.mutex:
+            old = self.entries.pop(full_key, None)
+            if old is not None:
+                self.bytes -= old[2]
+            self.entries[full_key] = (monotonic(), value, size)
+            self.bytes += size
+            while len(self.entries) > self.maxSize or (self.maxBytes is not None and self.bytes > self.maxBytes):
+                self.bytes -= self.entries.popitem(last=False)[1][2]
+                self.evictions += 1
+        return value.copy()
+
+    def clear(self):
+        with self.mutex:
+            self.entries.clear()
+            self.bytes = 0
+
+    def getStats(self):
+        with self.mutex:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hitRate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "size": len(self.entries),
+                "maxSize": self.maxSize,
+                "bytes": self.bytes,
+                "maxBytes": self.maxBytes
+            }
@@ -0,0 +1,154 @@
+from csv import writer
+from io import StringIO
+from re import compile as regex, IGNORECASE, ASCII
+from urllib.request import Request, urlopen
+from ijson import items, items_coro, sendable_list
+from numpy import nan
+from pandas import DataFrame, read_csv
+
+# the result formats of a SELECT query that can be read into a DataFrame
+CSV = "text/csv"
+JSON = "application/sparql-results+json"
+
+# the values read as missing (NaN) in the CSV results: the default list of
+# read_csv, written here and passed to every read_csv so the CSV and the JSON
+# readers always agree on it
+NA_VALUES = frozenset(["", "#N/A", "#N/A N/A", "#NA", "-1.#IND", "-1.#QNAN", "-NaN", "-nan", "1.#IND", "1.#QNAN",
+                       "<NA>", "N/A", "NA", "NULL", "NaN", "None", "n/a", "nan", "null"])
+
+# a value read_csv could turn into a number, a bool or NaN instead of a string
+# (the test is wider than read_csv, a value that only looks like one is fine)
+MAYBE_TYPED = regex(r"\s*([+-]?([0-9.]|inf|nan)|(true|false)\s*$|$)", IGNORECASE | ASCII)
+
+
+def accept_header(formats) -> str:
+    # the formats in order of preference: the first one has q=1, then 0.9, 0.8...
+    return ", ".join(f if i == 0 else f"{f};q={1 - i / 10:.1f}" for i, f in enumerate(formats))
+
+
+def read_csv_results(stream):
+    # read_csv pulls the bytes from the stream as it parses them: the body is
+    # never held as a whole, neither as bytes nor as a decoded string
+    return read_csv(stream, sep=",", keep_default_na=False, na_values=NA_VALUES)
+
+
+def json_term(cell):
+    # a term as it is written in the CSV results
+    if cell is None:
+        return None
+    if cell["type"] == "bnode":
+        return "_:" + cell["value"]
+    return cell["value"]
+
+
+def csv_column(name:str, values:list, width:int):
+    # the column as read_csv gives it from a CSV of width columns: read_csv infers
+    # the type of a column by blocks of rows whose size depends on the width, so
+    # the other columns are written empty instead of leaving them out
+    text = StringIO()
+    rows = writer(text, lineterminator="\n")
+    padding = [None] * (width - 1)
+    rows.writerow([name] + [f"_{i}" for i in range(1, width)])
+    rows.writerows([value] + padding for value in values)
+    text.seek(0)
+    return read_csv(text, sep=",", keep_default_na=False, na_values=NA_VALUES).iloc[:, 0]
+
+
+def text_column(values:list, width:int):
+    # the column of strings read_csv would give, or None if read_csv could see
+    # something else in it (a number, a bool, only missing values) or, in a
+    # result of one column, skip some rows (an unbound value is a blank line)
+    found_text = False
+    for value in values:
+        if value is None:
+            if width == 1:
+                return None
+        elif value in NA_VALUES:
+            pass
+        elif MAYBE_TYPED.match(value):
+            return None
+        else:
+            found_text = True
+    if not found_text:
+        return None
+    return [nan if value is None or value in NA_VALUES else value for value in values]
+
+
+class HeadReader(object):
+    # the response as ijson reads it, that also hands every chunk to a second
+    # parser until the variables of the head are found (the head comes before
+    # the results, so it is usually found in the first chunk)
+    def __init__(self, stream):
+        self.stream = stream
+        self.head = sendable_list()
+        self.parser = items_coro(self.head, "head.vars")
+
+    def read(self, size:int=-1):
+        chunk = self.stream.read(size)
+        if self.parser is not None and chunk:
+            self.parser.send(chunk)
+            if self.head:
+                self.parser = None
+        return chunk
+
+    def getNames(self):
+        if self.parser is not None:
+            self.parser.close()
+            self.parser = None
+        return self.head[0] if self.head else None
+
+
+def read_json_results(stream, chunkSize:int=1 << 16):
+    # the bindings are parsed while the body arrives, chunk by chunk, and every
+    # row goes straight into one list per variable. the DataFrame is the one
+    # read_csv gives from the CSV results of the same query: the columns of
+    # strings are built directly, the others are handed to read_csv
+    reader = HeadReader(stream)
+    columns = dict()
+    count = 0
+    for item in items(reader, "results.bindings.item", buf_size=chunkSize):
+        if count == 0 and reader.head:
+            columns.update((name, []) for name in reader.head[0])
+        if not columns.keys() >= item.keys():
+            for name in item:
+                if name not in columns:
+                    columns[name] = [None] * count
+        for name, column in columns.items():
+            column.append(json_term(item.get(name)))
+        count += 1
+    names = reader.getNames() or list(columns)
+
+    if count == 0:
+        return read_csv(StringIO(",".join(names) + "\n"), sep=",", keep_default_na=False, na_values=NA_VALUES)
+    frame = dict()
+    for name in names:
+        values = columns.get(name, [None] * count)
+        column = text_column(values, len(names))
+        frame[name] = column if column is not None else csv_column(name, values, len(names))
+    return DataFrame(frame, columns=names)
+
+
+# the readers of the formats, by content type
+READERS = {
+    CSV: read_csv_results,
+    JSON: read_json_results
+}
+
+
+def read_results(stream, contentType:str):
+    # the endpoint answers with one of the formats in the Accept header
+    format = (contentType or CSV).split(";")[0].strip().lower()
+    if format not in READERS:
+        raise ValueError(f"unsupported SPARQL results format: {contentType}")
+    return READERS[format](stream)
+
+
+def fetch_results(endpoint:str, query:str, formats=(CSV, JSON)):
+    # the request of sparql_dataframe.get (the query as the POST body) on a new
+    # connection, with the result read from the response while it arrives
+    request = Request(endpoint, data=query.encode("utf-8"), method="POST", headers={
+        "Content-Type": "application/sparql-query",
+        "Accept": accept_header(formats)
+    })
+    with urlopen(request) as response:
+        return read_results(response, response.headers.get("Content-Type"))
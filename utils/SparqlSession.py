@@ -0,0 +1,104 @@
+from http.client import HTTPConnection, HTTPSConnection, HTTPException
+from threading import Condition, Lock
+from urllib.parse import urlparse
+from utils.SparqlResults import CSV, JSON, accept_header, read_results
+
+
+class SparqlSession(object):
+    # a small pool of keep-alive HTTP connections to a SPARQL endpoint: a query
+    # borrows an open connection and gives it back, so the TCP connection is set
+    # up once and reused. at most size connections are open, a query that finds
+    # none free waits for one, so many concurrent queries never exhaust the sockets
+    def __init__(self, endpoint:str, size:int=10, timeout:float=60):
+        url = urlparse(endpoint)
+        self.endpoint = endpoint
+        self.https = url.scheme == "https"
+        self.host = url.hostname
+        self.port = url.port
+        self.path = url.path or "/"
+        if url.query:
+            self.path += "?" + url.query
+        self.size = size
+        self.timeout = timeout
+        # the idle connections (the last one given back is used first) and the
+        # number of connections open, idle or borrowed. available is notified
+        # every time one is given back or discarded, so a waiting query can
+        # take the connection or open a new one in place of the discarded one
+        self.idle = []
+        self.opened = 0
+        self.available = Condition(Lock())
+
+    def _newConnection(self):
+        connection_class = HTTPSConnection if self.https else HTTPConnection
+        return connection_class(self.host, self.port, timeout=self.timeout)
+
+    def _borrow(self):
+        with self.available:
+            if not self.available.wait_for(lambda: self.idle or self.opened < self.size, self.timeout):
+                raise TimeoutError(f"no free connection to {self.endpoint} after {self.timeout}s")
+            if self.idle:
+                return self.idle.pop()
+            self.opened += 1
+        return self._newConnection()
+
+    def _giveBack(self, connection):
+        with self.available:
+            self.idle.append(connection)
+            self.available.notify()
+
+    def _discard(self, connection):
+        connection.close()
+        with self.available:
+            self.opened -= 1
+            self.available.notify()
+
+    def request(self, query:str, accept:str, read):
+        # the same request sparql_dataframe sends: the query as the POST body.
+        # read gets the response while it arrives, the connection is given back
+        # once the whole body has been read
+        headers = {
+            "Content-Type": "application/sparql-query",
+            "Accept": accept,
+            "Connection": "keep-alive"
+        }
+        body = query.encode("utf-8")
+        connection = self._borrow()
+        try:
+            try:
+                connection.request("POST", self.path, body=body, headers=headers)
+                response = connection.getresponse()
+            except (HTTPException, ConnectionError):
+                # the server closed the idle connection: try once more on a new one
+                connection.close()
+                connection = self._newConnection()
+                connection.request("POST", self.path, body=body, headers=headers)
+                response = connection.getresponse()
+            if response.status >= 400:
+                data = response.read()
+                raise HTTPException(f"{response.status} {response.reason}: {data[:500].decode('utf-8', 'replace')}")
+            result = read(response)
+            response.read()
+        except Exception:
+            self._discard(connection)
+            raise
+        if response.will_close:
+            self._discard(connection)
+        else:
+            self._giveBack(connection)
+        return result
+
+    def post(self, query:str, accept:str=CSV):
+        return self.request(query, accept, lambda response: response.read())
+
+    def query(self, query:str, formats=(CSV, JSON)):
+        # a DataFrame like the one of sparql_dataframe.get, in the first of the
+        # formats that the endpoint supports
+        return self.request(query, accept_header(formats),
+                            lambda response: read_results(response, response.getheader("Content-Type")))
+
+    def close(self):
+        with self.available:
+            idle, self.idle = self.idle, []
+            self.opened -= len(idle)
+        for connection in idle:
+            connection.close()
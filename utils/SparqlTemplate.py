@@ -0,0 +1,92 @@
+from collections import OrderedDict
+from re import compile as regex
+from threading import Lock
+
+# the prefixes used by all the queries of the triplestore processors
+PREFIXES = """PREFIX ns1: <https://github.com/n1kg0r/ds-project-dhdk/attributes/>
+PREFIX ns2: <http://purl.org/dc/elements/1.1/>
+PREFIX ns3: <https://github.com/n1kg0r/ds-project-dhdk/relations/>
+"""
+
+# {{name}} in a template is replaced by the value bound to name ($name and ?name
+# are SPARQL variables, so they cannot be used)
+PLACEHOLDER = regex(r"\{\{(\w+)\}\}")
+
+
+# the escapes of a SPARQL string literal (ECHAR)
+ESCAPES = str.maketrans({"\\": "\\\\", '"': '\\"', "\n": "\\n", "\r": "\\r", "\t": "\\t",
+                         "\b": "\\b", "\f": "\\f"})
+
+
+def sparql_literal(value) -> str:
+    # a string literal on one line, with quotes, backslashes and newlines escaped,
+    # so a value can never end the literal and change the query
+    return '"' + str(value).translate(ESCAPES) + '"'
+
+
+class SparqlTemplate(object):
+    # a query split once into its constant parts and its placeholders: binding
+    # the values only joins the parts with the escaped literals. a list bound to
+    # a placeholder gives its literals separated by spaces, for a VALUES block
+    def __init__(self, body:str):
+        parts = PLACEHOLDER.split(PREFIXES + body)
+        self.texts = parts[0::2]
+        self.names = parts[1::2]
+
+    def bind(self, values:dict) -> str:
+        query = [self.texts[0]]
+        for name, text in zip(self.names, self.texts[1:]):
+            value = values[name]
+            if isinstance(value, (list, tuple)):
+                query.append(" ".join(sparql_literal(v) for v in value))
+            else:
+                query.append(sparql_literal(value))
+            query.append(text)
+        return "".join(query)
+
+
+class SparqlTemplates(object):
+    # the templates of a processor, compiled when the class is defined, and the
+    # query texts generated from them: the same call gives the same text (so
+    # the endpoint and the result cache see the same query) and the text is
+    # generated only once while it stays among the last maxSize ones.
+    # the texts of lists (batches of VALUES) are not kept, they are rarely repeated
+    def __init__(self, templates:dict, maxSize:int=1024):
+        self.templates = {name: SparqlTemplate(body) for name, body in templates.items()}
+        self.maxSize = maxSize
+        self.queries = OrderedDict()
+        self.mutex = Lock()
+        self.hits = 0
+        self.generated = 0
+
+    def render(self, name:str, **values) -> str:
+        template = self.templates[name]
+        key = None
+        if not any(isinstance(value, (list, tuple)) for value in values.values()):
+            key = (name,) + tuple(sorted((k, str(v)) for k, v in values.items()))
+            with self.mutex:
+                query = self.queries.get(key)
+                if query is not None:
+                    self.queries.move_to_end(key)
+                    self.hits += 1
+                    return query
+
+        query = template.bind(values)
+
+        with self.mutex:
+            self.generated += 1
+            if key is not None:
+                self.queries[key] = query
+                while len(self.queries) > self.maxSize:
+                    self.queries.popitem(last=False)
+        return query
+
+    def getStats(self):
+        with self.mutex:
+            return {
+                "templates": len(self.templates),
+                "hits": self.hits,
+                "generated": self.generated,
+                "size": len(self.queries),
+                "maxSize": self.maxSize
+            }
@@ -0,0 +1,66 @@
+from itertools import islice
+from time import perf_counter
+from urllib.request import Request, urlopen
+from rdflib.plugins.stores.sparqlstore import SPARQLUpdateStore
+from utils.LocalGraph import is_local_graph, LocalGraphStore
+
+
+def triples_to_ntriples(triples) -> str:
+    # n3() of URIRef and Literal is already valid N-Triples syntax
+    return "\n".join(f"{s.n3()} {p.n3()} {o.n3()} ." for s, p, o in triples)
+
+
+def upload_Graph(triples, endpoint:str, batch_size:int=10000, mode:str="update", report=print):
+    # send the triples to the endpoint in batches instead of one HTTP request per triple
+    #   mode "update" -> one SPARQL "INSERT DATA" request per batch
+    #   mode "post"   -> one N-Triples POST per batch (Blazegraph REST insert)
+    # a batch_size of 0 (or None) sends everything in a single request.
+    # if endpoint is a local graph file, the batches are added to it instead
+    # triples can be any iterable (a Graph, a generator...), it is consumed batch by batch
+    if mode not in ("update", "post"):
+        raise ValueError(f"unknown upload mode: {mode}")
+
+    store = None
+    local_store = LocalGraphStore.get(endpoint) if is_local_graph(endpoint) else None
+    if mode == "update" and local_store is None:
+        store = SPARQLUpdateStore()
+        store.open((endpoint, endpoint))
+
+    stats = []
+    iterator = iter(triples)
+    try:
+        while True:
+            batch = list(islice(iterator, batch_size)) if batch_size else list(iterator)
+            if not batch:
+                break
+
+            start = perf_counter()
+            data = triples_to_ntriples(batch) if local_store is None else None
+            if local_store is not None:
+                local_store.add(batch)
+            elif mode == "update":
+                store.update("INSERT DATA {\n%s\n}" % data)
+            else:
+                request = Request(endpoint, data=data.encode("utf-8"), method="POST",
+                                  headers={"Content-Type": "text/plain; charset=utf-8"})
+                with urlopen(request) as response:
+                    response.read()
+            elapsed = perf_counter() - start
+
+            batch_stats = {
+                "batch": len(stats) + 1,
+                "triples": len(batch),
+                "seconds": elapsed,
+                "triplesPerSecond": len(batch) / elapsed if elapsed else float("inf")
+            }
+            stats.append(batch_stats)
+            if report:
+                report("batch %(batch)d: %(triples)d triples in %(seconds).3fs (%(triplesPerSecond).0f triples/s)" % batch_stats)
+
+            if not batch_size:
+                break
+    finally:
+        if store is not None:
+            store.close()
+
+    return stats
@@ -1,3 +1,7 @@
+from os.path import abspath, dirname, join
+
 RDF_DB_URL = "http://192.168.0.168:9999/blazegraph/sparql"
 RDF_DB_URL_UPD = "http://127.0.0.1:9999/blazegraph/sparql"
-SQL_DB_URL = "data/annotation.db"
\ No newline at end of file
+SQL_DB_URL = "data/annotation.db"
+COUNTERS_DIR = join(dirname(dirname(abspath(__file__))), "counters")
+IDENTITY_INDEX = join(dirname(dirname(abspath(__file__))), "identity_index.db")
\ No newline at end of file